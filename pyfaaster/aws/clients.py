@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016-present, CloudZero, Inc. All rights reserved.
+# Licensed under the BSD-style license. See LICENSE file in the project root for full license information.
+
+"""
+A registry of boto3 clients that are reused across lambda invocations.
+
+Building a boto3 client costs tens of milliseconds, and every new client starts with a cold connection
+pool. Clients are thread safe, so we build one per (service, region, endpoint, credentials) and keep it
+for the life of the container.
+"""
+
+import threading
+
+import boto3
+from botocore.config import Config
+
+import pyfaaster.aws.tools as tools
+
+logger = tools.setup_logging('pyfaaster')
+
+DEFAULT_CONFIG = Config(
+    max_pool_connections=50,
+    connect_timeout=5,
+    retries={'max_attempts': 5, 'mode': 'standard'},
+)
+
+# merged over DEFAULT_CONFIG per service: a synchronous Lambda invoke can run for up to 15 minutes, and
+# a read timeout before then would be retried, invoking the function again
+SERVICE_CONFIGS = {
+    'lambda': Config(read_timeout=900),
+}
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def client(service_name, region_name=None, endpoint_url=None, aws_access_key_id=None, aws_secret_access_key=None,
+           aws_session_token=None, config=None):
+    """
+    Get the shared boto3 client for the given service, region, endpoint and credentials, creating it
+    (with DEFAULT_CONFIG and the service's SERVICE_CONFIGS merged under `config`) on first use.
+
+    Args:
+        service_name (str): e.g. 's3'
+        region_name (str): defaults to boto3's region resolution
+        endpoint_url (str):
+        aws_access_key_id (str): defaults to boto3's credential resolution
+        aws_secret_access_key (str):
+        aws_session_token (str):
+        config (botocore.config.Config): overrides for DEFAULT_CONFIG; clients are shared between equal configs
+
+    Returns:
+        a boto3 client
+    """
+    key = (service_name, region_name, endpoint_url, aws_access_key_id, aws_secret_access_key, aws_session_token,
+           _config_key(config))
+    shared = _clients.get(key)
+    if shared:
+        return shared
+
+    with _lock:
+        shared = _clients.get(key)
+        if not shared:
+            logger.debug(f'Creating {service_name} client (region: {region_name}, endpoint: {endpoint_url})')
+            merged = DEFAULT_CONFIG
+            for overrides in (SERVICE_CONFIGS.get(service_name), config):
+                if overrides:
+                    merged = merged.merge(overrides)
+            shared = boto3.client(service_name,
+                                  region_name=region_name,
+                                  endpoint_url=endpoint_url,
+                                  aws_access_key_id=aws_access_key_id,
+                                  aws_secret_access_key=aws_secret_access_key,
+                                  aws_session_token=aws_session_token,
+                                  config=merged)
+            _clients[key] = shared
+    return shared
+
+
+def _config_key(config):
+    """ A hashable key for the options set on `config`, equal for equal configs.
+
+    >>> _config_key(Config(retries={'mode': 'standard'}, read_timeout=1)) == _config_key(Config(read_timeout=1,
+    ...                                                                                      retries={'mode': 'standard'}))
+    True
+    """
+    if not config:
+        return None
+    return tuple(sorted((name, repr(value)) for name, value in config._user_provided_options.items()))
+
+
+def clear():
+    """ Forget all shared clients, e.g. after credentials have been rotated. """
+    with _lock:
+        _clients.clear()
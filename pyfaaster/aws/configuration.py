@@ -5,10 +5,13 @@
 from cachetools import cached, LRUCache
 from cachetools.keys import hashkey
 import io
+import threading
+import time
 
-import boto3
+import botocore.exceptions
 import simplejson as json
 
+import pyfaaster.aws.clients as clients
 import pyfaaster.aws.tools as tools
 
 logger = tools.setup_logging('pyfaaster')
@@ -24,14 +27,18 @@ def load(conn, config_bucket, config_file):
     return settings
 
 
-def save(conn, config_bucket, config_file, settings):
+def _put(conn, config_bucket, config_file, settings):
     logger.info(f'Saving configuration to {config_bucket}/{config_file}.')
     encryption = {'ServerSideEncryption': 'aws:kms', 'SSEKMSKeyId': conn['encrypt_key_arn']} if conn[
         'encrypt_key_arn'] else {'ServerSideEncryption': 'AES256'}
-    conn['client'].put_object(Bucket=config_bucket,
-                              Key=config_file,
-                              Body=io.StringIO(json.dumps(settings)).read(),
-                              **encryption)
+    return conn['client'].put_object(Bucket=config_bucket,
+                                     Key=config_file,
+                                     Body=io.StringIO(json.dumps(settings)).read(),
+                                     **encryption)
+
+
+def save(conn, config_bucket, config_file, settings):
+    _put(conn, config_bucket, config_file, settings)
     return settings
 
 
@@ -46,16 +53,219 @@ def load_or_create(conn, config_bucket, config_file):
 
 def conn(encrypt_key_arn=None, client=None):
     return {
-        'client': client or boto3.client('s3'),
+        'client': client or clients.client('s3'),
         'encrypt_key_arn': encrypt_key_arn,
     }
 
 
 read_only_cache = LRUCache(maxsize=32)
+read_only_lock = threading.RLock()
 
 
 @cached(cache=read_only_cache,
-        key=lambda conn, config_bucket, config_file: hashkey(config_bucket, config_file))
+        key=lambda conn, config_bucket, config_file: hashkey(config_bucket, config_file),
+        lock=read_only_lock)
 def read_only(conn, config_bucket, config_file):
     logger.info(f'Reading {config_bucket}/{config_file}.')
     return load(conn, config_bucket, config_file)
+
+
+revalidating_cache = LRUCache(maxsize=32)
+revalidating_cache_stats = {'hits': 0, 'misses': 0, 'not_modified': 0}
+_revalidating_lock = threading.Lock()
+
+
+def _cache_put(config_bucket, config_file, settings, etag, ttl):
+    with _revalidating_lock:
+        revalidating_cache[hashkey(config_bucket, config_file)] = (settings, etag, time.monotonic() + ttl)
+
+
+def load_revalidated(conn, config_bucket, config_file, ttl=60):
+    """
+    Load configuration, keeping the parsed settings in memory (i.e. in the warm container).
+    Within `ttl` seconds of the last fetch the cached settings are returned without calling S3;
+    after that the object is revalidated with a conditional GET on its ETag, so unchanged
+    configuration costs a 304 instead of a download and parse.
+
+    Counts of each outcome are kept in revalidating_cache_stats:
+        hits: served from memory
+        not_modified: revalidated with S3 (304)
+        misses: downloaded and parsed
+
+    Args:
+        conn (dict): see conn()
+        config_bucket (str):
+        config_file (str):
+        ttl (int): seconds before cached settings are revalidated
+
+    Returns:
+        dict
+    """
+    key = hashkey(config_bucket, config_file)
+    with _revalidating_lock:
+        entry = revalidating_cache.get(key)
+        if entry and time.monotonic() < entry[2]:
+            revalidating_cache_stats['hits'] += 1
+            return entry[0]
+
+    if entry:
+        try:
+            logger.info(f'Revalidating configuration {config_bucket}/{config_file}.')
+            content_object = conn['client'].get_object(Bucket=config_bucket, Key=config_file, IfNoneMatch=entry[1])
+        except botocore.exceptions.ClientError as err:
+            if err.response.get('ResponseMetadata', {}).get('HTTPStatusCode') != 304:
+                raise
+            _cache_put(config_bucket, config_file, entry[0], entry[1], ttl)
+            with _revalidating_lock:
+                revalidating_cache_stats['not_modified'] += 1
+            return entry[0]
+    else:
+        logger.info(f'Reading configuration from {config_bucket}/{config_file}.')
+        content_object = conn['client'].get_object(Bucket=config_bucket, Key=config_file)
+
+    settings = json.loads(content_object['Body'].read().decode('utf-8'))
+    _cache_put(config_bucket, config_file, settings, content_object.get('ETag'), ttl)
+    with _revalidating_lock:
+        revalidating_cache_stats['misses'] += 1
+    return settings
+
+
+def save_revalidated(conn, config_bucket, config_file, settings, ttl=60):
+    """
+    Save configuration and replace the settings held for load_revalidated in one step, so
+    concurrent readers see either the old or the new settings with their matching ETag.
+
+    Args:
+        conn (dict): see conn()
+        config_bucket (str):
+        config_file (str):
+        settings (dict):
+        ttl (int): seconds before the saved settings are revalidated
+
+    Returns:
+        dict
+    """
+    response = _put(conn, config_bucket, config_file, settings)
+    _cache_put(config_bucket, config_file, settings, response.get('ETag'), ttl)
+    return settings
+
+
+def _not_found(error):
+    if not isinstance(error, botocore.exceptions.ClientError):
+        return False
+    return (error.response.get('Error', {}).get('Code') in ('NoSuchKey', '404') or
+            error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 404)
+
+
+def load_or_create_revalidated(conn, config_bucket, config_file, ttl=60):
+    """
+    load_revalidated, creating an empty configuration file if there is none. If S3 fails otherwise (e.g.
+    throttling or a timeout) the settings already held are returned, or the error raised if there are none.
+
+    Args:
+        conn (dict): see conn()
+        config_bucket (str):
+        config_file (str):
+        ttl (int): seconds before cached settings are revalidated
+
+    Returns:
+        dict
+    """
+    try:
+        logger.info(f'Attempting to load {config_bucket}/{config_file}')
+        return load_revalidated(conn, config_bucket, config_file, ttl)
+    except Exception as error:
+        if _not_found(error):
+            logger.info(f'Failed to load, attempting to create {config_bucket}/{config_file} ({error})')
+            return save_revalidated(conn, config_bucket, config_file, {}, ttl)
+        with _revalidating_lock:
+            entry = revalidating_cache.get(hashkey(config_bucket, config_file))
+        if entry is None:
+            raise
+        logger.warning(f'Failed to revalidate {config_bucket}/{config_file}, using cached settings. ({error})')
+        return entry[0]
+
+
+_background = {'thread': None, 'stop': None, 'wake': None, 'registered': {}}
+_background_lock = threading.Lock()
+
+
+def _refresh(key, registration):
+    config_bucket, config_file = key
+    try:
+        settings = load_revalidated(registration['conn'], config_bucket, config_file, ttl=0)
+        with read_only_lock:
+            read_only_cache[key] = settings
+    except Exception as err:
+        logger.warning(f'Failed to refresh {config_bucket}/{config_file}, keeping current settings. ({err})')
+    finally:
+        registration['due'] = time.monotonic() + registration['interval']
+
+
+def _refresh_loop(stop, wake):
+    while not stop.is_set():
+        now = time.monotonic()
+        with _background_lock:
+            due = [(k, r) for k, r in _background['registered'].items() if r['due'] <= now]
+        for key, registration in due:
+            _refresh(key, registration)
+
+        with _background_lock:
+            next_due = min((r['due'] for r in _background['registered'].values()), default=None)
+        wake.wait(None if next_due is None else max(0, next_due - time.monotonic()))
+        wake.clear()
+
+
+def refresh_in_background(conn, config_bucket, config_file, interval=60):
+    """
+    Keep the read_only() settings for `config_bucket`/`config_file` fresh from a daemon thread, so
+    handlers calling read_only() always get the in-memory copy and never wait on S3 once registered.
+    Every `interval` seconds the thread revalidates the file (a 304 when unchanged, see
+    load_revalidated) and replaces the read_only_cache entry; on failure the current settings are kept.
+
+    NOTE: Lambda freezes the container between invocations, so refreshes only happen while it is
+          thawed. Settings can therefore be older than `interval` at the start of an invocation, and are
+          refreshed alongside it (i.e. stale-while-revalidate).
+
+    Args:
+        conn (dict): see conn()
+        config_bucket (str):
+        config_file (str):
+        interval (int): seconds between refreshes
+
+    Returns:
+        dict: the current settings
+    """
+    settings = read_only(conn, config_bucket, config_file)
+    with _background_lock:
+        _background['registered'][hashkey(config_bucket, config_file)] = {
+            'conn': conn,
+            'interval': interval,
+            'due': time.monotonic() + interval,
+        }
+        if _background['thread'] and _background['thread'].is_alive():
+            _background['wake'].set()
+        else:
+            stop, wake = threading.Event(), threading.Event()
+            thread = threading.Thread(target=_refresh_loop, args=(stop, wake),
+                                      name='pyfaaster-configuration-refresh', daemon=True)
+            _background.update(thread=thread, stop=stop, wake=wake)
+            thread.start()
+    return settings
+
+
+def stop_background_refresh(timeout=None):
+    """
+    Stop the refresh thread started by refresh_in_background and forget all registered files.
+    Their last settings stay in read_only_cache.
+
+    Args:
+        timeout (float): seconds to wait for the thread to finish
+    """
+    with _background_lock:
+        thread, stop, wake = _background['thread'], _background['stop'], _background['wake']
+        _background.update(thread=None, stop=None, wake=None, registered={})
+    if thread:
+        stop.set()
+        wake.set()
+        thread.join(timeout)
@@ -2,16 +2,195 @@
 # Copyright (c) 2016-present, CloudZero, Inc. All rights reserved.
 # Licensed under the BSD-style license. See LICENSE file in the project root for full license information.
 
+import contextlib
+from decimal import Decimal
+import queue
+import random
 import re
-from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
+import threading
+import time
+import weakref
+
+from cachetools import cached, LRUCache
+
+import pyfaaster.aws.clients as clients
+import pyfaaster.aws.dynamodb_codec as codec
+import pyfaaster.aws.tools as tools
+import pyfaaster.common.concurrency as concurrency
+
+logger = tools.setup_logging('pyfaaster')
+
+
+class UnprocessedKeysException(Exception):
+    def __init__(self, table_name, keys):
+        super().__init__(f'{len(keys)} keys of {table_name} were not read')
+        self.keys = keys
+
 
 pattern = re.compile(r'[\W_]+', re.UNICODE)
 
+serializer = codec.Serializer()
+deserializer = codec.Deserializer()
+
+update_expression_cache = LRUCache(maxsize=256)
+
+
+@cached(cache=update_expression_cache, lock=threading.Lock())
+def _update_expression(attribute_names):
+    """
+    Compile the SET expression for a tuple of attribute names.
+
+    Returns:
+        tuple: (UpdateExpression, ExpressionAttributeNames, value placeholder for each attribute name)
+    """
+    # Prepare data by generating an alphanumeric version of the key
+    placeholders = [pattern.sub('', k) for k in attribute_names]
+    updates_string = ', '.join([f'#{p} = :{p}' for p in placeholders])
+    attribute_names = {f'#{p}': k for p, k in zip(placeholders, attribute_names)}
+    return f'SET {updates_string}', attribute_names, tuple(f':{p}' for p in placeholders)
+
+
+_item_caches = weakref.WeakSet()
+
+
+def _written(table_name, key, item=None):
+    """ Tell every ItemCache holding `key` that its item was updated to `item` (None if not known). """
+    for cache in list(_item_caches):
+        cache._written(table_name, key, item)
+
+
+def _replaced(table_name, items):
+    """ Tell every ItemCache that `items` were put, replacing the items with the same keys. """
+    for cache in list(_item_caches):
+        for item in items:
+            cache._replaced(table_name, item)
+
+
+class ItemCache:
+    """
+    A read-through cache of DynamoDB items, for reference data (tenants, settings, ...) that is read on
+    every invocation. Keep one at module level, so that it lives as long as the container.
+
+    Items are cached for `ttl` seconds, or per table with `table_ttls`, and the least recently used are
+    evicted beyond `maxsize`. Missing items are cached too, for `negative_ttl` seconds. Items updated
+    through this module (update_item_from_dict, update_item_diff, bulk_update, CounterBuffer, batch_write)
+    are refreshed or dropped in every cache holding them, and a read racing such a write is not cached;
+    other writers are only seen when entries expire.
+    Counts of hits, misses and negative_hits (hits of a missing item) are kept in `stats`.
+
+    E.g.,
+        tenants = dynamodb.ItemCache(ttl=300)
+
+        def handler(event, context, **kwargs):
+            tenant = tenants.get('tenants', {'id': event['tenant']})
+
+    Or see handlers_decorators_v2.item_cache_aware.
+
+    Args:
+        maxsize (int): items (and missing items) cached
+        ttl (float): seconds an item is cached for
+        table_ttls (dict): table name -> seconds, overriding ttl
+        negative_ttl (float): seconds a missing item is cached for, defaults to the table's ttl
+        client: dynamodb client, defaults to the shared client
+    """
+
+    def __init__(self, maxsize=1024, ttl=60, table_ttls=None, negative_ttl=None, client=None):
+        self.ttl = ttl
+        self.table_ttls = table_ttls or {}
+        self.negative_ttl = negative_ttl
+        self.client = client
+        self.stats = {'hits': 0, 'misses': 0, 'negative_hits': 0}
+        self._items = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+        # cache key -> generation of the read in flight, dropped by a write to the key
+        self._loading = {}
+        self._generation = 0
+        self._key_names = {}
+        _item_caches.add(self)
+
+    def get(self, table_name, key, consistent_read=False):
+        """
+        Args:
+            table_name (str):
+            key (dict): primary key
+            consistent_read (bool): used when the item is read from the table
+
+        Returns:
+            dict: the item, or None if there is no item with `key`
+        """
+        cache_key = (table_name, tuple(sorted(key.items())))
+        with self._lock:
+            entry = self._items.get(cache_key)
+            if entry and entry[1] > time.monotonic():
+                self.stats['hits' if entry[0] is not None else 'negative_hits'] += 1
+                return entry[0]
+            self.stats['misses'] += 1
+            self._key_names[table_name] = tuple(sorted(key))
+            self._generation += 1
+            generation = self._loading[cache_key] = self._generation
+
+        try:
+            response = (self.client or clients.client('dynamodb')).get_item(
+                TableName=table_name, Key=codec.serialize_item(key), ConsistentRead=consistent_read)
+        except Exception:
+            with self._lock:
+                if self._loading.get(cache_key) == generation:
+                    del self._loading[cache_key]
+            raise
+        item = codec.deserialize_item(response['Item']) if 'Item' in response else None
+        self._put(cache_key, item, generation)
+        return item
+
+    def invalidate(self, table_name, key):
+        """ Drop the cached item with `key`. """
+        cache_key = (table_name, tuple(sorted(key.items())))
+        with self._lock:
+            self._items.pop(cache_key, None)
+            self._loading.pop(cache_key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._loading.clear()
+
+    def _expires(self, table_name, item):
+        ttl = self.table_ttls.get(table_name, self.ttl)
+        if item is None and self.negative_ttl is not None:
+            ttl = self.negative_ttl
+        return time.monotonic() + ttl
+
+    def _put(self, cache_key, item, generation):
+        with self._lock:
+            if self._loading.get(cache_key) != generation:
+                # written (or read again) since this read started
+                return
+            del self._loading[cache_key]
+            self._items[cache_key] = (item, self._expires(cache_key[0], item))
+
+    def _written(self, table_name, key, item):
+        cache_key = (table_name, tuple(sorted(key.items())))
+        with self._lock:
+            self._loading.pop(cache_key, None)
+            if cache_key not in self._items:
+                return
+            if item is None:
+                del self._items[cache_key]
+            else:
+                self._items[cache_key] = (item, self._expires(table_name, item))
+
+    def _replaced(self, table_name, item):
+        key_names = self._key_names.get(table_name)
+        if key_names and all(name in item for name in key_names):
+            self._written(table_name, {name: item[name] for name in key_names}, None)
+
 
 def update_item_from_dict(table_name, key, dictionary, client):
     """
     Update the item identified by `key` in the DynamoDB `table` by adding
     all of the attributes in the `dictionary`.
+
+    The update expression for each distinct set of attribute names is compiled once and kept in
+    update_expression_cache, so repeated calls with the same attributes only serialize the values.
     Args:
         table_name (str):
         key (dict):
@@ -21,29 +200,666 @@ def update_item_from_dict(table_name, key, dictionary, client):
     Returns:
         dict
     """
-    serializer = TypeSerializer()
-    deserializer = TypeDeserializer()
-
-    # Prepare data by generating an alphanumeric version of the key
-    working_data = {k: [pattern.sub("", k), v] for k, v in dictionary.items()}
-
-    updates_string = ', '.join([f'#{v[0]} = :{v[0]}' for v in working_data.values()])
-    update_expression = f'SET {updates_string}'
-    attribute_names = {f'#{v[0]}': k for k, v in working_data.items()}
-    attribute_values = {f':{v[0]}': serializer.serialize(v[1]) for k, v in working_data.items()}
+    update_expression, attribute_names, placeholders = _update_expression(tuple(dictionary))
+    attribute_values = {p: codec.serialize(v) for p, v in zip(placeholders, dictionary.values())}
     item = client.update_item(
         TableName=table_name,
-        Key={k: serializer.serialize(v) for k, v in key.items()},
+        Key=codec.serialize_item(key),
         UpdateExpression=update_expression,
-        ExpressionAttributeNames=attribute_names,
+        ExpressionAttributeNames=dict(attribute_names),
         ExpressionAttributeValues=attribute_values,
         ReturnValues='ALL_NEW',
     )
     if item:
-        result_data = item.get('Attributes', {})
-        output_data = {}
-        for k, v in result_data.items():
-            output_data[k] = deserializer.deserialize(v)
-        return output_data
+        item = codec.deserialize_item(item.get('Attributes', {}))
+        _written(table_name, key, item)
+        return item
     else:
         return None
+
+
+def bulk_update(table_name, updates, client=None, max_concurrency=8):
+    """
+    Update many items with update_item_from_dict, concurrently. Items with the same attribute names share
+    one compiled update expression (see update_expression_cache).
+
+    E.g.,
+        results = bulk_update('users', [({'id': '1'}, {'name': 'Lloyd'}), ({'id': '2'}, {'age': 30})])
+        failed = [r['key'] for r in results if not r['success']]
+
+    Args:
+        table_name (str):
+        updates (iterable): (key, attributes) pairs
+        client: dynamodb client, defaults to the shared client
+        max_concurrency (int): ceiling on updates in flight, to protect the table's write capacity (the
+                               shared pool's size is always a ceiling too)
+
+    Returns:
+        list: for each update, in order, {'key': ..., 'success': True, 'item': the updated item} or
+              {'key': ..., 'success': False, 'error': the exception raised}
+    """
+    client = client or clients.client('dynamodb')
+    updates = list(updates)
+    items = concurrency.map_concurrently(lambda update: update_item_from_dict(table_name, *update, client),
+                                         updates, max_concurrency=max_concurrency, name='dynamodb',
+                                         return_exceptions=True)
+
+    results = []
+    for (key, _), item in zip(updates, items):
+        if isinstance(item, Exception):
+            logger.error(f'Failed to update {key} in {table_name}: {item}')
+            results.append({'key': key, 'success': False, 'error': item})
+        else:
+            results.append({'key': key, 'success': True, 'item': item})
+    return results
+
+
+MAX_EXPRESSION_BYTES = 4 * 1024
+MAX_EXPRESSION_ACTIONS = 300
+
+
+def _is_number(value):
+    return isinstance(value, (int, Decimal)) and not isinstance(value, bool)
+
+
+def _is_empty_set(value):
+    return isinstance(value, (set, frozenset)) and not value
+
+
+def _diff(old, new, path, actions):
+    """ Append an (action, document path, value) to `actions` for each change from `old` to `new`. """
+    if isinstance(old, dict) and isinstance(new, dict):
+        actions.extend(('REMOVE', path + (k,), None) for k in old if k not in new)
+        for k, v in new.items():
+            if k in old:
+                _diff(old[k], v, path + (k,), actions)
+            elif not _is_empty_set(v):
+                actions.append(('SET', path + (k,), v))
+    elif isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        for i, (o, n) in enumerate(zip(old, new)):
+            _diff(o, n, path + (i,), actions)
+    elif _is_number(old) and _is_number(new):
+        if old != new:
+            actions.append(('INCREMENT', path, new - old))
+    elif _is_empty_set(new):
+        # DynamoDB has no empty sets
+        if not _is_empty_set(old):
+            actions.append(('REMOVE', path, None))
+    elif isinstance(old, set) and isinstance(new, set) and len(path) == 1:
+        added, removed = new - old, old - new
+        if added and removed:
+            # ADD and DELETE of the same path in one expression would overlap
+            actions.append(('SET', path, new))
+        elif added:
+            actions.append(('ADD', path, added))
+        elif removed:
+            actions.append(('DELETE', path, removed))
+    elif type(old) is not type(new) or old != new:
+        actions.append(('SET', path, new))
+
+
+def _document_path(path, names):
+    """ Render a path like ('a', 'b', 3) as '#n0.#n1[3]', adding its names' placeholders to `names`. """
+    rendered = ''
+    for component in path:
+        if isinstance(component, int):
+            rendered += f'[{component}]'
+        else:
+            placeholder = names.setdefault(component, f'#n{len(names)}')
+            rendered += f'.{placeholder}' if rendered else placeholder
+    return rendered
+
+
+def _clause(action, path, value, names, values):
+    """
+    Returns:
+        tuple: (UpdateExpression keyword, clause) for an action, adding its placeholders to names and values
+    """
+    document_path = _document_path(path, names)
+    if action == 'REMOVE':
+        return 'REMOVE', document_path
+    placeholder = f':v{len(values)}'
+    values[placeholder] = codec.serialize(value)
+    if action == 'SET':
+        return 'SET', f'{document_path} = {placeholder}'
+    if action == 'INCREMENT' and len(path) > 1:
+        # ADD only works on top level attributes
+        return 'SET', f'{document_path} = {document_path} + {placeholder}'
+    return 'ADD' if action in ('ADD', 'INCREMENT') else 'DELETE', f'{document_path} {placeholder}'
+
+
+def _expression(clauses, names, values):
+    by_keyword = {}
+    for keyword, clause in clauses:
+        by_keyword.setdefault(keyword, []).append(clause)
+    return {
+        'UpdateExpression': ' '.join(f'{keyword} {", ".join(c)}' for keyword, c in by_keyword.items()),
+        'ExpressionAttributeNames': {placeholder: name for name, placeholder in names.items()},
+        'ExpressionAttributeValues': values,
+    }
+
+
+def diff_update_expressions(old, new, numeric_add=True):
+    """
+    Compute the update expressions that turn the item `old` into `new`, touching only what changed.
+
+    Nested changes are made at their document path (e.g. #n0.#n1[3]) rather than by rewriting the whole
+    top level attribute; changed numbers are incremented by the difference, atomically (ADD at the top
+    level, SET #n = #n + :v below it); and elements are added to or deleted from top level sets (sets
+    that both gain and lose elements are rewritten, and emptied sets removed). Lists that change length
+    are rewritten.
+
+    E.g.,
+    >>> diff_update_expressions({'id': '1', 'n': 1, 'm': {'a': 'x', 'b': 'y'}}, {'id': '1', 'n': 3, 'm': {'a': 'z'}})
+    [{'UpdateExpression': 'ADD #n0 :v0 REMOVE #n1.#n2 SET #n1.#n3 = :v1', 'ExpressionAttributeNames': {'#n0': 'n', '#n1': 'm', '#n2': 'b', '#n3': 'a'}, 'ExpressionAttributeValues': {':v0': {'N': '2'}, ':v1': {'S': 'z'}}}]
+
+    Expressions are split to keep each within MAX_EXPRESSION_BYTES and MAX_EXPRESSION_ACTIONS.
+
+    Args:
+        old (dict): item as it is
+        new (dict): item as it should be
+        numeric_add (bool): increment changed numbers, rather than SET them to the new value
+
+    Returns:
+        list: of dicts with UpdateExpression, ExpressionAttributeNames and ExpressionAttributeValues
+    """
+    actions = []
+    _diff(old, new, (), actions)
+    if not numeric_add:
+        actions = [('SET', path, _value_at(new, path)) if action == 'INCREMENT' else (action, path, value)
+                   for action, path, value in actions]
+
+    expressions = []
+    clauses, names, values, size = [], {}, {}, 0
+    for action, path, value in actions:
+        chunk_names, chunk_values = dict(names), dict(values)
+        keyword, clause = _clause(action, path, value, chunk_names, chunk_values)
+        if clauses and (size + len(clause) + 10 > MAX_EXPRESSION_BYTES or len(clauses) == MAX_EXPRESSION_ACTIONS):
+            expressions.append(_expression(clauses, names, values))
+            clauses, names, values, size = [], {}, {}, 0
+            chunk_names, chunk_values = {}, {}
+            keyword, clause = _clause(action, path, value, chunk_names, chunk_values)
+        clauses.append((keyword, clause))
+        names, values, size = chunk_names, chunk_values, size + len(clause) + 10
+    if clauses:
+        expressions.append(_expression(clauses, names, values))
+    return expressions
+
+
+def _value_at(item, path):
+    for component in path:
+        item = item[component]
+    return item
+
+
+def update_item_diff(table_name, key, old, new, client=None, numeric_add=True):
+    """
+    Update the item identified by `key` in the DynamoDB `table_name` from `old` to `new`, writing only the
+    attributes (and nested fields) that changed (see diff_update_expressions). Changes too big for one
+    update expression are made with several UpdateItem calls, which together are not atomic.
+
+    Args:
+        table_name (str):
+        key (dict):
+        old (dict): item as it is
+        new (dict): item as it should be
+        client: dynamodb client, defaults to the shared client
+        numeric_add (bool): increment changed numbers, rather than SET them to the new value
+
+    Returns:
+        dict: the updated item, or None if nothing changed
+    """
+    client = client or clients.client('dynamodb')
+    old = {k: v for k, v in old.items() if k not in key}
+    new = {k: v for k, v in new.items() if k not in key}
+    expressions = diff_update_expressions(old, new, numeric_add)
+
+    response = None
+    for i, expression in enumerate(expressions):
+        response = client.update_item(
+            TableName=table_name,
+            Key=codec.serialize_item(key),
+            ReturnValues='ALL_NEW' if i == len(expressions) - 1 else 'NONE',
+            **expression,
+        )
+    if not response:
+        return None
+    item = codec.deserialize_item(response.get('Attributes', {}))
+    _written(table_name, key, item)
+    return item
+
+
+class CounterBuffer:
+    """
+    Sum increments to DynamoDB counters in memory and write them as one atomic ADD per item, instead of an
+    UpdateItem per increment.
+
+    Increments are buffered by (table, key, attribute) until flush(), or until `max_keys` items have
+    buffered increments, and the updates for different items are made concurrently. See
+    handlers_decorators_v2.counters_aware for a buffer that is flushed when the handler returns.
+
+    E.g.,
+        counters = dynamodb.CounterBuffer()
+        for record in records:
+            counters.increment('usage', {'tenant': record['tenant'], 'hour': record['hour']}, 'requests')
+        counters.flush()
+
+    Args:
+        client: dynamodb client, defaults to the shared client
+        max_keys (int): flush when this many items have buffered increments
+        max_concurrency (int): updates made at once (None for as many as the pool allows)
+    """
+
+    def __init__(self, client=None, max_keys=1000, max_concurrency=None):
+        self.client = client
+        self.max_keys = max_keys
+        self.max_concurrency = max_concurrency
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._counts)
+
+    def increment(self, table_name, key, attribute, amount=1):
+        """
+        Args:
+            table_name (str):
+            key (dict): primary key of the item holding the counter
+            attribute (str): top level number attribute
+            amount (int|Decimal): added to the counter; may be negative
+        """
+        buffer_key = (table_name, tuple(sorted(key.items())))
+        with self._lock:
+            counts = self._counts.get(buffer_key)
+            if counts is None:
+                counts = self._counts[buffer_key] = {}
+            counts[attribute] = counts.get(attribute, 0) + amount
+            full = len(self._counts) >= self.max_keys
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered increments.
+
+        Returns:
+            int: UpdateItem calls made
+
+        Raises:
+            ConcurrentExecutionError: if any update failed; its increments are put back in the buffer, for
+                                      the next flush to retry (an update that failed after being applied,
+                                      e.g. on a timeout, is then counted twice)
+        """
+        with self._lock:
+            counts, self._counts = self._counts, {}
+        updates = [(table_name, dict(key), {a: n for a, n in attributes.items() if n})
+                   for (table_name, key), attributes in counts.items()]
+        updates = [update for update in updates if update[2]]
+        try:
+            concurrency.map_concurrently(self._add, updates, max_concurrency=self.max_concurrency, name='dynamodb')
+        except concurrency.ConcurrentExecutionError as err:
+            with self._lock:
+                for i, error in err.errors:
+                    table_name, key, attributes = updates[i]
+                    logger.error(f'Failed to add {attributes} to {table_name} {key}: {error}')
+                    counts = self._counts.setdefault((table_name, tuple(sorted(key.items()))), {})
+                    for attribute, amount in attributes.items():
+                        counts[attribute] = counts.get(attribute, 0) + amount
+            raise
+        return len(updates)
+
+    def _add(self, update):
+        table_name, key, attributes = update
+        try:
+            (self.client or clients.client('dynamodb')).update_item(
+                TableName=table_name,
+                Key=codec.serialize_item(key),
+                UpdateExpression='ADD ' + ', '.join(f'#a{i} :a{i}' for i in range(len(attributes))),
+                ExpressionAttributeNames={f'#a{i}': attribute for i, attribute in enumerate(attributes)},
+                ExpressionAttributeValues={f':a{i}': codec.serialize(n) for i, n in enumerate(attributes.values())},
+            )
+        finally:
+            _written(table_name, key)
+
+
+MAX_BATCH_WRITE_ITEMS = 25
+
+
+def _backoff(backoff, attempt):
+    """ Seconds to wait before retry `attempt` (from 1): exponential, with full jitter. """
+    return random.uniform(0, backoff * 2 ** (attempt - 1))
+
+
+def _batch_write_chunk(client, table_name, max_attempts, backoff, write_requests):
+    """ BatchWriteItem up to 25 write requests, retrying the unprocessed ones.
+
+    Returns:
+        tuple: (BatchWriteItem calls made, write requests still unprocessed)
+    """
+    pending = write_requests
+    for attempt in range(max_attempts):
+        if attempt:
+            time.sleep(_backoff(backoff, attempt))
+        response = client.batch_write_item(RequestItems={table_name: pending})
+        pending = response.get('UnprocessedItems', {}).get(table_name, [])
+        if not pending:
+            return attempt + 1, []
+        logger.warning(f'{len(pending)} items unprocessed writing to {table_name} (attempt {attempt + 1}).')
+    return max_attempts, pending
+
+
+def batch_write(table_name, items=(), delete_keys=(), client=None, max_attempts=8, backoff=0.05,
+                max_concurrency=1, key_names=None):
+    """
+    Put `items` and delete the items with `delete_keys` in the DynamoDB `table_name` with BatchWriteItem,
+    25 at a time. Unprocessed items are retried with jittered exponential backoff.
+
+    BatchWriteItem rejects a request that writes the same item twice, so when the key attribute names are
+    known (from `key_names`, or else from `delete_keys`) writes are first deduplicated by primary key: the
+    last write of a key wins, with deletes coming after puts. Items to put only are not deduplicated
+    without `key_names`.
+
+    Args:
+        table_name (str):
+        items (iterable): dicts to put
+        delete_keys (iterable): keys (dicts) of items to delete
+        client: dynamodb client, defaults to the shared client
+        max_attempts (int): BatchWriteItem calls for a chunk before giving up on its unprocessed items
+        backoff (float): ceiling, in seconds, of the first retry's wait; doubled for each further retry
+        max_concurrency (int): chunks written at once (None for as many as the pool allows)
+        key_names (iterable): the table's primary key attribute names; by default those of delete_keys
+
+    Returns:
+        dict: {'items': write requests made, 'duplicates': writes dropped as duplicates,
+              'requests': BatchWriteItem calls, 'retries': calls that retried
+              unprocessed items, 'seconds': elapsed, 'items_per_second': ..., 'unprocessed_items': items
+              that were never written, 'unprocessed_keys': delete keys that were never processed}
+    """
+    client = client or clients.client('dynamodb')
+    items, delete_keys = list(items), list(delete_keys)
+    duplicates = 0
+    if key_names is None and delete_keys:
+        key_names = delete_keys[0]
+    if key_names is not None:
+        duplicates = len(items) + len(delete_keys)
+        key_names = sorted(key_names)
+        puts = {tuple(item[n] for n in key_names): item for item in items}
+        deletes = {tuple(key[n] for n in key_names): key for key in delete_keys}
+        items = [item for key_id, item in puts.items() if key_id not in deletes]
+        delete_keys = list(deletes.values())
+        duplicates -= len(items) + len(delete_keys)
+    write_requests = [{'PutRequest': {'Item': codec.serialize_item(item)}}
+                      for item in items]
+    write_requests.extend({'DeleteRequest': {'Key': codec.serialize_item(key)}}
+                          for key in delete_keys)
+    chunks = [write_requests[i:i + MAX_BATCH_WRITE_ITEMS]
+              for i in range(0, len(write_requests), MAX_BATCH_WRITE_ITEMS)]
+
+    start = time.monotonic()
+    try:
+        written = concurrency.map_concurrently(
+            lambda chunk: _batch_write_chunk(client, table_name, max_attempts, backoff, chunk),
+            chunks, max_concurrency=max_concurrency, name='dynamodb')
+    finally:
+        _replaced(table_name, items)
+        for key in delete_keys:
+            _written(table_name, key)
+    seconds = time.monotonic() - start
+
+    unprocessed = [r for _, pending in written for r in pending]
+    requests = sum(calls for calls, _ in written)
+    stats = {
+        'items': len(write_requests),
+        'duplicates': duplicates,
+        'requests': requests,
+        'retries': requests - len(chunks),
+        'seconds': seconds,
+        'items_per_second': (len(write_requests) - len(unprocessed)) / seconds if seconds else None,
+        'unprocessed_items': [codec.deserialize_item(r['PutRequest']['Item'])
+                              for r in unprocessed if 'PutRequest' in r],
+        'unprocessed_keys': [codec.deserialize_item(r['DeleteRequest']['Key'])
+                             for r in unprocessed if 'DeleteRequest' in r],
+    }
+    logger.info(f'Wrote {stats["items"]} items to {table_name} in {requests} requests ({stats["retries"]} retries, '
+                f'{len(unprocessed)} unprocessed).')
+    return stats
+
+
+MAX_BATCH_GET_KEYS = 100
+
+
+def _key_id(key):
+    """ A hashable id for a primary key: the value of a simple key, or a tuple of a composite key's values
+    in order of their attribute names.
+
+    >>> _key_id({'user': 'a', 'at': 5}) == _key_id({'at': 5, 'user': 'a'}) == (5, 'a')
+    True
+    """
+    values = tuple(key[name] for name in sorted(key))
+    return values[0] if len(values) == 1 else values
+
+
+def _batch_get_chunk(client, table_name, request, max_attempts, backoff, keys):
+    """ BatchGetItem up to 100 keys, retrying the unprocessed ones.
+
+    Returns:
+        tuple: (items read, keys still unprocessed)
+    """
+    items = []
+    pending = keys
+    for attempt in range(max_attempts):
+        if attempt:
+            time.sleep(_backoff(backoff, attempt))
+        response = client.batch_get_item(RequestItems={table_name: dict(request, Keys=pending)})
+        items.extend(response.get('Responses', {}).get(table_name, []))
+        pending = response.get('UnprocessedKeys', {}).get(table_name, {}).get('Keys', [])
+        if not pending:
+            break
+        logger.warning(f'{len(pending)} keys unprocessed reading {table_name} (attempt {attempt + 1}).')
+    return items, pending
+
+
+def batch_get(table_name, keys, client=None, consistent_read=False, max_attempts=8, backoff=0.05,
+              max_concurrency=None):
+    """
+    Read the items with `keys` from the DynamoDB `table_name` with BatchGetItem. Duplicate keys are read
+    once, 100 keys to a request, and the requests are made concurrently; unprocessed keys are retried
+    with jittered exponential backoff.
+
+    E.g.,
+        batch_get('users', [{'id': '1'}, {'id': '2'}]) -> {'1': {'id': '1', ...}, '2': None}
+        batch_get('events', [{'user': '1', 'at': 5}]) -> {(5, '1'): {'user': '1', 'at': 5, ...}}
+
+    Args:
+        table_name (str):
+        keys (iterable): primary keys (dicts), all with the same attribute names
+        client: dynamodb client, defaults to the shared client
+        consistent_read (bool):
+        max_attempts (int): BatchGetItem calls for a chunk before giving up on its unprocessed keys
+        backoff (float): ceiling, in seconds, of the first retry's wait; doubled for each further retry
+        max_concurrency (int): requests made at once (None for as many as the pool allows)
+
+    Returns:
+        dict: key value (for composite keys, a tuple of the values in order of their attribute names) -> item,
+              or None where there is no item, in the order of `keys`
+
+    Raises:
+        UnprocessedKeysException: if some keys were still unprocessed after max_attempts
+    """
+    client = client or clients.client('dynamodb')
+    unique = {}
+    for key in keys:
+        unique.setdefault(_key_id(key), key)
+    if not unique:
+        return {}
+
+    key_names = tuple(next(iter(unique.values())))
+    serialized = [codec.serialize_item(key) for key in unique.values()]
+    request = {'ConsistentRead': consistent_read}
+    chunks = [serialized[i:i + MAX_BATCH_GET_KEYS] for i in range(0, len(serialized), MAX_BATCH_GET_KEYS)]
+    read = concurrency.map_concurrently(
+        lambda chunk: _batch_get_chunk(client, table_name, request, max_attempts, backoff, chunk),
+        chunks, max_concurrency=max_concurrency, name='dynamodb')
+
+    unprocessed = [k for _, pending in read for k in pending]
+    if unprocessed:
+        raise UnprocessedKeysException(
+            table_name, codec.deserialize_items(unprocessed))
+
+    results = dict.fromkeys(unique)
+    for items, _ in read:
+        for item in codec.deserialize_items(items):
+            results[_key_id({name: item[name] for name in key_names})] = item
+    return results
+
+
+def _pages(operation, kwargs, start_key=None):
+    """ Yield (deserialized items, LastEvaluatedKey) for each page of a query or scan. """
+    while True:
+        response = operation(**(dict(kwargs, ExclusiveStartKey=start_key) if start_key else kwargs))
+        start_key = response.get('LastEvaluatedKey')
+        yield codec.deserialize_items(response.get('Items', [])), start_key
+        if not start_key:
+            return
+
+
+def query_iter(table_name, client=None, pages=False, resume_token=None, **kwargs):
+    """
+    Query the DynamoDB `table_name` a page at a time, yielding deserialized items, so that only one page
+    is held in memory.
+
+    E.g.,
+        for item in query_iter('events', KeyConditionExpression='#u = :u',
+                               ExpressionAttributeNames={'#u': 'user'},
+                               ExpressionAttributeValues={':u': {'S': 'a'}}):
+            ...
+
+    Args:
+        table_name (str):
+        client: dynamodb client, defaults to the shared client
+        pages (bool): yield (items, resume_token) for each page instead of items; the token continues the
+                      query after that page, and is None after the last page
+        resume_token (dict): continue a query from a token yielded with pages=True
+        kwargs: Query parameters
+
+    Returns:
+        generator
+    """
+    client = client or clients.client('dynamodb')
+    for items, last_key in _pages(client.query, dict(kwargs, TableName=table_name), resume_token):
+        if pages:
+            yield items, last_key
+        else:
+            yield from items
+
+
+def _scan_token(total_segments, remaining):
+    if not remaining:
+        return None
+    return {'TotalSegments': total_segments, 'Segments': [[segment, key] for segment, key in remaining.items()]}
+
+
+def _put(pages, stop, page):
+    """ Put a page on the (bounded) queue, unless the consumer has gone away. """
+    while not stop.is_set():
+        try:
+            pages.put(page, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _segment_pages(operation, kwargs, total_segments, segments):
+    """ Yield (segment, items, LastEvaluatedKey) for each page of each of `segments` ((segment, start key)). """
+    for segment, start_key in segments:
+        segment_kwargs = dict(kwargs, Segment=segment, TotalSegments=total_segments) if total_segments > 1 else kwargs
+        for items, last_key in _pages(operation, segment_kwargs, start_key):
+            yield segment, items, last_key
+
+
+def _scan_worker(operation, kwargs, total_segments, segments, pages, stop):
+    try:
+        for page in _segment_pages(operation, kwargs, total_segments, segments):
+            if not _put(pages, stop, page):
+                return
+        _put(pages, stop, (None, None, None))
+    except Exception as err:
+        _put(pages, stop, (None, err, None))
+
+
+def _concurrent_segment_pages(operation, kwargs, total_segments, segments, workers):
+    """ As _segment_pages, with the segments shared between `workers` threads of this scan's own. (A shared
+    pool would deadlock: a worker blocked on an unconsumed scan's queue holds its thread.) The threads are
+    daemons, and stop soon after the generator is closed. """
+    stop = threading.Event()
+    pages = queue.Queue(maxsize=2 * workers)
+    for worker in range(workers):
+        threading.Thread(target=_scan_worker, name=f'pyfaaster-dynamodb-scan-{worker}', daemon=True,
+                         args=(operation, kwargs, total_segments, segments[worker::workers], pages, stop)).start()
+
+    finished = 0
+    try:
+        while finished < workers:
+            segment, items, last_key = pages.get()
+            if segment is not None:
+                yield segment, items, last_key
+            elif isinstance(items, Exception):
+                raise items
+            else:
+                finished += 1
+    finally:
+        stop.set()
+
+
+def scan_iter(table_name, client=None, total_segments=1, max_concurrency=None, pages=False, resume_token=None,
+              **kwargs):
+    """
+    Scan the DynamoDB `table_name` a page at a time, yielding deserialized items.
+
+    With `total_segments`, the table is scanned as that many segments (a parallel scan), by up to
+    `max_concurrency` threads at once. Items come in page order within a segment, but pages of different
+    segments are interleaved. At most two pages per thread are read ahead of the consumer.
+
+    A long scan can be continued in another invocation: with pages=True, (items, resume_token) is
+    yielded for each page, and passing the last token consumed as `resume_token` continues the scan
+    after that page. Tokens are dicts, JSON serializable unless the table has binary keys.
+
+    Args:
+        table_name (str):
+        client: dynamodb client, defaults to the shared client
+        total_segments (int): segments to scan the table as
+        max_concurrency (int): segments scanned at once (None for all of them)
+        pages (bool): yield (items, resume_token) for each page instead of items; the token is None once
+                      every segment is complete
+        resume_token (dict): continue a scan from a token yielded with pages=True
+        kwargs: Scan parameters
+
+    Returns:
+        generator
+    """
+    client = client or clients.client('dynamodb')
+    kwargs = dict(kwargs, TableName=table_name)
+    if resume_token:
+        total_segments = resume_token['TotalSegments']
+        remaining = {segment: key for segment, key in resume_token['Segments']}
+    else:
+        remaining = {segment: None for segment in range(total_segments)}
+
+    segments = list(remaining.items())
+    workers = min(max_concurrency or total_segments, len(segments))
+    if workers > 1:
+        segment_pages = _concurrent_segment_pages(client.scan, kwargs, total_segments, segments, workers)
+    else:
+        segment_pages = _segment_pages(client.scan, kwargs, total_segments, segments)
+
+    with contextlib.closing(segment_pages):
+        for segment, items, last_key in segment_pages:
+            if last_key:
+                remaining[segment] = last_key
+            else:
+                remaining.pop(segment)
+            if pages:
+                yield items, _scan_token(total_segments, remaining)
+            else:
+                yield from items
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016-present, CloudZero, Inc. All rights reserved.
+# Licensed under the BSD-style license. See LICENSE file in the project root for full license information.
+
+"""
+Conversion between Python values and DynamoDB attribute values, producing exactly what boto3's
+TypeSerializer/TypeDeserializer produce, but faster.
+
+Values are converted by a table lookup on their exact type, instead of a chain of isinstance checks;
+the less common types (binary, sets, subclasses of the built in types) are handed to boto3. Items are
+deserialized with string and number attributes unpacked inline, which makes flat items (the usual case)
+about as cheap as a dict comprehension.
+
+With `floats=True`, numbers are read as int or float rather than Decimal, and floats can be written.
+Values round trip, but not always their type: DynamoDB normalizes numbers, so whole floats may come
+back as ints.
+"""
+
+from collections.abc import Mapping
+from decimal import Decimal
+
+from boto3.dynamodb.types import DYNAMODB_CONTEXT, TypeDeserializer, TypeSerializer
+
+_boto_serializer = TypeSerializer()
+_boto_deserializer = TypeDeserializer()
+
+_MAX_INT = 10 ** 38
+
+
+def _serialize_int(value, floats):
+    if -_MAX_INT < value < _MAX_INT:
+        return {'N': str(value)}
+    return _boto_serializer.serialize(value)
+
+
+def _serialize_decimal(value, floats):
+    number = str(DYNAMODB_CONTEXT.create_decimal(value))
+    if number in ['Infinity', 'NaN']:
+        raise TypeError('Infinity and NaN not supported')
+    return {'N': number}
+
+
+def _serialize_float(value, floats):
+    if not floats:
+        raise TypeError('Float types are not supported. Use Decimal types instead.')
+    if value != value or value in (float('inf'), float('-inf')):
+        raise TypeError('Infinity and NaN not supported')
+    return {'N': str(DYNAMODB_CONTEXT.create_decimal(repr(value)))}
+
+
+def _serialize_map(value, floats):
+    return {'M': {k: serialize(v, floats) for k, v in value.items()}}
+
+
+def _serialize_list(value, floats):
+    return {'L': [serialize(v, floats) for v in value]}
+
+
+_SERIALIZERS = {
+    str: lambda value, floats: {'S': value},
+    bool: lambda value, floats: {'BOOL': value},
+    type(None): lambda value, floats: {'NULL': True},
+    int: _serialize_int,
+    Decimal: _serialize_decimal,
+    float: _serialize_float,
+    dict: _serialize_map,
+    list: _serialize_list,
+    tuple: _serialize_list,
+}
+
+
+def serialize(value, floats=False):
+    """
+    Serialize a Python value to a DynamoDB attribute value, as TypeSerializer.serialize does.
+
+    E.g.,
+    >>> serialize({'name': 'Lloyd', 'age': 30, 'tags': ['a', None]})
+    {'M': {'name': {'S': 'Lloyd'}, 'age': {'N': '30'}, 'tags': {'L': [{'S': 'a'}, {'NULL': True}]}}}
+    >>> serialize(1.5, floats=True)
+    {'N': '1.5'}
+
+    Args:
+        value: a value TypeSerializer supports (or a float, with floats=True)
+        floats (bool): serialize floats too, rather than raising TypeError
+
+    Returns:
+        dict
+    """
+    serializer = _SERIALIZERS.get(type(value))
+    if serializer:
+        return serializer(value, floats)
+    if floats:
+        # boto3 would reject floats nested in these
+        if isinstance(value, (set, frozenset)) and any(isinstance(v, float) for v in value):
+            return {'NS': [serialize(v, floats)['N'] for v in value]}
+        if isinstance(value, Mapping):
+            return _serialize_map(value, floats)
+        if isinstance(value, (list, tuple)):
+            return _serialize_list(value, floats)
+    return _boto_serializer.serialize(value)
+
+
+def serialize_item(item, floats=False):
+    """ Serialize a dict of Python values to a DynamoDB item (see serialize). """
+    return {k: serialize(v, floats) for k, v in item.items()}
+
+
+def _number(value, floats):
+    if not floats:
+        return DYNAMODB_CONTEXT.create_decimal(value)
+    return int(value) if value.lstrip('-').isdigit() else float(value)
+
+
+_DESERIALIZERS = {
+    'S': lambda value, floats: value,
+    'N': _number,
+    'BOOL': lambda value, floats: value,
+    'NULL': lambda value, floats: None,
+    'M': lambda value, floats: {k: deserialize(v, floats) for k, v in value.items()},
+    'L': lambda value, floats: [deserialize(v, floats) for v in value],
+    'SS': lambda value, floats: set(value),
+    'NS': lambda value, floats: {_number(v, floats) for v in value},
+}
+
+
+def deserialize(value, floats=False):
+    """
+    Deserialize a DynamoDB attribute value, as TypeDeserializer.deserialize does.
+
+    E.g.,
+    >>> deserialize({'M': {'n': {'N': '1.50'}, 'ok': {'BOOL': True}}})
+    {'n': Decimal('1.50'), 'ok': True}
+    >>> deserialize({'L': [{'N': '3'}, {'N': '1.5'}]}, floats=True)
+    [3, 1.5]
+
+    Args:
+        value (dict): attribute value
+        floats (bool): deserialize numbers as int or float rather than Decimal
+
+    Returns:
+        the Python value
+    """
+    if len(value) == 1:
+        for dynamodb_type, v in value.items():
+            deserializer = _DESERIALIZERS.get(dynamodb_type)
+            if deserializer:
+                return deserializer(v, floats)
+    return _boto_deserializer.deserialize(value)
+
+
+def deserialize_item(item, floats=False):
+    """ Deserialize a DynamoDB item to a dict of Python values (see deserialize). """
+    result = {}
+    for k, value in item.items():
+        s = value.get('S')
+        if s is not None:
+            result[k] = s
+            continue
+        n = value.get('N')
+        if n is not None:
+            result[k] = _number(n, floats)
+        else:
+            result[k] = deserialize(value, floats)
+    return result
+
+
+def deserialize_items(items, floats=False):
+    """ Deserialize a page of DynamoDB items (see deserialize_item). """
+    return [deserialize_item(item, floats) for item in items]
+
+
+class Serializer:
+    """ A drop in replacement for boto3's TypeSerializer, backed by serialize. """
+
+    def __init__(self, floats=False):
+        self.floats = floats
+
+    def serialize(self, value):
+        return serialize(value, self.floats)
+
+
+class Deserializer:
+    """ A drop in replacement for boto3's TypeDeserializer, backed by deserialize. """
+
+    def __init__(self, floats=False):
+        self.floats = floats
+
+    def deserialize(self, value):
+        return deserialize(value, self.floats)
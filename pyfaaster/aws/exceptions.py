@@ -11,3 +11,12 @@ class HTTPResponseException(Exception):
     def __init__(self, body, statusCode=500):
         self.body = body
         self.statusCode = statusCode
+
+
+class PublishException(Exception):
+    """Exception for messages that could not be published, even after retrying. `failures` holds the
+    result (with its 'error') of each failed message."""
+
+    def __init__(self, failures):
+        super().__init__(f'Failed to publish {len(failures)} messages: {[f["error"] for f in failures]}')
+        self.failures = failures
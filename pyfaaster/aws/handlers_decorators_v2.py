@@ -8,9 +8,12 @@ import os
 import simplejson as json
 
 import pyfaaster.aws.configuration as conf
+import pyfaaster.aws.dynamodb as dynamodb
 from pyfaaster.aws.exceptions import HTTPResponseException
+import pyfaaster.aws.instrumentation as instrumentation
 import pyfaaster.aws.publish as publish
 import pyfaaster.aws.tools as tools
+import pyfaaster.common.concurrency as concurrency
 import pyfaaster.common.utils as utils
 
 logger = tools.setup_logging('pyfaaster')
@@ -29,6 +32,7 @@ def environ_aware(required=None, optional=None):
         function (func): a function that is environ aware
     """
 
+    @instrumentation.layer('environ_aware')
     def environ_handler(handler):
         def function_wrapper(*args, **kwargs):
             for r in required if required else []:
@@ -50,6 +54,7 @@ def environ_aware(required=None, optional=None):
 namespace_aware = environ_aware(['NAMESPACE'], [])
 
 
+@instrumentation.layer('domain_aware')
 def domain_aware(handler):
     """ Decorator that will check and add event.requestContext.authorizer.domain to the event kwargs.
 
@@ -81,6 +86,7 @@ def allow_origin_response(*origins):
     Returns:
         handler (func): a lambda handler function that is authorized
     """
+    @instrumentation.layer('allow_origin_response')
     def allow_origin_handler(handler):
         def handler_wrapper(event, context, **kwargs):
             logger.debug(f'Checking origin for event: {event}')
@@ -123,6 +129,7 @@ def parameters(required_querystring=None, optional_querystring=None, path=None,
     Returns:
         handler (func): a lambda handler function that is namespace aware
     """
+    @instrumentation.layer('parameters')
     def parameters_handler(handler):
         def handler_wrapper(event, context, **kwargs):
             for param in required_querystring if required_querystring else {}:
@@ -159,6 +166,7 @@ def body(required=None, optional=None, error=None):
     Returns:
         handler (func): a lambda handler function that is namespace aware
     """
+    @instrumentation.layer('body')
     def body_handler(handler):
         def handler_wrapper(event, context, **kwargs):
             try:
@@ -202,6 +210,7 @@ def scopes(*scope_list):
         logger.exception(err)
         raise TypeError('All scopes must be castable to string.')
 
+    @instrumentation.layer('scopes')
     def scopes_handler(handler):
         def handler_wrapper(event, context, **kwargs):
             token_scopes = utils.deep_get(event, 'requestContext', 'authorizer', 'scopes')
@@ -220,6 +229,7 @@ def scopes(*scope_list):
     return scopes_handler
 
 
+@instrumentation.layer('sub_aware')
 def sub_aware(handler):
     """ Decorator that will check and add event.requestContext.authorizer.sub to the event kwargs.
 
@@ -253,6 +263,7 @@ def http_response(default_error_message=None):
     Returns:
         handler (func): a lambda handler function that whose result is HTTPGateway compatible.
     """
+    @instrumentation.layer('http_response')
     def http_response_handler(handler):
         def handler_wrapper(event, context, **kwargs):
             try:
@@ -299,7 +310,10 @@ def pausable(handler):
     Returns:
         handler (func): a pausable lambda handler
     """
+    handler = instrumentation.handler_layer(handler)
+
     @environ_aware([], ['PAUSE'])
+    @instrumentation.timed('pausable')
     def handler_wrapper(event, context, **kwargs):
         if kwargs.get('PAUSE'):
             logger.warning('Function paused')
@@ -308,6 +322,7 @@ def pausable(handler):
     return handler_wrapper
 
 
+@instrumentation.layer('pingable')
 def pingable(handler):
     """ Decorator that will short circuit and return immediately before calling
     the decorated handler if the event is a "ping" event.
@@ -346,10 +361,12 @@ def publisher(handler):
     Returns:
         handler (func): a publishing lambda handler
     """
+    handler = instrumentation.handler_layer(handler)
 
     @account_id_aware
     @namespace_aware
     @region_aware
+    @instrumentation.timed('publisher')
     def handler_wrapper(event, context, **kwargs):
         result = handler(event, context, **kwargs)
         conn = publish.conn(kwargs['region'], kwargs['account_id'], kwargs['NAMESPACE'])
@@ -360,10 +377,12 @@ def publisher(handler):
 
 
 def event_publisher(handler):
-    """ Decorator that will publish events to SNS Topics (and eventually EventBridge).
+    """ Decorator that will publish events to SNS Topics or EventBridge event buses.
     This decorator looks for a 'events' key in the result of the wrapper decorator.
     It expects result['events'] to be a dict where key is target (i.e. Topic Name or EventBus)
     or ARN and value is an array messages to be sent. It will publish each event to its respective target.
+    Targets that are event bus ARNs (arn:aws:events:...), or names listed in the optional, comma separated
+    EVENT_BUS_TARGETS environment variable, are sent to EventBridge with PutEvents; all others to SNS.
 
     Each must adhere to the followign schema:
     {
@@ -402,69 +421,195 @@ def event_publisher(handler):
     Returns:
         handler (func): a publishing lambda handler
     """
+    handler = instrumentation.handler_layer(handler)
 
     @account_id_aware
     @namespace_aware
     @region_aware
+    @instrumentation.timed('event_publisher')
     def handler_wrapper(event, context, **kwargs):
         result = handler(event, context, **kwargs)
-        # TODO: Add code to check configuration and send via SNS or EventBridge accordingly
-        conn = publish.conn(kwargs['region'], kwargs['account_id'], kwargs['NAMESPACE'])
+        conn = publish.conn(kwargs['region'], kwargs['account_id'], kwargs['NAMESPACE'],
+                            backends=publish.event_bus_backends(os.environ.get('EVENT_BUS_TARGETS')))
         publish.publish_events(conn, result.get('events', {}))
         return result
 
     return handler_wrapper
 
 
-def subscriber(required_topics=None):
+def _sns_message(record, required_topics=None):
+    try:
+        sns = record['Sns']
+    except Exception:
+        raise Exception('Unsupported event format.')
+    if required_topics and not any((topic_name in sns['TopicArn'] for topic_name in required_topics)):
+        raise Exception('Message received not from expected topic.')
+    try:
+        return json.loads(sns.get('Message'))
+    except Exception as err:
+        raise Exception(f'Could not decode message. ({err})')
+
+
+def _failed_record(index, record, err):
+    return {'index': index, 'MessageId': utils.deep_get(record, 'Sns', 'MessageId'), 'error': str(err)}
+
+
+def subscriber(required_topics=None, batch=None, max_concurrency=None):
     """ Decorator that will grab messages from sns location in event body.
 
+    By default only the first record is read and its message is passed to the handler as `message`.
+    To process every record in the event, choose a batch mode:
+
+        batch='list': the handler is called once with all decoded messages as `messages`, and the
+                      decorator returns {'result': handler result, 'failed_records': [...]}
+        batch='each': the handler is called once per decoded message (as `message`); a record whose
+                      handler call raises does not affect the others. The decorator returns
+                      {'results': [handler result or None, ...], 'failed_records': [...]}
+
+    Records that cannot be decoded (or are not from a required topic) are left out and reported in
+    failed_records as {'index': int, 'MessageId': str, 'error': str}, as are failed handler calls.
+
     Args:
         required_topics (iterable): Handler must be triggered by one of these Topics
+        batch (str): None, 'list' or 'each'
+        max_concurrency (int): in batch modes, decode records (and, for 'each', call the handler) on up to
+                               this many threads; by default records are processed in turn
 
     Returns:
         handler (func): a lambda handler function that is namespace aware
     """
+    if batch not in (None, 'list', 'each'):
+        raise ValueError(f'Unsupported batch mode {batch}.')
+
+    @instrumentation.layer('subscriber')
     def subscriber_handler(handler):
         def handler_wrapper(event, context, **kwargs):
             try:
-                sns = event['Records'][0]['Sns']
+                records = event['Records'] if batch else [event['Records'][0]]
             except Exception:
                 raise Exception('Unsupported event format.')
-            if required_topics and not any((topic_name in sns['TopicArn'] for topic_name in required_topics)):
-                raise Exception('Message received not from expected topic.')
-            try:
-                message_body = json.loads(sns.get('Message'))
-            except Exception as err:
-                raise Exception(f'Could not decode message. ({err})')
 
-            kwargs['message'] = message_body
+            if not batch:
+                kwargs['message'] = _sns_message(records[0], required_topics)
+                return handler(event, context, **kwargs)
 
-            return handler(event, context, **kwargs)
+            if batch == 'list':
+                decoded = concurrency.map_concurrently(functools.partial(_sns_message, required_topics=required_topics),
+                                                       records, max_concurrency=max_concurrency or 1,
+                                                       name='subscriber', return_exceptions=True)
+                failed_records = [_failed_record(i, records[i], d) for i, d in enumerate(decoded)
+                                  if isinstance(d, Exception)]
+                messages = [d for d in decoded if not isinstance(d, Exception)]
+                return {'result': handler(event, context, messages=messages, **kwargs),
+                        'failed_records': failed_records}
+
+            def handle_record(record):
+                return handler(event, context, message=_sns_message(record, required_topics), **kwargs)
+
+            results = concurrency.map_concurrently(handle_record, records, max_concurrency=max_concurrency or 1,
+                                                   name='subscriber', return_exceptions=True)
+            failed_records = []
+            for i, result in enumerate(results):
+                if isinstance(result, Exception):
+                    logger.error(f'Failed to process record {i}: {result}')
+                    failed_records.append(_failed_record(i, records[i], result))
+                    results[i] = None
+            return {'results': results, 'failed_records': failed_records}
 
         return handler_wrapper
 
     return subscriber_handler
 
 
-def configuration_aware(config_file, create=False):
+def _sqs_message(record):
+    try:
+        body = json.loads(record['body'])
+    except Exception as err:
+        raise Exception(f'Could not decode message. ({err})')
+    if isinstance(body, dict) and body.get('Type') == 'Notification' and 'Message' in body:
+        # delivered through an SNS subscription
+        try:
+            return json.loads(body['Message'])
+        except Exception as err:
+            raise Exception(f'Could not decode SNS message. ({err})')
+    return body
+
+
+def sqs_consumer(max_concurrency=None):
+    """ Decorator that calls the handler once per message of an SQS event (as `message`), and reports
+    the messages whose handler call failed as partial batch failures, so that only those are redelivered.
+    Message bodies are json decoded; bodies that are SNS notifications are unwrapped to the SNS message.
+
+    The decorated function returns {'batchItemFailures': [{'itemIdentifier': messageId}, ...]}, which
+    requires ReportBatchItemFailures on the event source mapping.
+
+    For FIFO queues, records are processed in turn and, once a record fails, every later record is
+    reported as failed too, so that message order is kept on redelivery.
+
+    Args:
+        max_concurrency (int): process up to this many messages at once (standard queues only); by
+                               default messages are processed in turn
+
+    Returns:
+        handler (func): a lambda handler function that consumes SQS batches
+    """
+    @instrumentation.layer('sqs_consumer')
+    def sqs_consumer_handler(handler):
+        def handle_record(event, context, kwargs, record):
+            return handler(event, context, message=_sqs_message(record), **kwargs)
+
+        def handler_wrapper(event, context, **kwargs):
+            try:
+                records = event['Records']
+                fifo = any(r['eventSourceARN'].endswith('.fifo') for r in records)
+            except Exception:
+                raise Exception('Unsupported event format.')
+
+            failed = []
+            if fifo:
+                for i, record in enumerate(records):
+                    try:
+                        handle_record(event, context, kwargs, record)
+                    except Exception as err:
+                        logger.error(f'Failed to process message {record.get("messageId")}: {err}')
+                        failed = records[i:]
+                        break
+            else:
+                results = concurrency.map_concurrently(functools.partial(handle_record, event, context, kwargs),
+                                                       records, max_concurrency=max_concurrency or 1,
+                                                       name='sqs_consumer', return_exceptions=True)
+                for record, result in zip(records, results):
+                    if isinstance(result, Exception):
+                        logger.error(f'Failed to process message {record.get("messageId")}: {result}')
+                        failed.append(record)
+
+            return {'batchItemFailures': [{'itemIdentifier': r['messageId']} for r in failed]}
+
+        return handler_wrapper
+
+    return sqs_consumer_handler
+
+
+def configuration_aware(config_file, create=False, ttl=None):
     """ Decorator that expects a configuration file in an S3 Bucket specified by the 'CONFIG'
     environment variable and S3 Bucket Key (path) specified by config_file. If create=True, this
     decorator will create an empty configuration file instead of erring.
 
-    NOTE: Decorating a lambda with this incurs a performance penalty - S3 is checked on every call.
-          This makes sense when writing a lambda function that updates config and is called infrequently,
-          but makes far less sense if all one needs to do is read config data.
-    TODO: We need a more clear, refined pattern for dealing with uncached writes and cached reads.
-          The way the current config features are written, it's not clear how best to use them.
+    NOTE: By default, decorating a lambda with this incurs a performance penalty - S3 is checked on every call.
+          This makes sense when writing a lambda function that updates config and is called infrequently.
+          Pass a `ttl` (seconds) to keep the parsed configuration in the warm container instead: it is
+          only revalidated (a conditional GET, i.e. a 304 when unchanged) once `ttl` has passed, and
+          configuration['save'] updates the cached copy. See configuration.load_revalidated.
 
     Args:
         config_file (str): key in the 'CONFIG' S3 bucket of expected configuration file
         create (Bool): optionally create configuration file if absent
+        ttl (int): optionally cache configuration for this many seconds between revalidations
 
     Returns:
         handler (func): a configuration aware lambda handler
     """
+    @instrumentation.layer('configuration_aware')
     def configuration_handler(handler):
         def handler_wrapper(event, context, **kwargs):
             config_bucket = os.environ['CONFIG']
@@ -472,8 +617,12 @@ def configuration_aware(config_file, create=False):
 
             conn = conf.conn(encrypt_key_arn)
             try:
-                settings = conf.load_or_create(conn, config_bucket, config_file) if create else conf.load(
-                    conn, config_bucket, config_file)
+                if ttl is None:
+                    settings = conf.load_or_create(conn, config_bucket, config_file) if create else conf.load(
+                        conn, config_bucket, config_file)
+                else:
+                    settings = conf.load_or_create_revalidated(conn, config_bucket, config_file, ttl) if create \
+                        else conf.load_revalidated(conn, config_bucket, config_file, ttl)
             except Exception as err:
                 logger.exception(err)
                 logger.error('Failed to load or create configuration.')
@@ -481,7 +630,8 @@ def configuration_aware(config_file, create=False):
 
             configuration = {
                 'load': lambda: settings or {},
-                'save': functools.partial(conf.save, conn, config_bucket, config_file),
+                'save': functools.partial(conf.save, conn, config_bucket, config_file) if ttl is None
+                else functools.partial(conf.save_revalidated, conn, config_bucket, config_file, ttl=ttl),
             }
             return handler(event, context, configuration=configuration, **kwargs)
 
@@ -490,6 +640,58 @@ def configuration_aware(config_file, create=False):
     return configuration_handler
 
 
+def counters_aware(max_keys=1000, max_concurrency=None):
+    """ Decorator that will add a dynamodb.CounterBuffer to kwargs['counters'] and flush it when the handler
+    returns. If the handler raises, the increments buffered since the last flush are dropped rather than
+    written, so that a retried invocation does not count them twice.
+
+    Args:
+        max_keys (int): flush when this many items have buffered increments
+        max_concurrency (int): updates made at once
+
+    Returns:
+        function (func): a function that is counters aware
+    """
+
+    @instrumentation.layer('counters_aware')
+    def counters_handler(handler):
+        def handler_wrapper(event, context, **kwargs):
+            counters = dynamodb.CounterBuffer(max_keys=max_keys, max_concurrency=max_concurrency)
+            kwargs['counters'] = counters
+            result = handler(event, context, **kwargs)
+            counters.flush()
+            return result
+
+        return handler_wrapper
+
+    return counters_handler
+
+
+def item_cache_aware(cache=None, **options):
+    """ Decorator that will add a dynamodb.ItemCache to kwargs['item_cache']. The cache is kept across
+    invocations of the handler; pass one to share it between handlers.
+
+    Args:
+        cache (dynamodb.ItemCache): the cache to add, by default one created with `options`
+        options: dynamodb.ItemCache arguments (maxsize, ttl, table_ttls, negative_ttl)
+
+    Returns:
+        function (func): a function that is item cache aware
+    """
+    cache = cache or dynamodb.ItemCache(**options)
+
+    @instrumentation.layer('item_cache_aware')
+    def item_cache_handler(handler):
+        def handler_wrapper(event, context, **kwargs):
+            kwargs['item_cache'] = cache
+            return handler(event, context, **kwargs)
+
+        return handler_wrapper
+
+    return item_cache_handler
+
+
+@instrumentation.layer('client_config_aware')
 def client_config_aware(handler):
     """ Decorator that will find the Source IP and Client in the event headers.
 
@@ -508,6 +710,7 @@ def client_config_aware(handler):
     return handler_wrapper
 
 
+@instrumentation.layer('region_aware')
 def region_aware(handler):
     """ Decorator that will find the Account Region in the lambda context.
 
@@ -524,6 +727,7 @@ def region_aware(handler):
     return handler_wrapper
 
 
+@instrumentation.layer('account_id_aware')
 def account_id_aware(handler):
     """ Decorator that will find the Account ID in the lambda context.
 
@@ -540,6 +744,7 @@ def account_id_aware(handler):
     return handler_wrapper
 
 
+@instrumentation.layer('catch_exceptions')
 def catch_exceptions(handler):
     """ Decorator that will catch all exceptions. Normally bad practice in pure Python programming, but when running
     Python in AWS Lambda, by preventing a Python Lambda from throwing an exception you can prevent a cold start
@@ -559,11 +764,15 @@ def catch_exceptions(handler):
     return handler_wrapper
 
 
-def default(default_error_message=None):
+def default(default_error_message=None, config_ttl=None):
     """
     AWS lambda handler handler. A wrapper with standard boilerplate implementing the
     best practices we've developed
 
+    Args:
+        default_error_message (string): Default message to send if none was provided
+        config_ttl (int): optionally cache configuration.json, see configuration_aware
+
     Returns:
         The wrapped lambda function or JSON response function when an error occurs.  When called,
         this wrapped function will return the appropriate output
@@ -574,7 +783,7 @@ def default(default_error_message=None):
         @http_response(default_error_message)
         @account_id_aware
         @client_config_aware
-        @configuration_aware('configuration.json', create=True)
+        @configuration_aware('configuration.json', create=True, ttl=config_ttl)
         @environ_aware(['NAMESPACE', 'CONFIG'], ['ENCRYPT_KEY_ARN'])
         @pingable
         def handler_wrapper(event, context, **kwargs):
@@ -0,0 +1,546 @@
+# Copyright (c) 2016-present, CloudZero, Inc. All rights reserved.
+# Licensed under the BSD-style license. See LICENSE file in the project root for full license information.
+
+"""
+A flat alternative to stacking the decorators in `pyfaaster.aws.handlers_decorators_v2`.
+
+Each decorator in handlers_decorators_v2 adds a Python frame and rebuilds **kwargs at every layer.
+A pipeline compiles the same middleware, declared as a list of steps (outermost first, the same order
+you would stack the decorators), into a single wrapper that shares one kwargs dict and walks the steps
+in a loop. For example, these two handlers behave identically:
+
+    @decs.http_response()
+    @decs.account_id_aware
+    @decs.pingable
+    def handler(event, context, **kwargs):
+        ...
+
+    def handler(event, context, **kwargs):
+        ...
+    handler = pipeline(handler, [http_response(), account_id_aware, pingable])
+
+A step has up to three hooks, all of which receive the shared kwargs dict:
+
+    before(event, context, kwargs) -> None to continue, any other value short circuits as the response
+    after(event, context, kwargs, response) -> response
+    on_error(event, context, kwargs, error) -> response (or raise)
+
+`on_error` sees anything raised by inner steps, the handler and the step's own `after`, exactly like a
+try/except wrapped around the call to the inner handler in the equivalent decorator. A step created with
+`named=True` gets the handler's name as the first argument of each of its hooks.
+"""
+
+import collections
+import functools
+import os
+import re
+
+import simplejson as json
+
+import pyfaaster.aws.configuration as conf
+import pyfaaster.aws.dynamodb as dynamodb
+from pyfaaster.aws.exceptions import HTTPResponseException
+import pyfaaster.aws.publish as publish
+import pyfaaster.aws.tools as tools
+import pyfaaster.common.utils as utils
+
+logger = tools.setup_logging('pyfaaster')
+
+
+Step = collections.namedtuple('Step', ['name', 'before', 'after', 'on_error', 'named'],
+                              defaults=(None, None, None, False))
+
+
+def _named(step, handler_name):
+    """ `step` with the handler's name bound to its hooks. """
+    hooks = {hook: functools.partial(getattr(step, hook), handler_name)
+             for hook in ('before', 'after', 'on_error') if getattr(step, hook) is not None}
+    return step._replace(named=False, **hooks)
+
+
+def pipeline(handler, steps):
+    """ Compile `steps` around `handler` into a single lambda handler.
+
+    Args:
+        handler (func): a handler function with the signature (event, context, **kwargs) -> result
+        steps (iterable): Steps, outermost first (i.e. in the order the equivalent decorators would be stacked)
+
+    Returns:
+        handler (func): a lambda handler function with all steps applied
+    """
+    steps = tuple(_named(step, handler.__name__) if step.named else step for step in steps)
+    # (index, before) of the steps with a before hook
+    befores = tuple((i, step.before) for i, step in enumerate(steps) if step.before is not None)
+    # for each count of steps entered, the (after, on_error) hooks to unwind, innermost first
+    unwinds = tuple(tuple((step.after, step.on_error) for step in reversed(steps[:entered])
+                          if step.after is not None or step.on_error is not None)
+                    for entered in range(len(steps) + 1))
+    all_entered = len(steps)
+
+    @functools.wraps(handler)
+    def pipeline_wrapper(event, context, **kwargs):
+        response = error = None
+        entered = all_entered
+        try:
+            for entered, before in befores:
+                response = before(event, context, kwargs)
+                if response is not None:
+                    break
+            else:
+                entered = all_entered
+                response = handler(event, context, **kwargs)
+        except Exception as err:
+            error = err
+
+        for after, on_error in unwinds[entered]:
+            if error is None and after is not None:
+                try:
+                    response = after(event, context, kwargs, response)
+                except Exception as err:
+                    error = err
+            if error is not None and on_error is not None:
+                try:
+                    response = on_error(event, context, kwargs, error)
+                    error = None
+                except Exception as err:
+                    error = err
+
+        if error is not None:
+            raise error
+        return response
+
+    return pipeline_wrapper
+
+
+def _environ_before(required, optional, event, context, kwargs):
+    for r in required:
+        value = os.environ.get(r)
+        if not value:
+            raise HTTPResponseException(f'{r} environment variable missing.')
+        kwargs[r] = value
+
+    for o in optional:
+        kwargs[o] = os.environ.get(o)
+
+
+def environ_aware(required=None, optional=None):
+    """ Step equivalent of handlers_decorators_v2.environ_aware.
+
+    Args:
+        required (iterable): required environment vars
+        optional (iterable): optional environment vars
+
+    Returns:
+        Step
+    """
+    return Step('environ_aware',
+                before=functools.partial(_environ_before, tuple(required or ()), tuple(optional or ())))
+
+
+namespace_aware = environ_aware(['NAMESPACE'], [])
+
+
+def _domain_before(event, context, kwargs):
+    domain = utils.deep_get(event, 'requestContext', 'authorizer', 'domain')
+    if not domain:
+        logger.error('Domain requestContext variable missing.')
+        raise HTTPResponseException('Invalid domain.')
+    kwargs['domain'] = domain
+
+
+domain_aware = Step('domain_aware', before=_domain_before)
+
+
+def _allow_origin_before(origins, event, context, kwargs):
+    logger.debug(f'Checking origin for event: {event}')
+
+    request_origin = utils.deep_get(event, 'headers', 'origin', ignore_case=True)
+    if not any(re.match(o, str(request_origin)) for o in origins):
+        logger.warning(f'Invalid request origin: {request_origin}')
+        raise HTTPResponseException('Unknown origin.', statusCode=403)
+    kwargs['request_origin'] = request_origin
+
+
+def _allow_origin_after(event, context, kwargs, response):
+    if not isinstance(response, dict):
+        raise Exception(
+            f'Unsupported response type {type(response)}; response must be dict for *_response decorators.')
+
+    current_headers = response.get('headers', {})
+    cors_headers = {'Access-Control-Allow-Origin': kwargs['request_origin'],
+                    'Access-Control-Allow-Credentials': 'true'}
+    response['headers'] = {**current_headers, **cors_headers}
+    return response
+
+
+def allow_origin_response(*origins):
+    """ Step equivalent of handlers_decorators_v2.allow_origin_response.
+
+    Args:
+        origins (*args): regular expressions of allowed origins
+
+    Returns:
+        Step
+    """
+    return Step('allow_origin_response',
+                before=functools.partial(_allow_origin_before, origins),
+                after=_allow_origin_after)
+
+
+def _parameters_before(required_querystring, optional_querystring, path, error, event, context, kwargs):
+    for param in required_querystring:
+        value = utils.deep_get(event, 'queryStringParameters', param)
+        if not value:
+            logger.error(f'queryStringParameter [{param}] missing from event [{event}].')
+            raise HTTPResponseException(error or f'Invalid {param}.', statusCode=400)
+        kwargs[param] = value
+    for param in optional_querystring:
+        value = utils.deep_get(event, 'queryStringParameters', param)
+        if value:
+            kwargs[param] = value
+    for param in path:
+        value = utils.deep_get(event, 'pathParameters', param)
+        if not value:
+            logger.error(f'pathParameter [{param}] missing from event [{event}].')
+            raise HTTPResponseException(error or f'Invalid {param}.', statusCode=400)
+        kwargs[param] = value
+
+
+def parameters(required_querystring=None, optional_querystring=None, path=None, error=None):
+    """ Step equivalent of handlers_decorators_v2.parameters.
+
+    Args:
+        required_querystring (iterable): Required queryStringParameters
+        optional_querystring (iterable): Optional queryStringParameters
+        path (iterable): pathParameters (these are always required)
+
+    Returns:
+        Step
+    """
+    return Step('parameters',
+                before=functools.partial(_parameters_before,
+                                         tuple(required_querystring or ()),
+                                         tuple(optional_querystring or ()),
+                                         tuple(path or ()),
+                                         error))
+
+
+def _body_before(required, optional, error, event, context, kwargs):
+    try:
+        event_body = json.loads(event.get('body'))
+    except json.JSONDecodeError:
+        raise HTTPResponseException(error or 'Invalid event.body: cannot decode json.', statusCode=400)
+
+    body_required = {k: event_body.get(k) for k in required}
+    if not all((v is not None for v in body_required.values())):
+        logger.error(f'There is a required key in [{required}] missing from event.body [{event_body}].')
+        raise HTTPResponseException(error or 'Invalid event.body: missing required key.', statusCode=400)
+
+    body_optional = {k: event_body.get(k) for k in optional}
+
+    handler_body = {}
+    handler_body.update(**body_required, **body_optional)
+    kwargs['body'] = handler_body
+
+
+def body(required=None, optional=None, error=None):
+    """ Step equivalent of handlers_decorators_v2.body.
+
+    Args:
+        required (iterable): Required body keys
+        optional (iterable): Optional body keys
+
+    Returns:
+        Step
+    """
+    return Step('body', before=functools.partial(_body_before, tuple(required or ()), tuple(optional or ()), error))
+
+
+def _scopes_before(scope_list, string_scope_list, event, context, kwargs):
+    token_scopes = utils.deep_get(event, 'requestContext', 'authorizer', 'scopes')
+
+    if not token_scopes:
+        raise HTTPResponseException('Invalid token scopes: missing!')
+
+    if not all((s in token_scopes for s in string_scope_list)):
+        logger.warning(f'There is a required scope [{scope_list}] missing from token scopes [{token_scopes}].')
+        raise HTTPResponseException('access_token has insufficient access.', statusCode=403)
+
+
+def scopes(*scope_list):
+    """ Step equivalent of handlers_decorators_v2.scopes.
+
+    Args:
+        scope_list (List): List of required access_token scopes. Each item must be castable to string.
+
+    Returns:
+        Step
+    """
+    try:
+        string_scope_list = [str(s) for s in scope_list]
+    except Exception as err:
+        logger.exception(err)
+        raise TypeError('All scopes must be castable to string.')
+
+    return Step('scopes', before=functools.partial(_scopes_before, scope_list, string_scope_list))
+
+
+def _sub_before(event, context, kwargs):
+    sub = utils.deep_get(event, 'requestContext', 'authorizer', 'sub')
+    if not sub:
+        logger.error('Sub requestContext variable missing.')
+        raise HTTPResponseException('Invalid sub.')
+    kwargs['sub'] = sub
+
+
+sub_aware = Step('sub_aware', before=_sub_before)
+
+
+def _http_response_after(event, context, kwargs, res):
+    if not isinstance(res, dict):
+        raise Exception(f'Unsupported return type {type(res)}; response must be dict.')
+    return {
+        'headers': res.get('headers', {}),
+        'statusCode': res.get('statusCode', 200),
+        'body': json.dumps(res['body'], iterable_as_array=True) if 'body' in res else None,
+    }
+
+
+def _http_response_error(default_error_message, event, context, kwargs, err):
+    logger.exception(err)
+    # HTTPResponseException and HTTPResponseException like objects
+    if isinstance(err, HTTPResponseException) or (hasattr(err, 'statusCode') and hasattr(err, 'body')):
+        return {
+            'statusCode': err.statusCode,
+            'body': json.dumps(err.body, iterable_as_array=True),
+        }
+    lambda_function_name = context.function_name.split('.')[-1].replace('_', ' ')
+    return {
+        'statusCode': 500,
+        'body': default_error_message or f'Failed to {lambda_function_name}.',
+    }
+
+
+def http_response(default_error_message=None):
+    """ Step equivalent of handlers_decorators_v2.http_response.
+
+    Args:
+        default_error_message (string): Default message to send if none was provided
+
+    Returns:
+        Step
+    """
+    return Step('http_response',
+                after=_http_response_after,
+                on_error=functools.partial(_http_response_error, default_error_message))
+
+
+def _pausable_before(event, context, kwargs):
+    kwargs['PAUSE'] = os.environ.get('PAUSE')
+    if kwargs['PAUSE']:
+        logger.warning('Function paused')
+        raise HTTPResponseException('info: paused', statusCode=503)
+
+
+pausable = Step('pausable', before=_pausable_before)
+
+
+def _pingable_before(event, context, kwargs):
+    if event.get('detail-type') == 'Scheduled Event' and event.get('source') == 'aws.events':
+        logger.debug('Ping received, keeping function alive')
+        return 'info: ping'
+
+
+pingable = Step('pingable', before=_pingable_before)
+
+
+def _publisher_before(event, context, kwargs):
+    kwargs['account_id'] = tools.get_account_id(context)
+    _environ_before(('NAMESPACE',), (), event, context, kwargs)
+    kwargs['region'] = tools.get_region(context)
+
+
+def _publisher_after(event, context, kwargs, result):
+    conn = publish.conn(kwargs['region'], kwargs['account_id'], kwargs['NAMESPACE'])
+    publish.publish(conn, result.get('messages', {}))
+    return result
+
+
+def _event_publisher_after(event, context, kwargs, result):
+    conn = publish.conn(kwargs['region'], kwargs['account_id'], kwargs['NAMESPACE'],
+                        backends=publish.event_bus_backends(os.environ.get('EVENT_BUS_TARGETS')))
+    publish.publish_events(conn, result.get('events', {}))
+    return result
+
+
+publisher = Step('publisher', before=_publisher_before, after=_publisher_after)
+event_publisher = Step('event_publisher', before=_publisher_before, after=_event_publisher_after)
+
+
+def _subscriber_before(required_topics, event, context, kwargs):
+    try:
+        sns = event['Records'][0]['Sns']
+    except Exception:
+        raise Exception('Unsupported event format.')
+    if required_topics and not any((topic_name in sns['TopicArn'] for topic_name in required_topics)):
+        raise Exception('Message received not from expected topic.')
+    try:
+        message_body = json.loads(sns.get('Message'))
+    except Exception as err:
+        raise Exception(f'Could not decode message. ({err})')
+
+    kwargs['message'] = message_body
+
+
+def subscriber(required_topics=None):
+    """ Step equivalent of handlers_decorators_v2.subscriber.
+
+    Args:
+        required_topics (iterable): Handler must be triggered by one of these Topics
+
+    Returns:
+        Step
+    """
+    return Step('subscriber', before=functools.partial(_subscriber_before, required_topics))
+
+
+def _configuration_before(config_file, create, ttl, event, context, kwargs):
+    config_bucket = os.environ['CONFIG']
+    encrypt_key_arn = os.environ.get('ENCRYPT_KEY_ARN')
+
+    conn = conf.conn(encrypt_key_arn)
+    try:
+        if ttl is None:
+            settings = conf.load_or_create(conn, config_bucket, config_file) if create else conf.load(
+                conn, config_bucket, config_file)
+        else:
+            settings = conf.load_or_create_revalidated(conn, config_bucket, config_file, ttl) if create \
+                else conf.load_revalidated(conn, config_bucket, config_file, ttl)
+    except Exception as err:
+        logger.exception(err)
+        logger.error('Failed to load or create configuration.')
+        raise HTTPResponseException('Failed to load configuration.', statusCode=503)
+
+    kwargs['configuration'] = {
+        'load': lambda: settings or {},
+        'save': functools.partial(conf.save, conn, config_bucket, config_file) if ttl is None
+        else functools.partial(conf.save_revalidated, conn, config_bucket, config_file, ttl=ttl),
+    }
+
+
+def configuration_aware(config_file, create=False, ttl=None):
+    """ Step equivalent of handlers_decorators_v2.configuration_aware.
+
+    Args:
+        config_file (str): key in the 'CONFIG' S3 bucket of expected configuration file
+        create (Bool): optionally create configuration file if absent
+        ttl (int): optionally cache configuration for this many seconds between revalidations
+
+    Returns:
+        Step
+    """
+    return Step('configuration_aware', before=functools.partial(_configuration_before, config_file, create, ttl))
+
+
+def _counters_before(max_keys, max_concurrency, event, context, kwargs):
+    kwargs['counters'] = dynamodb.CounterBuffer(max_keys=max_keys, max_concurrency=max_concurrency)
+
+
+def _counters_after(event, context, kwargs, result):
+    kwargs['counters'].flush()
+    return result
+
+
+def counters_aware(max_keys=1000, max_concurrency=None):
+    """ Step equivalent of handlers_decorators_v2.counters_aware.
+
+    Args:
+        max_keys (int): flush when this many items have buffered increments
+        max_concurrency (int): updates made at once
+
+    Returns:
+        Step
+    """
+    return Step('counters_aware', before=functools.partial(_counters_before, max_keys, max_concurrency),
+                after=_counters_after)
+
+
+def _item_cache_before(cache, event, context, kwargs):
+    kwargs['item_cache'] = cache
+
+
+def item_cache_aware(cache=None, **options):
+    """ Step equivalent of handlers_decorators_v2.item_cache_aware.
+
+    Args:
+        cache (dynamodb.ItemCache): the cache to add, by default one created with `options`
+        options: dynamodb.ItemCache arguments (maxsize, ttl, table_ttls, negative_ttl)
+
+    Returns:
+        Step
+    """
+    return Step('item_cache_aware', before=functools.partial(_item_cache_before, cache or dynamodb.ItemCache(**options)))
+
+
+def _client_config_before(handler_name, event, context, kwargs):
+    client_details = tools.get_client_details(event)
+    # formatted lazily, unlike the decorator, so that disabled levels cost nothing
+    logger.info('%s | %s', handler_name, client_details)
+    logger.debug('aws_lambda_wrapper| %s', event)
+    kwargs['client_details'] = client_details
+
+
+client_config_aware = Step('client_config_aware', before=_client_config_before, named=True)
+
+
+def _region_before(event, context, kwargs):
+    kwargs['region'] = tools.get_region(context)
+
+
+region_aware = Step('region_aware', before=_region_before)
+
+
+def _account_id_before(event, context, kwargs):
+    kwargs['account_id'] = tools.get_account_id(context)
+
+
+account_id_aware = Step('account_id_aware', before=_account_id_before)
+
+
+def _catch_exceptions_error(event, context, kwargs, e):
+    logger.exception(f'Exception caught by catch_exceptions decorator: {e}')
+
+
+catch_exceptions = Step('catch_exceptions', on_error=_catch_exceptions_error)
+
+
+def _could_not_complete_error(handler_name, event, context, kwargs, err):
+    logger.error('Lambda Event : {}'.format(event))
+    logger.exception('{}:{}'.format(type(err), err))
+    raise HTTPResponseException(f'Could not complete {handler_name}')
+
+
+def default(default_error_message=None, config_ttl=None):
+    """ Pipeline equivalent of handlers_decorators_v2.default.
+
+    Args:
+        default_error_message (string): Default message to send if none was provided
+        config_ttl (int): optionally cache configuration.json, see configuration_aware
+
+    Returns:
+        The wrapped lambda function or JSON response function when an error occurs.  When called,
+        this wrapped function will return the appropriate output
+    """
+
+    def default_handler(handler):
+        return pipeline(handler, [
+            http_response(default_error_message),
+            account_id_aware,
+            client_config_aware,
+            configuration_aware('configuration.json', create=True, ttl=config_ttl),
+            environ_aware(['NAMESPACE', 'CONFIG'], ['ENCRYPT_KEY_ARN']),
+            pingable,
+            Step('default', on_error=functools.partial(_could_not_complete_error, handler.__name__)),
+        ])
+
+    return default_handler
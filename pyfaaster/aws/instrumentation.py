@@ -0,0 +1,188 @@
+# Copyright (c) 2016-present, CloudZero, Inc. All rights reserved.
+# Licensed under the BSD-style license. See LICENSE file in the project root for full license information.
+
+"""
+Opt-in, per-layer timing of the decorators in `pyfaaster.aws.handlers_decorators_v2`.
+
+Instrumentation is decided when a decorator is applied to a handler, so it has to be enabled (either
+via the environment or `enable()`) before your handlers are decorated, i.e. before your handler module
+is imported. Handlers decorated while instrumentation is off are returned untouched and pay nothing.
+
+    PYFAASTER_INSTRUMENT=1              record wall time per layer
+    PYFAASTER_INSTRUMENT_ALLOCATIONS=1  also record net allocated bytes per layer (uses tracemalloc)
+    PYFAASTER_INSTRUMENT_LOG=1          emit each invocation's records as one structured log line
+
+Each invocation produces a list of records, outermost layer first, e.g.
+
+    [{'layer': 'http_response', 'depth': 0, 'duration_ms': 12.1, 'self_ms': 0.4},
+     {'layer': 'configuration_aware', 'depth': 1, 'duration_ms': 11.7, 'self_ms': 11.2},
+     {'layer': 'handler', 'depth': 2, 'duration_ms': 0.5, 'self_ms': 0.5}]
+
+which is handed to every function registered with `add_hook`.
+"""
+
+import functools
+import os
+import threading
+import time
+import tracemalloc
+
+import simplejson as json
+
+import pyfaaster.aws.tools as tools
+
+logger = tools.setup_logging('pyfaaster')
+
+_settings = {
+    'enabled': bool(os.environ.get('PYFAASTER_INSTRUMENT')),
+    'allocations': bool(os.environ.get('PYFAASTER_INSTRUMENT_ALLOCATIONS')),
+    'log': bool(os.environ.get('PYFAASTER_INSTRUMENT_LOG')),
+    'started_tracemalloc': False,
+}
+_hooks = []
+_local = threading.local()
+
+
+def enable(allocations=False, log=False):
+    """ Instrument handlers decorated from now on.
+
+    Args:
+        allocations (bool): also record net allocated bytes per layer; starts tracemalloc if needed
+        log (bool): emit one structured log line per invocation
+
+    Returns:
+        None
+    """
+    _settings.update(enabled=True, allocations=allocations, log=log)
+    if allocations and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _settings['started_tracemalloc'] = True
+
+
+def disable():
+    """ Stop recording. Handlers decorated from now on are not instrumented. """
+    if _settings['started_tracemalloc']:
+        tracemalloc.stop()
+    _settings.update(enabled=False, allocations=False, log=False, started_tracemalloc=False)
+
+
+if _settings['enabled'] and _settings['allocations']:
+    enable(allocations=True, log=_settings['log'])
+
+
+def add_hook(hook):
+    """ Register `hook`, a function called with the list of layer records after every instrumented invocation. """
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+def _finish(records):
+    for record in records:
+        record['self_ms'] = record['duration_ms'] - record.pop('children_ms')
+        if 'allocated_bytes' in record:
+            record['self_allocated_bytes'] = record['allocated_bytes'] - record.pop('children_allocated_bytes')
+
+    if _settings['log']:
+        logger.info(json.dumps({'pyfaaster_layers': records}))
+    for hook in _hooks:
+        try:
+            hook(records)
+        except Exception as err:
+            logger.exception(f'Instrumentation hook failed: {err}')
+
+
+def _timed(name, fn):
+    @functools.wraps(fn)
+    def layer_wrapper(*args, **kwargs):
+        if not _settings['enabled']:
+            return fn(*args, **kwargs)
+
+        if not getattr(_local, 'stack', None):
+            _local.stack = []
+            _local.records = []
+        stack, records = _local.stack, _local.records
+        record = {'layer': name, 'depth': len(stack), 'children_ms': 0.0}
+        records.append(record)
+        stack.append(record)
+
+        allocations = _settings['allocations'] and tracemalloc.is_tracing()
+        if allocations:
+            record['children_allocated_bytes'] = 0
+            start_bytes = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            record['duration_ms'] = (time.perf_counter() - start) * 1000
+            if allocations:
+                record['allocated_bytes'] = tracemalloc.get_traced_memory()[0] - start_bytes
+            stack.pop()
+            if stack:
+                stack[-1]['children_ms'] += record['duration_ms']
+                if allocations and 'children_allocated_bytes' in stack[-1]:
+                    stack[-1]['children_allocated_bytes'] += record['allocated_bytes']
+            else:
+                _local.records = []
+                _finish(records)
+
+    layer_wrapper._pyfaaster_layer = name
+    return layer_wrapper
+
+
+def timed(name):
+    """ Decorator that times a single handler wrapper as layer `name`, when instrumentation is enabled.
+
+    Args:
+        name (str): layer name used in the records
+
+    Returns:
+        decorator (func): returns the wrapper untouched when instrumentation is disabled
+    """
+    def timed_decorator(fn):
+        return _timed(name, fn) if _settings['enabled'] else fn
+
+    return timed_decorator
+
+
+def handler_layer(handler):
+    """ Time `handler` as layer 'handler', unless it is already an instrumented layer or instrumentation is disabled.
+
+    Args:
+        handler (func): the function being decorated
+
+    Returns:
+        handler (func)
+    """
+    if not _settings['enabled'] or getattr(handler, '_pyfaaster_layer', None):
+        return handler
+    return _timed('handler', handler)
+
+
+def layer(name):
+    """ Decorator for decorators: time the wrapper the decorated decorator returns as layer `name`, and
+    the wrapped handler as layer 'handler' if it is not itself an instrumented layer.
+
+    E.g.,
+        @instrumentation.layer('pingable')
+        def pingable(handler):
+            ...
+
+    Args:
+        name (str): layer name used in the records
+
+    Returns:
+        decorator (func): the decorator, which only instruments when instrumentation is enabled
+    """
+    def layer_decorator(decorator):
+        @functools.wraps(decorator)
+        def instrumented_decorator(handler):
+            if not _settings['enabled']:
+                return decorator(handler)
+            return _timed(name, decorator(handler_layer(handler)))
+
+        return instrumented_decorator
+
+    return layer_decorator
@@ -2,16 +2,483 @@
 # Copyright (c) 2016-present, CloudZero, Inc. All rights reserved.
 # Licensed under the BSD-style license. See LICENSE file in the project root for full license information.
 
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import base64
+import bisect
 import gzip
+import hashlib
+import itertools
+import threading
+import time
+import uuid
 
+from cachetools import cached, TTLCache
+from cachetools.keys import hashkey
+import simplejson as json
 
-def decode_record(record, compressed=False, transform_fn=lambda x: x):
-    data = record['kinesis']['data']
-    decoded = base64.b64decode(data)
-    return transform_fn((decoded if not compressed else gzip.decompress(decoded)).decode('utf-8'))
+import pyfaaster.aws.clients as clients
+import pyfaaster.aws.tools as tools
+import pyfaaster.common.concurrency as concurrency
 
+logger = tools.setup_logging('pyfaaster')
 
-def decode_records(records, compressed=False, transform_fn=lambda x: x):
-    return [decode_record(r, compressed, transform_fn)
+
+def _identity(x):
+    return x
+
+
+KPL_MAGIC = b'\xf3\x89\x9a\xc2'
+_KPL_DIGEST_SIZE = 16
+
+
+def _varint(buf, pos):
+    result = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _fields(buf):
+    """ Yield (field number, value) for each field of a protobuf message; length delimited values are bytes. """
+    pos, end = 0, len(buf)
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        wire_type = key & 0x7
+        if wire_type == 0:
+            value, pos = _varint(buf, pos)
+        elif wire_type == 2:
+            length, pos = _varint(buf, pos)
+            value, pos = buf[pos:pos + length], pos + length
+        elif wire_type == 1:
+            value, pos = buf[pos:pos + 8], pos + 8
+        elif wire_type == 5:
+            value, pos = buf[pos:pos + 4], pos + 4
+        else:
+            raise ValueError(f'Unsupported protobuf wire type {wire_type}')
+        yield key >> 3, value
+
+
+def _is_aggregated(data):
+    if len(data) <= len(KPL_MAGIC) + _KPL_DIGEST_SIZE or not data.startswith(KPL_MAGIC):
+        return False
+    message = data[len(KPL_MAGIC):-_KPL_DIGEST_SIZE]
+    if hashlib.md5(message).digest() != data[-_KPL_DIGEST_SIZE:]:
+        logger.warning('Kinesis record has the KPL magic prefix but a bad checksum, treating it as unaggregated.')
+        return False
+    return True
+
+
+def deaggregate(data):
+    """
+    Unpack a record aggregated by the Kinesis Producer Library (KPL) into its user records.
+
+    An aggregated record is the KPL magic prefix, a protobuf AggregatedRecord message and the MD5 of that
+    message. As with the KPL's own consumers, data without the prefix or with a bad checksum is not
+    aggregated and comes back as a single user record.
+
+    Args:
+        data (bytes): base64 decoded kinesis record data
+
+    Returns:
+        list: of dict, with 'partitionKey', 'explicitHashKey' (None unless aggregated) and 'data' (bytes)
+    """
+    if not _is_aggregated(data):
+        return [{'partitionKey': None, 'explicitHashKey': None, 'data': data}]
+
+    partition_keys, hash_keys, records = [], [], []
+    for field, value in _fields(memoryview(data)[len(KPL_MAGIC):-_KPL_DIGEST_SIZE]):
+        if field == 1:
+            partition_keys.append(bytes(value).decode('utf-8'))
+        elif field == 2:
+            hash_keys.append(bytes(value).decode('utf-8'))
+        elif field == 3:
+            records.append(dict(_fields(value)))
+
+    return [{'partitionKey': partition_keys[r.get(1, 0)],
+             'explicitHashKey': hash_keys[r[2]] if 2 in r else None,
+             'data': bytes(r.get(3, b''))}
             for r in records]
+
+
+def _decode_data(data, compressed, transform_fn, raw=False):
+    data = gzip.decompress(data) if compressed else data
+    return transform_fn(data if raw else data.decode('utf-8'))
+
+
+def decode_record(record, compressed=False, transform_fn=_identity, raw=False):
+    """
+    Decode a kinesis event record's data.
+
+    Args:
+        record (dict): kinesis event record
+        compressed (bool): the data is gzipped
+        transform_fn (func): applied to the decoded data
+        raw (bool): pass transform_fn the decoded bytes rather than a utf-8 str, saving a copy of the
+                    payload for consumers that take bytes (e.g. json.loads)
+
+    Returns:
+        transform_fn's result
+    """
+    return _decode_data(base64.b64decode(record['kinesis']['data']), compressed, transform_fn, raw)
+
+
+def _payloads(record, compressed, aggregated):
+    data = base64.b64decode(record['kinesis']['data'])
+    payloads = [r['data'] for r in deaggregate(data)] if aggregated else [data]
+    return [gzip.decompress(p) for p in payloads] if compressed else payloads
+
+
+def _decode_values(record, compressed, transform_fn, aggregated, raw, ndjson):
+    """ The decoded values of a record: one, unless it is aggregated or ndjson. """
+    values = []
+    for payload in _payloads(record, compressed, aggregated):
+        if ndjson:
+            values.extend(transform_fn(json.loads(line)) for line in payload.splitlines() if line.strip())
+        else:
+            values.append(transform_fn(payload if raw else payload.decode('utf-8')))
+    return values
+
+
+def _decode_chunk(records, compressed, transform_fn, aggregated=False, raw=False, ndjson=False):
+    if aggregated or ndjson:
+        return [v for r in records for v in _decode_values(r, compressed, transform_fn, aggregated, raw, ndjson)]
+    return [decode_record(r, compressed, transform_fn, raw) for r in records]
+
+
+_process_pool = {}
+
+
+def _processes(max_workers):
+    """ The shared process pool of `max_workers` processes, or None where processes aren't available (e.g.
+    AWS Lambda has no /dev/shm). """
+    if max_workers not in _process_pool:
+        try:
+            _process_pool[max_workers] = ProcessPoolExecutor(max_workers=max_workers)
+        except (OSError, NotImplementedError, ImportError) as err:
+            logger.warning(f'Process pool unavailable, decoding with threads instead. ({err})')
+            _process_pool[max_workers] = None
+    return _process_pool[max_workers]
+
+
+def _decode_slices(pool, slices, *args):
+    decoded = pool.map(_decode_chunk, slices, *(itertools.repeat(arg) for arg in args))
+    return list(itertools.chain.from_iterable(decoded))
+
+
+def decode_records(records, compressed=False, transform_fn=_identity, max_workers=None, processes=False,
+                   aggregated=False, raw=False, ndjson=False):
+    """
+    Decode records (see decode_record), in order.
+
+    By default records are decoded in turn. With `max_workers`, the batch is split into slices that are
+    decoded in parallel: on threads, which pays off for large compressed batches since zlib releases the
+    GIL, or with `processes=True` on a process pool, for CPU heavy transform_fns (which then must be
+    picklable, i.e. not lambdas). Where processes are not available, as on AWS Lambda, threads are used.
+    Parallel decoding has a fixed overhead per batch, and only pays off for large batches and with more
+    than one CPU; measure it for your records with test_decode_records_parallel_benchmark. Pools are
+    shared, one per `max_workers`, and a process pool that breaks (e.g. a worker was killed) is replaced.
+
+    With `ndjson=True` each record (or user record) holds newline delimited JSON, and each line is parsed
+    straight from the decoded bytes and passed to transform_fn, so one record gives as many results as
+    it has lines.
+
+    Args:
+        records (list): kinesis event records
+        compressed (bool): records are gzipped
+        transform_fn (func): applied to each decoded record
+        max_workers (int): decode on up to this many threads/processes
+        processes (bool): use processes instead of threads
+        aggregated (bool): records may be KPL aggregated, decode each of their user records (see deaggregate)
+        raw (bool): pass transform_fn bytes rather than a utf-8 str (see decode_record)
+        ndjson (bool): records hold newline delimited JSON, decode each line
+
+    Returns:
+        list
+    """
+    if not max_workers or max_workers == 1 or len(records) <= 1:
+        return _decode_chunk(records, compressed, transform_fn, aggregated, raw, ndjson)
+
+    slice_size = -(-len(records) // (max_workers * 4))
+    slices = [records[i:i + slice_size] for i in range(0, len(records), slice_size)]
+    args = (compressed, transform_fn, aggregated, raw, ndjson)
+    pool = processes and _processes(max_workers)
+    if pool:
+        try:
+            return _decode_slices(pool, slices, *args)
+        except BrokenProcessPool:
+            logger.warning('Process pool broken, decoding on a new one.')
+            _process_pool.pop(max_workers, None)
+            pool = _processes(max_workers)
+            if pool:
+                return _decode_slices(pool, slices, *args)
+    return _decode_slices(concurrency.executor(f'kinesis-{max_workers}', max_workers), slices, *args)
+
+
+def iter_records(records, compressed=False, transform_fn=_identity, chunk_size=None, aggregated=False, raw=False,
+                 ndjson=False):
+    """
+    Lazily decode records (see decode_record), so that only the records being worked on are held
+    decoded in memory, instead of the whole batch as with decode_records.
+
+    E.g.,
+    >>> records = [{'kinesis': {'data': base64.b64encode(s.encode('utf-8'))}} for s in 'abcde']
+    >>> list(iter_records(records, transform_fn=str.upper))
+    ['A', 'B', 'C', 'D', 'E']
+    >>> list(iter_records(records, chunk_size=2))
+    [['a', 'b'], ['c', 'd'], ['e']]
+
+    Args:
+        records (iterable): kinesis event records
+        compressed (bool): records are gzipped
+        transform_fn (func): applied to each decoded record
+        chunk_size (int): yield lists of up to this many decoded records instead of single records
+        aggregated (bool): records may be KPL aggregated, decode each of their user records (see deaggregate)
+        raw (bool): pass transform_fn bytes rather than a utf-8 str (see decode_record)
+        ndjson (bool): records hold newline delimited JSON, decode each line (see decode_records)
+
+    Returns:
+        generator
+    """
+    if aggregated or ndjson:
+        decoded = (v for r in records for v in _decode_values(r, compressed, transform_fn, aggregated, raw, ndjson))
+    else:
+        decoded = (decode_record(r, compressed, transform_fn, raw) for r in records)
+
+    if not chunk_size:
+        yield from decoded
+        return
+
+    while True:
+        chunk = list(itertools.islice(decoded, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+MAX_PUT_RECORDS = 500
+MAX_PUT_RECORDS_BYTES = 5 * 1024 * 1024
+MAX_RECORD_BYTES = 1024 * 1024
+
+
+shard_ranges_cache = TTLCache(maxsize=32, ttl=300)
+
+
+def _shard_ranges_key(stream_name, client=None):
+    meta = (client or clients.client('kinesis')).meta
+    return hashkey(stream_name, meta.region_name, meta.endpoint_url)
+
+
+@cached(cache=shard_ranges_cache, key=_shard_ranges_key, lock=threading.Lock())
+def shard_ranges(stream_name, client=None):
+    """
+    The hash key ranges of a stream's open shards, cached for five minutes (see shard_ranges_cache) per
+    stream name, region and endpoint.
+
+    Args:
+        stream_name (str):
+        client: kinesis client, defaults to the shared client
+
+    Returns:
+        list: of (shard id, starting hash key, ending hash key), ordered by hash key
+    """
+    client = client or clients.client('kinesis')
+    shards, kwargs = [], {'StreamName': stream_name}
+    while True:
+        response = client.list_shards(**kwargs)
+        shards.extend(response['Shards'])
+        if not response.get('NextToken'):
+            break
+        kwargs = {'NextToken': response['NextToken']}
+
+    ranges = [(shard['ShardId'], int(shard['HashKeyRange']['StartingHashKey']),
+               int(shard['HashKeyRange']['EndingHashKey']))
+              for shard in shards if 'EndingSequenceNumber' not in shard['SequenceNumberRange']]
+    return sorted(ranges, key=lambda r: r[1])
+
+
+def _partition_key_hash(partition_key):
+    """ The hash key Kinesis gives a partition key: its MD5, as a 128 bit integer. """
+    return int.from_bytes(hashlib.md5(partition_key.encode('utf-8')).digest(), 'big')
+
+
+class ShardBalancer:
+    """
+    Choose ExplicitHashKeys for a stream's records from its open shards' hash key ranges, instead of
+    leaving it to the MD5 of the partition key, which can leave some shards busier than others.
+
+    hash_key() spreads records round robin over the shards, so each gets the same number of records;
+    hash_key(group) always gives the same shard for `group`, keeping related records together (and in
+    order) with groups spread evenly over the shards.
+
+    E.g.,
+        balancer = kinesis.ShardBalancer('my-stream')
+        with kinesis.Producer('my-stream') as producer:
+            for event in events:
+                producer.put(json.dumps(event), explicit_hash_key=balancer.hash_key())
+
+    Args:
+        stream_name (str):
+        client: kinesis client, defaults to the shared client
+        ranges (list): shard ranges, as from shard_ranges(), instead of reading them from the stream
+    """
+
+    def __init__(self, stream_name=None, client=None, ranges=None):
+        self.ranges = ranges or shard_ranges(stream_name, client)
+        self._starts = [start for _, start, _ in self.ranges]
+        self._hash_keys = [str((start + end) // 2) for _, start, end in self.ranges]
+        self._next = itertools.count()
+
+    def hash_key(self, group=None):
+        """
+        Args:
+            group (str): keep records with the same group on the same shard
+
+        Returns:
+            str: an ExplicitHashKey, the middle of the chosen shard's range
+        """
+        if group is None:
+            index = next(self._next) % len(self.ranges)
+        else:
+            index = _partition_key_hash(group) % len(self.ranges)
+        return self._hash_keys[index]
+
+    def shard_id(self, partition_key=None, explicit_hash_key=None):
+        """ The shard Kinesis writes a record with this partition key or explicit hash key to. """
+        hash_key = int(explicit_hash_key) if explicit_hash_key is not None else _partition_key_hash(partition_key)
+        return self.ranges[bisect.bisect_right(self._starts, hash_key) - 1][0]
+
+
+def _entry_size(entry):
+    return len(entry['Data']) + len(entry['PartitionKey'].encode('utf-8'))
+
+
+class PutRecordsException(Exception):
+    def __init__(self, stream_name, failed):
+        super().__init__(f'{len(failed)} records were not written to {stream_name}')
+        self.failed = failed
+
+
+class Producer:
+    """
+    Buffer records for a Kinesis stream and write them with PutRecords, up to MAX_PUT_RECORDS records and
+    MAX_PUT_RECORDS_BYTES bytes per call. Records that fail with ProvisionedThroughputExceededException
+    are retried with exponential backoff; other failures are returned from flush(). Used as a context
+    manager, the producer flushes on exit and raises PutRecordsException if any record failed.
+
+    E.g.,
+        with kinesis.Producer('my-stream', compressed=True) as producer:
+            for line in lines:
+                producer.put(line)
+        # or: results = producer.flush()
+
+    If PutRecords itself raises (e.g. the stream does not exist), the records it had not written stay
+    buffered, to be written by the next flush().
+
+    Args:
+        stream_name (str):
+        compressed (bool): gzip records, for consumers using decode_record(compressed=True)
+        client: kinesis client, defaults to the shared client
+        max_attempts (int): PutRecords attempts for a record
+        backoff (float): seconds to wait before the first retry, doubled for each further retry
+    """
+
+    def __init__(self, stream_name, compressed=False, client=None, max_attempts=5, backoff=0.1):
+        self.stream_name = stream_name
+        self.compressed = compressed
+        self.client = client or clients.client('kinesis')
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        failed = [r for r in self.flush() if not r['success']]
+        if failed and exc_type is None:
+            raise PutRecordsException(self.stream_name, failed)
+
+    def put(self, data, partition_key=None, explicit_hash_key=None):
+        """
+        Buffer a record, writing the buffer first if the record would not fit in the same PutRecords call.
+
+        Args:
+            data (str|bytes): str is utf-8 encoded
+            partition_key (str): defaults to a random key, spreading records across shards
+            explicit_hash_key (str): overrides the partition key's hash to choose the shard
+
+        Raises:
+            ValueError: if the record is larger than Kinesis allows
+        """
+        data = data.encode('utf-8') if isinstance(data, str) else data
+        entry = {'Data': gzip.compress(data) if self.compressed else data,
+                 'PartitionKey': partition_key or uuid.uuid4().hex}
+        if explicit_hash_key:
+            entry['ExplicitHashKey'] = explicit_hash_key
+
+        size = _entry_size(entry)
+        if size > MAX_RECORD_BYTES:
+            raise ValueError(f'Record of {size} bytes is larger than the {MAX_RECORD_BYTES} bytes Kinesis allows.')
+        if len(self._buffer) == MAX_PUT_RECORDS or self._buffer_bytes + size > MAX_PUT_RECORDS_BYTES:
+            self._send()
+        self._buffer.append(entry)
+        self._buffer_bytes += size
+
+    def flush(self):
+        """
+        Write any buffered records.
+
+        Returns:
+            list: for each record written since the last flush, in the order written, {'success': True,
+                  'ShardId': ..., 'SequenceNumber': ...} or {'success': False, 'error': {'Code': ...,
+                  'Message': ...}}
+        """
+        if self._buffer:
+            self._send()
+        results, self._results = self._results, []
+        return results
+
+    def _send(self):
+        entries, self._buffer, self._buffer_bytes = self._buffer, [], 0
+        results = [None] * len(entries)
+        pending = list(range(len(entries)))
+        try:
+            for attempt in range(self.max_attempts):
+                if attempt:
+                    time.sleep(self.backoff * 2 ** (attempt - 1))
+                response = self.client.put_records(StreamName=self.stream_name,
+                                                   Records=[entries[i] for i in pending])
+                retry = []
+                for i, result in zip(pending, response['Records']):
+                    results[i] = result
+                    if result.get('ErrorCode') == 'ProvisionedThroughputExceededException':
+                        retry.append(i)
+                pending = retry
+                if not pending:
+                    break
+                logger.warning(f'Throughput exceeded for {len(pending)} records to {self.stream_name} '
+                               f'(attempt {attempt + 1}).')
+        except Exception:
+            # keep the records not yet written for the next flush
+            unwritten = set(pending)
+            self._buffer = [entries[i] for i in pending] + self._buffer
+            self._buffer_bytes = sum(_entry_size(e) for e in self._buffer)
+            self._record([r for i, r in enumerate(results) if i not in unwritten])
+            raise
+        self._record(results)
+
+    def _record(self, results):
+        for result in results:
+            if result.get('ErrorCode'):
+                error = {'Code': result['ErrorCode'], 'Message': result.get('ErrorMessage')}
+                self._results.append({'success': False, 'error': error})
+            else:
+                self._results.append({'success': True, 'ShardId': result['ShardId'],
+                                      'SequenceNumber': result['SequenceNumber']})
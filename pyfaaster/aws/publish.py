@@ -1,30 +1,69 @@
 # Copyright (c) 2016-present, CloudZero, Inc. All rights reserved.
 # Licensed under the BSD-style license. See LICENSE file in the project root for full license information.
 
-import boto3
 import simplejson as json
 import datetime as dt
+import functools
+import time
 
+import botocore.exceptions
+
+import pyfaaster.aws.clients as clients
+from pyfaaster.aws.exceptions import PublishException
 import pyfaaster.aws.tools as tools
+import pyfaaster.common.concurrency as concurrency
 from voluptuous import Schema, ALLOW_EXTRA, All
 
 logger = tools.setup_logging('pyfaaster')
 
+SNS = 'sns'
+EVENTBRIDGE = 'eventbridge'
+
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_BACKOFF = 0.1
+
+
+def _backend(conn, target):
+    """ SNS or EVENTBRIDGE: given by the target's ARN, else by conn['backends'], else SNS. """
+    if target.startswith('arn:aws:events:'):
+        return EVENTBRIDGE
+    if target.startswith('arn:aws:sns:'):
+        return SNS
+    return conn.get('backends', {}).get(target, SNS)
+
+
+def event_bus_backends(targets):
+    """ Backends (see conn()) sending each of the comma separated `targets` to EventBridge.
+
+    >>> event_bus_backends('bus-1, bus-{namespace}')
+    {'bus-1': 'eventbridge', 'bus-{namespace}': 'eventbridge'}
+    >>> event_bus_backends(None)
+    {}
+    """
+    return {t.strip(): EVENTBRIDGE for t in (targets or '').split(',') if t.strip()}
 
-def _publish_sns_message(conn, topic, message, **kwargs):
-    logger.debug(f'Publishing {message}')
 
-    topic_arn = topic.format(
+def _topic_arn(conn, topic):
+    return topic.format(
         namespace=conn['namespace']) if 'arn:aws:sns' in topic else conn['topic_arn_prefix'] + topic.format(
         namespace=conn['namespace'])
 
+
+def _prepare_message(message):
     if getattr(message, 'get', None) and not message.get('timestamp'):
         message['timestamp'] = str(dt.datetime.now(tz=dt.timezone.utc))
 
     if isinstance(message, str):
-        prepared_message = message
+        return message
     else:
-        prepared_message = json.dumps(message, iterable_as_array=True)
+        return json.dumps(message, iterable_as_array=True)
+
+
+def _publish_sns_message(conn, topic, message, **kwargs):
+    logger.debug(f'Publishing {message}')
+
+    topic_arn = _topic_arn(conn, topic)
+    prepared_message = _prepare_message(message)
 
     logger.debug(f'Publishing {message} to {topic_arn}')
 
@@ -48,40 +87,322 @@ _validate_events = Schema({
 })
 
 
-def publish_events(conn, events):
+def _publish_topic_events(conn, topic, events_for_topic):
+    return [_publish_sns_message(conn, topic, event['detail'],
+                                 Subject=event['type'],
+                                 MessageAttributes={
+                                    'message_type': {
+                                        'DataType': 'String',
+                                        'StringValue': event['type']
+                                    }
+                                 })
+            for event in events_for_topic]
+
+
+def _per_topic(fn, items, max_concurrency):
+    """ Call fn(topic, value) for each topic, in parallel on the shared 'publish' pool unless
+    max_concurrency is None/1, and return the results in topic order. """
+    if not max_concurrency or max_concurrency == 1:
+        return [fn(topic, value) for topic, value in items.items()]
+    return concurrency.map_concurrently(lambda item: fn(*item), items.items(),
+                                        max_concurrency=max_concurrency, name='publish')
+
+
+def _publish_target_events(conn, target, events_for_target):
+    if _backend(conn, target) == SNS:
+        return _publish_topic_events(conn, target, events_for_target)
+
+    results = _put_target_events(conn, DEFAULT_MAX_ATTEMPTS, DEFAULT_BACKOFF, target, events_for_target)
+    failures = [r for r in results if not r['success']]
+    if failures:
+        raise PublishException(failures)
+    return [r['event'] for r in results]
+
+
+def publish_events(conn, events, max_concurrency=None):
+    """ Publish each event to its target: an SNS topic, or an EventBridge event bus when the target is
+    an event bus ARN or conn['backends'] says so (see conn()). Events for an event bus are sent with
+    PutEvents, see publish_events_batch.
+
+    Args:
+        conn (dict): see conn()
+        events (dict): target -> list of events, each conforming to EVENT
+        max_concurrency (int): publish up to this many targets in parallel; by default targets are published in turn
+
+    Returns:
+        list: the published messages, in order
+
+    Raises:
+        PublishException: when event bus entries still failed after retrying
+        ConcurrentExecutionError: when publishing in parallel, with every target's error
+    """
     _validate_events(events)
     logger.debug(f'Publishing {events}')
 
     published_events = []
-    for topic, events_for_topic in events.items():
-        for event in events_for_topic:
-            event = _publish_sns_message(conn, topic, event['detail'],
-                                         Subject=event['type'],
-                                         MessageAttributes={
-                                            'message_type': {
-                                                'DataType': 'String',
-                                                'StringValue': event['type']
-                                            }
-                                        })
-            published_events.append(event)
+    for published_for_target in _per_topic(functools.partial(_publish_target_events, conn), events, max_concurrency):
+        published_events.extend(published_for_target)
 
     return published_events
 
 
-def publish(conn, messages):
+MAX_BATCH_ENTRIES = 10
+MAX_BATCH_BYTES = 256 * 1024
+
+
+def _entry_size(entry):
+    attributes = entry.get('MessageAttributes', {})
+    return len(entry['Message'].encode('utf-8')) + len(entry.get('Subject', '').encode('utf-8')) + sum(
+        len(name.encode('utf-8')) + len(a['DataType']) + len(a['StringValue'].encode('utf-8'))
+        for name, a in attributes.items())
+
+
+def _put_events_entry_size(entry):
+    """ The size of a PutEvents entry, as EventBridge counts it (plus its EventBusName).
+
+    >>> _put_events_entry_size({'Source': 'src', 'DetailType': 'type', 'Detail': '{}', 'Resources': ['arn']})
+    12
+    """
+    size = 14 if entry.get('Time') else 0
+    size += sum(len(entry[k].encode('utf-8')) for k in ('Source', 'DetailType', 'Detail', 'EventBusName') if k in entry)
+    return size + sum(len(r.encode('utf-8')) for r in entry.get('Resources', []))
+
+
+def _too_large(size):
+    return {'Code': 'EntryTooLarge',
+            'Message': f'Entry of {size} bytes is larger than the {MAX_BATCH_BYTES} bytes allowed.'}
+
+
+def _client_error(err):
+    return {'Code': err.response['Error'].get('Code'), 'Message': err.response['Error'].get('Message')}
+
+
+def _batches(entries, max_entries=MAX_BATCH_ENTRIES, max_bytes=MAX_BATCH_BYTES, size=_entry_size):
+    """ Split entries into lists of at most `max_entries` entries and (where possible) `max_bytes` bytes.
+
+    >>> [len(b) for b in _batches([{'Message': 'x'}] * 25)]
+    [10, 10, 5]
+    >>> [len(b) for b in _batches([{'Message': 'x' * 100}] * 5, max_bytes=250)]
+    [2, 2, 1]
+    """
+    batch, batch_bytes = [], 0
+    for entry in entries:
+        entry_bytes = size(entry)
+        if batch and (len(batch) == max_entries or batch_bytes + entry_bytes > max_bytes):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(entry)
+        batch_bytes += entry_bytes
+    if batch:
+        yield batch
+
+
+def _publish_batch(conn, topic_arn, entries, max_attempts, backoff):
+    """ PublishBatch `entries` to `topic_arn`, retrying only the failed, retryable entries.
+
+    Returns:
+        dict: entry Id -> {'MessageId': ...} or {'Error': failed entry}
+    """
+    results = {}
+    pending = entries
+    for attempt in range(max_attempts):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        try:
+            response = conn['sns'].publish_batch(TopicArn=topic_arn, PublishBatchRequestEntries=pending)
+        except botocore.exceptions.ClientError as err:
+            logger.exception(f'Failed to publish {len(pending)} entries to {topic_arn}.')
+            results.update({e['Id']: {'Error': {'Id': e['Id'], **_client_error(err)}} for e in pending})
+            break
+        for success in response.get('Successful', []):
+            results[success['Id']] = {'MessageId': success['MessageId']}
+        retry_ids = set()
+        for failure in response.get('Failed', []):
+            results[failure['Id']] = {'Error': failure}
+            if not failure.get('SenderFault'):
+                retry_ids.add(failure['Id'])
+        pending = [e for e in pending if e['Id'] in retry_ids]
+        if not pending:
+            break
+        logger.warning(f'Failed to publish {len(pending)} entries to {topic_arn} (attempt {attempt + 1}).')
+    return results
+
+
+def _publish_topic_events_batch(conn, max_attempts, backoff, topic, events_for_topic):
+    topic_arn = _topic_arn(conn, topic)
+    messages = [event['detail'] for event in events_for_topic]
+    entries = [{
+        'Id': str(i),
+        'Message': _prepare_message(message),
+        'Subject': event['type'],
+        'MessageAttributes': {
+            'message_type': {
+                'DataType': 'String',
+                'StringValue': event['type']
+            }
+        },
+    } for i, (event, message) in enumerate(zip(events_for_topic, messages))]
+
+    published = {e['Id']: {'Error': _too_large(_entry_size(e))} for e in entries if _entry_size(e) > MAX_BATCH_BYTES}
+    for batch in _batches([e for e in entries if e['Id'] not in published]):
+        published.update(_publish_batch(conn, topic_arn, batch, max_attempts, backoff))
+
+    results = []
+    for entry, message in zip(entries, messages):
+        result = published[entry['Id']]
+        if 'MessageId' in result:
+            results.append({'topic': topic, 'event': message, 'success': True, 'MessageId': result['MessageId']})
+        else:
+            error = {k: v for k, v in result['Error'].items() if k != 'Id'}
+            results.append({'topic': topic, 'event': message, 'success': False, 'error': error})
+
+    return results
+
+
+_RETRYABLE_PUT_EVENTS_ERRORS = {'InternalFailure', 'InternalException', 'ThrottlingException'}
+
+
+def _put_events(conn, entries, max_attempts, backoff):
+    """ PutEvents `entries`, retrying only the entries that failed with a retryable error.
+
+    Returns:
+        list: the PutEvents result entry for each of `entries`, in order
+    """
+    events_client = conn.get('events') or clients.client('events')
+    results = [None] * len(entries)
+    pending = list(range(len(entries)))
+    for attempt in range(max_attempts):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        try:
+            response = events_client.put_events(Entries=[entries[i] for i in pending])
+        except botocore.exceptions.ClientError as err:
+            logger.exception(f'Failed to put {len(pending)} events.')
+            error = _client_error(err)
+            for i in pending:
+                results[i] = {'ErrorCode': error['Code'], 'ErrorMessage': error['Message']}
+            break
+        retry = []
+        for i, result in zip(pending, response['Entries']):
+            results[i] = result
+            if result.get('ErrorCode') in _RETRYABLE_PUT_EVENTS_ERRORS:
+                retry.append(i)
+        pending = retry
+        if not pending:
+            break
+        logger.warning(f'Failed to put {len(pending)} events (attempt {attempt + 1}).')
+    return results
+
+
+def _put_target_events(conn, max_attempts, backoff, target, events_for_target):
+    event_bus = target.format(namespace=conn['namespace'])
+    messages = [event['detail'] for event in events_for_target]
+    entries = [{
+        'Source': event.get('source', conn['namespace']),
+        'DetailType': event['type'],
+        'Detail': _prepare_message(message),
+        'EventBusName': event_bus,
+    } for event, message in zip(events_for_target, messages)]
+
+    put = [None] * len(entries)
+    sizes = [_put_events_entry_size(e) for e in entries]
+    for i, size in enumerate(sizes):
+        if size > MAX_BATCH_BYTES:
+            error = _too_large(size)
+            put[i] = {'ErrorCode': error['Code'], 'ErrorMessage': error['Message']}
+    indexes = [i for i, result in enumerate(put) if result is None]
+    for batch in _batches(indexes, size=lambda i: sizes[i]):
+        for i, result in zip(batch, _put_events(conn, [entries[i] for i in batch], max_attempts, backoff)):
+            put[i] = result
+
+    results = []
+    for result, message in zip(put, messages):
+        if result.get('EventId'):
+            results.append({'target': target, 'event': message, 'success': True, 'EventId': result['EventId']})
+        else:
+            error = {'Code': result.get('ErrorCode'), 'Message': result.get('ErrorMessage')}
+            results.append({'target': target, 'event': message, 'success': False, 'error': error})
+
+    return results
+
+
+def _publish_target_events_batch(conn, max_attempts, backoff, target, events_for_target):
+    publish_batch = _publish_topic_events_batch if _backend(conn, target) == SNS else _put_target_events
+    return publish_batch(conn, max_attempts, backoff, target, events_for_target)
+
+
+def publish_events_batch(conn, events, max_attempts=DEFAULT_MAX_ATTEMPTS, backoff=DEFAULT_BACKOFF, max_concurrency=None):
+    """ Publish `events` (see publish_events) in batches of up to 10 entries / 256 KB per target: with
+    SNS PublishBatch for topics and EventBridge PutEvents for event buses. An event's `type` and `detail`
+    become the SNS Subject/Message (or EventBridge DetailType/Detail); an optional `source` sets the
+    EventBridge Source, which defaults to the namespace. Entries that fail are retried (with exponential
+    backoff) up to `max_attempts` times, unless the failure is not retryable. Entries larger than 256 KB,
+    and the entries of a batch whose call raised a ClientError, are reported as failed without stopping
+    the other batches.
+
+    Args:
+        conn (dict): see conn()
+        events (dict): target -> list of events, each conforming to EVENT
+        max_attempts (int): attempts per batch
+        backoff (float): seconds to wait before the first retry, doubled for each further retry
+        max_concurrency (int): publish up to this many targets in parallel; by default targets are published in turn
+
+    Returns:
+        list: one result per event, in order:
+            {'topic': topic, 'event': message, 'success': True, 'MessageId': str} or
+            {'topic': topic, 'event': message, 'success': False, 'error': {'Code': ..., 'Message': ...}};
+            for event buses 'target' replaces 'topic' and 'EventId' replaces 'MessageId'
+
+    Raises:
+        ConcurrentExecutionError: when publishing in parallel, with every target's error
+    """
+    _validate_events(events)
+    logger.debug(f'Publishing {events}')
+
+    results = []
+    for results_for_target in _per_topic(
+            functools.partial(_publish_target_events_batch, conn, max_attempts, backoff), events, max_concurrency):
+        results.extend(results_for_target)
+
+    return results
+
+
+def publish(conn, messages, max_concurrency=None):
+    """ Publish each message to its topic.
+
+    Args:
+        conn (dict): see conn()
+        messages (dict): topic -> message
+        max_concurrency (int): publish up to this many topics in parallel; by default topics are published in turn
+
+    Returns:
+        list: the published messages, in order
+
+    Raises:
+        ConcurrentExecutionError: when publishing in parallel, with every topic's error
+    """
     logger.debug(f'Publishing {messages}')
 
-    published_messages = []
-    for topic, message in messages.items():
-        message = _publish_sns_message(conn, topic, messages[topic])
-        published_messages.append(message)
+    return _per_topic(functools.partial(_publish_sns_message, conn), messages, max_concurrency)
 
-    return published_messages
 
+def conn(region, account_id, namespace, client=None, events_client=None, backends=None):
+    """
+    Args:
+        region (str): region of topics given by name
+        account_id (str): account of topics given by name
+        namespace (str): substituted for {namespace} in target names
+        client: SNS client
+        events_client: EventBridge client, created when first needed if not given
+        backends (dict): target name -> SNS or EVENTBRIDGE, for targets not given by ARN (default SNS)
 
-def conn(region, account_id, namespace, client=None):
+    Returns:
+        dict
+    """
     return {
         'namespace': namespace,
         'topic_arn_prefix': f'arn:aws:sns:{region}:{account_id}:',
-        'sns': client or boto3.client('sns'),
+        'sns': client or clients.client('sns'),
+        'events': events_client,
+        'backends': backends or {},
     }
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016-present, CloudZero, Inc. All rights reserved.
+# Licensed under the BSD-style license. See LICENSE file in the project root for full license information.
+
+"""
+Bounded, reusable thread pools for fanning out I/O bound work (e.g. AWS API calls) from a lambda handler.
+
+Pools are created lazily, one per name, and kept for the life of the process, so warm invocations
+don't pay for thread start up. Use a distinct name per caller: a task must never wait on work
+submitted to its own pool, or a saturated pool will deadlock.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import threading
+
+DEFAULT_MAX_WORKERS = 16
+
+_executors = {}
+_lock = threading.Lock()
+
+
+class ConcurrentExecutionError(Exception):
+    """Raised by map_concurrently when one or more calls failed. `errors` is a list of (index, exception),
+    in input order; `results` holds the result of every call by index (None where the call failed)."""
+
+    def __init__(self, errors, results):
+        super().__init__(f'{len(errors)} of {len(results)} calls failed: {[str(e) for _, e in errors]}')
+        self.errors = errors
+        self.results = results
+
+
+def executor(name, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Get the shared thread pool called `name`, creating it with `max_workers` threads on first use.
+
+    Args:
+        name (str): pool name
+        max_workers (int): size of the pool when it is created
+
+    Returns:
+        concurrent.futures.ThreadPoolExecutor
+    """
+    pool = _executors.get(name)
+    if pool:
+        return pool
+    with _lock:
+        if name not in _executors:
+            _executors[name] = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'pyfaaster-{name}')
+        return _executors[name]
+
+
+def map_concurrently(fn, items, max_concurrency=None, name='default', return_exceptions=False):
+    """
+    Call `fn` on each of `items` on the pool called `name`, with at most `max_concurrency` calls in
+    flight, and return the results in the order of `items`.
+
+    E.g.,
+    >>> map_concurrently(lambda x: x * 2, [1, 2, 3], max_concurrency=2)
+    [2, 4, 6]
+    >>> map_concurrently(lambda x: 1 / x, [1, 0], return_exceptions=True)
+    [1.0, ZeroDivisionError('division by zero')]
+
+    Args:
+        fn (func): a function of one argument
+        items (iterable): arguments for fn
+        max_concurrency (int): ceiling on concurrent calls (the pool size is always a ceiling too);
+                               1 runs everything in the calling thread
+        name (str): pool to run on, see executor()
+        return_exceptions (bool): return exceptions in place of results instead of raising
+
+    Returns:
+        list: results, in order
+
+    Raises:
+        ConcurrentExecutionError: if any call raised (and return_exceptions is False)
+    """
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+
+    if max_concurrency == 1 or len(items) <= 1:
+        for i, item in enumerate(items):
+            try:
+                results[i] = fn(item)
+            except Exception as err:
+                errors.append((i, err))
+                if return_exceptions:
+                    results[i] = err
+    else:
+        pool = executor(name)
+        limit = max_concurrency or len(items)
+        futures = {}
+        index = 0
+        while index < len(items) or futures:
+            while index < len(items) and len(futures) < limit:
+                futures[pool.submit(fn, items[index])] = index
+                index += 1
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = futures.pop(future)
+                try:
+                    results[i] = future.result()
+                except Exception as err:
+                    errors.append((i, err))
+                    if return_exceptions:
+                        results[i] = err
+
+    if errors and not return_exceptions:
+        raise ConcurrentExecutionError(sorted(errors, key=lambda e: e[0]), results)
+    return results
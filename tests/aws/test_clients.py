@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016-present, CloudZero, Inc. All rights reserved.
+# Licensed under the BSD-style license. See LICENSE file in the project root for full license information.
+
+from botocore.config import Config
+import pytest
+
+import pyfaaster.aws.clients as clients
+import pyfaaster.aws.configuration as conf
+import pyfaaster.aws.publish as publish
+
+
+@pytest.fixture(scope='function')
+def registry():
+    clients.clear()
+    yield
+    clients.clear()
+
+
+@pytest.mark.unit
+def test_client_is_shared(registry):
+    s3 = clients.client('s3', region_name='us-east-1')
+
+    assert clients.client('s3', region_name='us-east-1') is s3
+    assert clients.client('s3', region_name='us-west-2') is not s3
+    assert clients.client('s3', region_name='us-east-1', endpoint_url='http://localhost:4572') is not s3
+    assert clients.client('s3', region_name='us-east-1', aws_access_key_id='a', aws_secret_access_key='b') is not s3
+    assert clients.client('sns', region_name='us-east-1') is not s3
+
+
+@pytest.mark.unit
+def test_client_config(registry):
+    s3 = clients.client('s3', region_name='us-east-1')
+    assert s3.meta.config.max_pool_connections == clients.DEFAULT_CONFIG.max_pool_connections
+
+    config = Config(read_timeout=1)
+    tuned = clients.client('s3', region_name='us-east-1', config=config)
+    assert tuned is not s3
+    assert tuned is clients.client('s3', region_name='us-east-1', config=config)
+    assert tuned.meta.config.read_timeout == 1
+    assert tuned.meta.config.max_pool_connections == clients.DEFAULT_CONFIG.max_pool_connections
+    assert clients.client('s3', region_name='us-east-1', config=Config(read_timeout=1)) is tuned
+    assert len(clients._clients) == 2
+
+    assert s3.meta.config.read_timeout == 60
+    assert clients.client('lambda', region_name='us-east-1').meta.config.read_timeout == 900
+
+
+@pytest.mark.unit
+def test_clear(registry):
+    s3 = clients.client('s3', region_name='us-east-1')
+    clients.clear()
+    assert clients.client('s3', region_name='us-east-1') is not s3
+
+
+@pytest.mark.unit
+def test_conns_share_clients(registry, monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+
+    assert conf.conn()['client'] is conf.conn('arn:aws:kms:region:account_id:key/guid')['client']
+    assert publish.conn('us-east-1', '123456789012', 'ns')['sns'] is clients.client('sns')
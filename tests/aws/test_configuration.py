@@ -2,7 +2,9 @@
 # Copyright (c) 2016-present, CloudZero, Inc. All rights reserved.
 # Licensed under the BSD-style license. See LICENSE file in the project root for full license information.
 from io import BytesIO
+import time
 
+import botocore.exceptions
 import botocore.session
 from botocore.stub import Stubber
 from botocore.response import StreamingBody
@@ -141,3 +143,139 @@ def test_read_only():
         assert conf.read_only_cache.currsize == 1
         # verify cache has the right data
         assert conf.read_only_cache[('bucket', 'conf.json')] == settings
+
+
+@pytest.fixture(scope='function')
+def revalidating_cache(mocker):
+    conf.revalidating_cache.clear()
+    conf.revalidating_cache_stats.update(hits=0, misses=0, not_modified=0)
+    clock = mocker.patch('pyfaaster.aws.configuration.time')
+    clock.monotonic.return_value = 1000
+    yield clock
+    conf.revalidating_cache.clear()
+
+
+def _get_response(settings, etag):
+    data = json.dumps(settings).encode('utf-8')
+    return {'Body': StreamingBody(raw_stream=BytesIO(data), content_length=len(data)), 'ETag': etag}
+
+
+@pytest.mark.unit
+def test_load_revalidated(revalidating_cache):
+    bucket_name = 'bucket'
+    file_name = 'conf.json'
+    settings = {'setting_1': 'foo'}
+    new_settings = {'setting_1': 'bar'}
+    s3 = botocore.session.get_session().create_client('s3')
+    conn = conf.conn(client=s3)
+
+    with Stubber(s3) as stubber:
+        stubber.add_response('get_object', _get_response(settings, '"v1"'), {'Bucket': bucket_name, 'Key': file_name})
+        assert conf.load_revalidated(conn, bucket_name, file_name, ttl=60) == settings
+
+        # within ttl, no S3 call
+        revalidating_cache.monotonic.return_value = 1059
+        assert conf.load_revalidated(conn, bucket_name, file_name, ttl=60) == settings
+
+        # ttl expired, unchanged
+        revalidating_cache.monotonic.return_value = 1060
+        stubber.add_client_error('get_object', service_error_code='304', http_status_code=304,
+                                 expected_params={'Bucket': bucket_name, 'Key': file_name, 'IfNoneMatch': '"v1"'})
+        assert conf.load_revalidated(conn, bucket_name, file_name, ttl=60) == settings
+
+        # ttl expired again, changed
+        revalidating_cache.monotonic.return_value = 1200
+        stubber.add_response('get_object', _get_response(new_settings, '"v2"'),
+                             {'Bucket': bucket_name, 'Key': file_name, 'IfNoneMatch': '"v1"'})
+        assert conf.load_revalidated(conn, bucket_name, file_name, ttl=60) == new_settings
+        stubber.assert_no_pending_responses()
+
+    assert conf.revalidating_cache_stats == {'hits': 1, 'misses': 2, 'not_modified': 1}
+    assert conf.revalidating_cache[('bucket', 'conf.json')] == (new_settings, '"v2"', 1260)
+
+
+@pytest.mark.unit
+def test_load_revalidated_error(revalidating_cache):
+    s3 = botocore.session.get_session().create_client('s3')
+    conn = conf.conn(client=s3)
+
+    with Stubber(s3) as stubber:
+        stubber.add_response('get_object', _get_response({}, '"v1"'), {'Bucket': 'bucket', 'Key': 'conf.json'})
+        conf.load_revalidated(conn, 'bucket', 'conf.json', ttl=60)
+
+        revalidating_cache.monotonic.return_value = 2000
+        stubber.add_client_error('get_object', service_error_code='AccessDenied', http_status_code=403)
+        with pytest.raises(botocore.exceptions.ClientError):
+            conf.load_revalidated(conn, 'bucket', 'conf.json', ttl=60)
+
+
+@pytest.mark.unit
+def test_load_or_create_revalidated(revalidating_cache):
+    settings = {'setting_1': 'foo'}
+    s3 = botocore.session.get_session().create_client('s3')
+    conn = conf.conn(client=s3)
+
+    with Stubber(s3) as stubber:
+        stubber.add_client_error('get_object', service_error_code='NoSuchKey', http_status_code=404)
+        stubber.add_response('put_object', {'ETag': '"v1"'})
+        assert conf.load_or_create_revalidated(conn, 'bucket', 'conf.json', ttl=60) == {}
+
+        revalidating_cache.monotonic.return_value = 2000
+        stubber.add_response('get_object', _get_response(settings, '"v2"'))
+        assert conf.load_or_create_revalidated(conn, 'bucket', 'conf.json', ttl=60) == settings
+
+        # transient errors while revalidating serve the cached settings, and never write
+        revalidating_cache.monotonic.return_value = 3000
+        stubber.add_client_error('get_object', service_error_code='SlowDown', http_status_code=503)
+        assert conf.load_or_create_revalidated(conn, 'bucket', 'conf.json', ttl=60) == settings
+        stubber.assert_no_pending_responses()
+
+    conf.revalidating_cache.clear()
+    with Stubber(s3) as stubber:
+        stubber.add_client_error('get_object', service_error_code='SlowDown', http_status_code=503)
+        with pytest.raises(botocore.exceptions.ClientError):
+            conf.load_or_create_revalidated(conn, 'bucket', 'conf.json', ttl=60)
+
+
+@pytest.mark.unit
+def test_save_revalidated(revalidating_cache):
+    settings = {'setting_1': 'foo'}
+    s3 = botocore.session.get_session().create_client('s3')
+    conn = conf.conn(client=s3)
+
+    with Stubber(s3) as stubber:
+        put_parameters = {'Body': json.dumps(settings),
+                          'Bucket': 'bucket',
+                          'Key': 'conf.json',
+                          'ServerSideEncryption': 'AES256'}
+        stubber.add_response('put_object', {'ETag': '"v3"'}, put_parameters)
+        assert conf.save_revalidated(conn, 'bucket', 'conf.json', settings, ttl=60) == settings
+        assert conf.load_revalidated(conn, 'bucket', 'conf.json', ttl=60) == settings
+
+    assert conf.revalidating_cache[('bucket', 'conf.json')] == (settings, '"v3"', 1060)
+    assert conf.revalidating_cache_stats['hits'] == 1
+
+
+@pytest.mark.unit
+def test_refresh_in_background(mocker):
+    conf.revalidating_cache.clear()
+    settings = {'setting_1': 'foo'}
+    new_settings = {'setting_1': 'bar'}
+    s3 = mocker.Mock()
+    s3.get_object.side_effect = lambda **kwargs: _get_response(
+        new_settings if s3.get_object.call_count > 1 else settings, f'"v{s3.get_object.call_count}"')
+    conn = conf.conn(client=s3)
+
+    try:
+        assert conf.refresh_in_background(conn, 'bucket', 'refreshed.json', interval=0.01) == settings
+        for _ in range(100):
+            if conf.read_only(conn, 'bucket', 'refreshed.json') == new_settings:
+                break
+            time.sleep(0.01)
+        assert conf.read_only(conn, 'bucket', 'refreshed.json') == new_settings
+    finally:
+        conf.stop_background_refresh(timeout=1)
+        conf.read_only_cache.pop(('bucket', 'refreshed.json'), None)
+        conf.revalidating_cache.clear()
+
+    assert not conf._background['registered']
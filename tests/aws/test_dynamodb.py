@@ -2,12 +2,16 @@
 # Copyright (c) 2016-present, CloudZero, Inc. All rights reserved.
 # Licensed under the BSD-style license. See LICENSE file in the project root for full license information.
 
+import json
+import timeit
 
 import botocore.session
 import pytest
 from botocore.stub import Stubber
 
 import pyfaaster.aws.dynamodb as dyn
+import pyfaaster.aws.dynamodb_codec as codec
+import pyfaaster.common.concurrency as concurrency
 
 
 @pytest.mark.unit
@@ -50,3 +54,493 @@ def test_update_item_from_dict_reserved_words():
         attributes = {'AGGREGATE': 'Lloyd'}
         item = dyn.update_item_from_dict('test_table', {'id': '1'}, attributes, client)
         assert item == {'id': '1', 'name': 'Harry', 'AGGREGATE': 'Lloyd'}
+
+
+@pytest.mark.unit
+def test_update_item_from_dict_caches_expressions(mocker):
+    dyn.update_expression_cache.clear()
+    client = mocker.Mock()
+    client.update_item.return_value = {'Attributes': {'id': {'S': '1'}}}
+
+    dyn.update_item_from_dict('test_table', {'id': '1'}, {'best-friend': 'Lloyd', 'age': 30}, client)
+    dyn.update_item_from_dict('test_table', {'id': '2'}, {'best-friend': 'Harry', 'age': 31}, client)
+
+    assert len(dyn.update_expression_cache) == 1
+    first, second = [c[1] for c in client.update_item.call_args_list]
+    assert second['UpdateExpression'] == first['UpdateExpression'] == 'SET #bestfriend = :bestfriend, #age = :age'
+    assert second['ExpressionAttributeValues'] == {':bestfriend': {'S': 'Harry'}, ':age': {'N': '31'}}
+    assert second['ExpressionAttributeNames'] is not first['ExpressionAttributeNames']
+
+
+@pytest.mark.performance
+def test_update_item_from_dict_benchmark(mocker):
+    client = mocker.Mock()
+    client.update_item.return_value = {}
+    attributes = {f'attribute-{i}': i for i in range(20)}
+
+    def update():
+        dyn.update_item_from_dict('test_table', {'id': '1'}, attributes, client)
+
+    cached = min(timeit.repeat(update, number=1000, repeat=3))
+    uncached = min(timeit.repeat(lambda: (dyn.update_expression_cache.clear(), update()), number=1000, repeat=3))
+    print(f'uncached: {uncached:.4f}s, cached: {cached:.4f}s per 1000 updates ({uncached / cached:.2f}x)')
+    assert uncached / cached > 1.5
+
+
+def _put_requests(items):
+    return [{'PutRequest': {'Item': codec.serialize_item(item)}} for item in items]
+
+
+@pytest.mark.unit
+def test_batch_write(mocker):
+    sleep = mocker.patch('time.sleep')
+    client = botocore.session.get_session().create_client('dynamodb', region_name='us-east-1')
+    items = [{'id': str(i), 'n': i} for i in range(30)]
+    first, second = _put_requests(items[:25]), _put_requests(items[25:])
+    delete = {'DeleteRequest': {'Key': {'id': {'S': 'gone'}}}}
+
+    with Stubber(client) as stubber:
+        stubber.add_response('batch_write_item', {'UnprocessedItems': {'test_table': first[3:5]}},
+                             {'RequestItems': {'test_table': first}})
+        stubber.add_response('batch_write_item', {'UnprocessedItems': {}},
+                             {'RequestItems': {'test_table': first[3:5]}})
+        stubber.add_response('batch_write_item', {'UnprocessedItems': {'test_table': [delete]}},
+                             {'RequestItems': {'test_table': second + [delete]}})
+        stubber.add_response('batch_write_item', {'UnprocessedItems': {'test_table': [delete]}},
+                             {'RequestItems': {'test_table': [delete]}})
+
+        stats = dyn.batch_write('test_table', items, delete_keys=[{'id': 'gone'}], client=client, max_attempts=2)
+
+    assert stats['items'] == 31
+    assert stats['requests'] == 4
+    assert stats['retries'] == 2
+    assert stats['unprocessed_items'] == []
+    assert stats['unprocessed_keys'] == [{'id': 'gone'}]
+    assert sleep.call_count == 2
+
+
+@pytest.mark.unit
+def test_batch_write_concurrently(mocker):
+    client = mocker.Mock()
+    client.batch_write_item.return_value = {'UnprocessedItems': {}}
+
+    stats = dyn.batch_write('test_table', [{'id': str(i)} for i in range(100)], client=client, max_concurrency=4,
+                            key_names=['id'])
+
+    assert stats['requests'] == 4
+    written = [r for c in client.batch_write_item.call_args_list for r in c[1]['RequestItems']['test_table']]
+    assert sorted(r['PutRequest']['Item']['id']['S'] for r in written) == sorted(str(i) for i in range(100))
+
+
+@pytest.mark.unit
+def test_batch_write_deduplicates():
+    client = botocore.session.get_session().create_client('dynamodb', region_name='us-east-1')
+    items = [{'user': 'a', 'at': 1, 'n': 1}, {'at': 2, 'user': 'a'}, {'user': 'a', 'at': 1, 'n': 2},
+             {'user': 'b', 'at': 1}]
+
+    with Stubber(client) as stubber:
+        stubber.add_response('batch_write_item', {}, {'RequestItems': {'test_table': _put_requests(
+            [items[2], items[1], items[3]])}})
+        stubber.add_response('batch_write_item', {}, {'RequestItems': {'test_table': _put_requests(items)}})
+        stubber.add_response('batch_write_item', {}, {'RequestItems': {'test_table': [
+            {'DeleteRequest': {'Key': {'at': {'N': '1'}, 'user': {'S': 'a'}}}}]}})
+
+        assert dyn.batch_write('test_table', items, client=client, key_names=['user', 'at'])['duplicates'] == 1
+        # without key names (given or from delete keys), items to put are written as they are
+        assert dyn.batch_write('test_table', items, client=client)['duplicates'] == 0
+        stats = dyn.batch_write('test_table', items[:1], delete_keys=[{'at': 1, 'user': 'a'}], client=client)
+        stubber.assert_no_pending_responses()
+
+    assert stats['items'] == 1
+    assert stats['duplicates'] == 1
+
+
+@pytest.mark.unit
+def test_batch_get(mocker):
+    sleep = mocker.patch('time.sleep')
+    client = botocore.session.get_session().create_client('dynamodb', region_name='us-east-1')
+    keys = [{'id': str(i)} for i in reversed(range(105))]
+    first, second = [codec.serialize_item(k) for k in keys[:100]], [codec.serialize_item(k) for k in keys[100:]]
+
+    def response(found, unprocessed=None):
+        unprocessed = {'test_table': {'Keys': unprocessed}} if unprocessed else {}
+        return {'Responses': {'test_table': [codec.serialize_item(dict(k, n=int(k['id']))) for k in found]},
+                'UnprocessedKeys': unprocessed}
+
+    with Stubber(client) as stubber:
+        stubber.add_response('batch_get_item', response(keys[1:99], first[99:]),
+                             {'RequestItems': {'test_table': {'ConsistentRead': False, 'Keys': first}}})
+        stubber.add_response('batch_get_item', response(keys[99:100]),
+                             {'RequestItems': {'test_table': {'ConsistentRead': False, 'Keys': first[99:]}}})
+        stubber.add_response('batch_get_item', response(keys[100:]),
+                             {'RequestItems': {'test_table': {'ConsistentRead': False, 'Keys': second}}})
+
+        items = dyn.batch_get('test_table', keys[:3] + keys + keys[:3], client=client, max_concurrency=1)
+
+    assert list(items) == [k['id'] for k in keys]
+    assert items['104'] is None
+    assert items['5'] == {'id': '5', 'n': 5}
+    assert len(items) == 105
+    sleep.assert_called_once()
+
+
+@pytest.mark.unit
+def test_batch_get_composite_keys_and_unprocessed(mocker):
+    mocker.patch('time.sleep')
+    client = mocker.Mock()
+    keys = [{'user': 'a', 'at': 1}, {'at': 2, 'user': 'a'}, {'at': 1, 'user': 'a'}]
+    client.batch_get_item.return_value = {
+        'Responses': {'test_table': [codec.serialize_item({'x': 'y', 'at': 2, 'user': 'a'})]},
+        'UnprocessedKeys': {}}
+
+    assert dyn.batch_get('test_table', keys, client=client) == {(1, 'a'): None, (2, 'a'): {'user': 'a', 'at': 2, 'x': 'y'}}
+    assert len(client.batch_get_item.call_args[1]['RequestItems']['test_table']['Keys']) == 2
+
+    client.batch_get_item.return_value = {'UnprocessedKeys': {'test_table': {'Keys': [codec.serialize_item(keys[0])]}}}
+    with pytest.raises(dyn.UnprocessedKeysException) as error:
+        dyn.batch_get('test_table', keys, client=client, max_attempts=2)
+    assert error.value.keys == [keys[0]]
+
+
+@pytest.mark.unit
+def test_query_iter():
+    client = botocore.session.get_session().create_client('dynamodb', region_name='us-east-1')
+    query = {'TableName': 'test_table', 'KeyConditionExpression': 'id = :id',
+             'ExpressionAttributeValues': {':id': {'S': '1'}}}
+    last_key = {'id': {'S': '1'}, 'at': {'N': '2'}}
+
+    with Stubber(client) as stubber:
+        stubber.add_response('query', {'Items': [codec.serialize_item({'id': '1', 'at': i}) for i in (1, 2)],
+                                       'LastEvaluatedKey': last_key}, query)
+        stubber.add_response('query', {'Items': [codec.serialize_item({'id': '1', 'at': 3})]},
+                             dict(query, ExclusiveStartKey=last_key))
+        stubber.add_response('query', {'Items': [codec.serialize_item({'id': '1', 'at': 3})]},
+                             dict(query, ExclusiveStartKey=last_key))
+
+        items = dyn.query_iter('test_table', client=client, KeyConditionExpression='id = :id',
+                               ExpressionAttributeValues={':id': {'S': '1'}})
+        assert [item['at'] for item in items] == [1, 2, 3]
+
+        resumed = dyn.query_iter('test_table', client=client, pages=True, resume_token=last_key,
+                                 KeyConditionExpression='id = :id', ExpressionAttributeValues={':id': {'S': '1'}})
+        assert list(resumed) == [([{'id': '1', 'at': 3}], None)]
+
+
+def _fake_scan(pages_per_segment=3, fail_segment=None):
+    def scan(**kwargs):
+        segment = kwargs.get('Segment', 0)
+        if segment == fail_segment:
+            raise ValueError('scan failed')
+        page = int(kwargs['ExclusiveStartKey']['page']['N']) if 'ExclusiveStartKey' in kwargs else 0
+        response = {'Items': [codec.serialize_item({'id': f'{segment}-{page}-{i}'}) for i in range(2)]}
+        if page < pages_per_segment - 1:
+            response['LastEvaluatedKey'] = {'page': {'N': str(page + 1)}}
+        return response
+    return scan
+
+
+def _scanned(total_segments, pages_per_segment=3):
+    return sorted(f'{s}-{p}-{i}' for s in range(total_segments) for p in range(pages_per_segment) for i in range(2))
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('max_concurrency', [1, 2, None])
+def test_scan_iter_segments(mocker, max_concurrency):
+    client = mocker.Mock()
+    client.scan.side_effect = _fake_scan()
+
+    items = dyn.scan_iter('test_table', client=client, total_segments=4, max_concurrency=max_concurrency)
+    assert sorted(item['id'] for item in items) == _scanned(4)
+    assert all(c[1]['TotalSegments'] == 4 for c in client.scan.call_args_list)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('total_segments', [1, 3])
+def test_scan_iter_resume(mocker, total_segments):
+    client = mocker.Mock()
+    client.scan.side_effect = _fake_scan()
+
+    first = dyn.scan_iter('test_table', client=client, total_segments=total_segments, pages=True)
+    seen = []
+    for _ in range(total_segments + 1):
+        items, token = next(first)
+        seen.extend(item['id'] for item in items)
+    first.close()
+
+    token = json.loads(json.dumps(token))
+    for items, last in dyn.scan_iter('test_table', client=client, pages=True, resume_token=token):
+        seen.extend(item['id'] for item in items)
+    assert last is None
+    assert sorted(seen) == _scanned(total_segments)
+
+
+@pytest.mark.unit
+def test_scan_iter_interleaved(mocker):
+    client = mocker.Mock()
+    client.scan.side_effect = _fake_scan(pages_per_segment=20)
+
+    # the first scan's 16 workers block on its full queue while the others run
+    first = dyn.scan_iter('test_table', client=client, total_segments=16, pages=True)
+    next(first)
+    second = dyn.scan_iter('test_table', client=client, total_segments=2)
+    third = dyn.scan_iter('test_table', client=client, total_segments=2)
+    pairs = list(zip(second, third))
+    assert len(pairs) == len(_scanned(2, pages_per_segment=20))
+    first.close()
+
+
+@pytest.mark.unit
+def test_scan_iter_raises_segment_errors(mocker):
+    client = mocker.Mock()
+    client.scan.side_effect = _fake_scan(fail_segment=1)
+
+    with pytest.raises(ValueError):
+        list(dyn.scan_iter('test_table', client=client, total_segments=2))
+
+
+@pytest.mark.unit
+def test_bulk_update(mocker):
+    dyn.update_expression_cache.clear()
+    client = mocker.Mock()
+
+    def update_item(Key, ExpressionAttributeValues, **kwargs):
+        if Key['id']['S'] == 'bad':
+            raise Exception('conditional check failed')
+        return {'Attributes': dict(Key, **{k[1:]: v for k, v in ExpressionAttributeValues.items()})}
+
+    client.update_item.side_effect = update_item
+    updates = [({'id': str(i)}, {'n': i}) for i in range(20)] + [({'id': 'bad'}, {'n': 0}), ({'id': 'x'}, {'m': 's'})]
+
+    results = dyn.bulk_update('test_table', updates, client=client, max_concurrency=4)
+
+    assert [r['key'] for r in results] == [key for key, _ in updates]
+    assert results[5] == {'key': {'id': '5'}, 'success': True, 'item': {'id': '5', 'n': 5}}
+    assert not results[20]['success'] and str(results[20]['error']) == 'conditional check failed'
+    assert results[21]['item'] == {'id': 'x', 'm': 's'}
+    assert len(dyn.update_expression_cache) == 2
+
+
+@pytest.mark.unit
+def test_diff_update_expressions_nested():
+    old = {'m': {'l': [1, 'a', {'x': 'y'}], 'gone': 'z'}, 'tags': {'a', 'b'}, 'flag': 1, 'same': 'same', 'n': 5}
+    new = {'m': {'l': [1, 'b', {'x': 'y', 'w': 2}], 'added': 'q'}, 'tags': {'b', 'c'}, 'flag': True, 'same': 'same',
+           'n': 3}
+
+    [expression] = dyn.diff_update_expressions(old, new)
+    names = {v: k for k, v in expression['ExpressionAttributeNames'].items()}
+    assert expression['UpdateExpression'] == (
+        'REMOVE {m}.{gone} '
+        'SET {m}.{l}[1] = :v0, {m}.{l}[2].{w} = :v1, {m}.{added} = :v2, {tags} = :v3, {flag} = :v4 '
+        'ADD {n} :v5').format(**names)
+    values = expression['ExpressionAttributeValues']
+    assert sorted(values.pop(':v3')['SS']) == ['b', 'c']
+    assert values == {':v0': {'S': 'b'}, ':v1': {'N': '2'}, ':v2': {'S': 'q'}, ':v4': {'BOOL': True},
+                      ':v5': {'N': '-2'}}
+
+
+@pytest.mark.unit
+def test_diff_update_expressions_sets():
+    old = {'added': {'a'}, 'deleted': {'a', 'b'}, 'emptied': {'a'}, 'm': {'emptied': {1}}}
+    new = {'added': {'a', 'b'}, 'deleted': {'a'}, 'emptied': set(), 'm': {'emptied': set()}, 'new': set()}
+
+    [expression] = dyn.diff_update_expressions(old, new)
+    assert expression['UpdateExpression'] == 'ADD #n0 :v0 DELETE #n1 :v1 REMOVE #n2, #n3.#n2'
+    assert expression['ExpressionAttributeNames'] == {'#n0': 'added', '#n1': 'deleted', '#n2': 'emptied',
+                                                      '#n3': 'm'}
+    assert expression['ExpressionAttributeValues'] == {':v0': {'SS': ['b']}, ':v1': {'SS': ['b']}}
+
+
+@pytest.mark.unit
+def test_diff_update_expressions_numbers():
+    old, new = {'n': 1, 'm': {'count': 10}}, {'n': 4, 'm': {'count': 7}}
+
+    [added] = dyn.diff_update_expressions(old, new)
+    assert added['UpdateExpression'] == 'ADD #n0 :v0 SET #n1.#n2 = #n1.#n2 + :v1'
+    assert added['ExpressionAttributeValues'] == {':v0': {'N': '3'}, ':v1': {'N': '-3'}}
+
+    [assigned] = dyn.diff_update_expressions(old, new, numeric_add=False)
+    assert assigned['UpdateExpression'] == 'SET #n0 = :v0, #n1.#n2 = :v1'
+    assert assigned['ExpressionAttributeValues'] == {':v0': {'N': '4'}, ':v1': {'N': '7'}}
+
+    assert dyn.diff_update_expressions(old, old) == []
+
+
+@pytest.mark.unit
+def test_diff_update_expressions_splits():
+    old = {f'attribute-{i}': 'old' for i in range(500)}
+    new = {k: 'new' for k in old}
+
+    expressions = dyn.diff_update_expressions(old, new)
+    assert len(expressions) > 1
+    updated = set()
+    for expression in expressions:
+        assert len(expression['UpdateExpression']) <= dyn.MAX_EXPRESSION_BYTES
+        assert len(expression['ExpressionAttributeValues']) <= dyn.MAX_EXPRESSION_ACTIONS
+        updated.update(expression['ExpressionAttributeNames'].values())
+    assert updated == set(old)
+
+
+@pytest.mark.unit
+def test_update_item_diff():
+    client = botocore.session.get_session().create_client('dynamodb', region_name='us-east-1')
+    old = {'id': '1', 'profile': {'name': 'Harry', 'age': 30}}
+    new = {'id': '1', 'profile': {'name': 'Harry', 'age': 31}}
+
+    with Stubber(client) as stubber:
+        stubber.add_response('update_item', {'Attributes': codec.serialize_item(new)}, {
+            'TableName': 'test_table',
+            'Key': {'id': {'S': '1'}},
+            'UpdateExpression': 'SET #n0.#n1 = #n0.#n1 + :v0',
+            'ExpressionAttributeNames': {'#n0': 'profile', '#n1': 'age'},
+            'ExpressionAttributeValues': {':v0': {'N': '1'}},
+            'ReturnValues': 'ALL_NEW'})
+
+        assert dyn.update_item_diff('test_table', {'id': '1'}, old, new, client=client) == new
+        assert dyn.update_item_diff('test_table', {'id': '1'}, old, old, client=client) is None
+
+
+@pytest.mark.unit
+def test_counter_buffer_coalesces_increments(mocker):
+    client = mocker.Mock()
+    counters = dyn.CounterBuffer(client=client)
+
+    for hour in ('00', '01', '00', '00'):
+        counters.increment('usage', {'tenant': 'a', 'hour': hour}, 'requests')
+        counters.increment('usage', {'hour': hour, 'tenant': 'a'}, 'bytes', 100)
+    counters.increment('usage', {'tenant': 'b', 'hour': '00'}, 'requests', 0)
+    assert len(counters) == 3
+
+    assert counters.flush() == 2
+    assert len(counters) == 0
+    updates = sorted((c[1] for c in client.update_item.call_args_list), key=lambda u: u['Key']['hour']['S'])
+    assert updates[0] == {
+        'TableName': 'usage',
+        'Key': {'hour': {'S': '00'}, 'tenant': {'S': 'a'}},
+        'UpdateExpression': 'ADD #a0 :a0, #a1 :a1',
+        'ExpressionAttributeNames': {'#a0': 'requests', '#a1': 'bytes'},
+        'ExpressionAttributeValues': {':a0': {'N': '3'}, ':a1': {'N': '300'}},
+    }
+    assert updates[1]['ExpressionAttributeValues'] == {':a0': {'N': '1'}, ':a1': {'N': '100'}}
+    assert counters.flush() == 0
+
+
+@pytest.mark.unit
+def test_counter_buffer_flushes_at_max_keys(mocker):
+    client = mocker.Mock()
+    counters = dyn.CounterBuffer(client=client, max_keys=3)
+
+    for i in range(7):
+        counters.increment('usage', {'tenant': str(i)}, 'requests')
+    assert client.update_item.call_count == 6
+    assert len(counters) == 1
+
+
+@pytest.mark.unit
+def test_counter_buffer_keeps_failed_increments(mocker):
+    client = mocker.Mock()
+    client.update_item.side_effect = Exception('throttled')
+    counters = dyn.CounterBuffer(client=client)
+    counters.increment('usage', {'tenant': 'a'}, 'requests')
+
+    with pytest.raises(concurrency.ConcurrentExecutionError):
+        counters.flush()
+    assert len(counters) == 1
+
+    client.update_item.side_effect = None
+    counters.increment('usage', {'tenant': 'a'}, 'requests')
+    assert counters.flush() == 1
+    assert client.update_item.call_args[1]['ExpressionAttributeValues'] == {':a0': {'N': '2'}}
+    assert len(counters) == 0
+
+
+@pytest.fixture(scope='function')
+def item_client(mocker):
+    client = mocker.Mock()
+    items = {'1': {'id': '1', 'name': 'Harry'}}
+    client.get_item.side_effect = lambda TableName, Key, ConsistentRead: (
+        {'Item': codec.serialize_item(items[Key['id']['S']])} if Key['id']['S'] in items else {})
+    return client
+
+
+@pytest.mark.unit
+def test_item_cache(item_client, mocker):
+    now = mocker.patch('time.monotonic', return_value=1000)
+    cache = dyn.ItemCache(ttl=60, table_ttls={'short': 5}, negative_ttl=1, client=item_client)
+
+    for _ in range(3):
+        assert cache.get('tenants', {'id': '1'}) == {'id': '1', 'name': 'Harry'}
+        assert cache.get('tenants', {'id': 'missing'}) is None
+    assert cache.get('short', {'id': '1'})['name'] == 'Harry'
+    assert cache.stats == {'hits': 2, 'misses': 3, 'negative_hits': 2}
+
+    now.return_value = 1002
+    cache.get('tenants', {'id': '1'})
+    cache.get('tenants', {'id': 'missing'})
+    now.return_value = 1006
+    cache.get('short', {'id': '1'})
+    assert cache.stats == {'hits': 3, 'misses': 5, 'negative_hits': 2}
+    assert item_client.get_item.call_count == 5
+
+    cache.invalidate('tenants', {'id': '1'})
+    cache.get('tenants', {'id': '1'})
+    assert item_client.get_item.call_count == 6
+
+
+@pytest.mark.unit
+def test_item_cache_lru(item_client):
+    cache = dyn.ItemCache(maxsize=2, client=item_client)
+    for key in ('1', 'a', 'b', '1'):
+        cache.get('tenants', {'id': key})
+    assert item_client.get_item.call_count == 4
+
+
+@pytest.mark.unit
+def test_item_cache_write_through(item_client, mocker):
+    cache = dyn.ItemCache(client=item_client)
+    other = dyn.ItemCache(client=item_client)
+    cache.get('tenants', {'id': '1'})
+    item_client.update_item.return_value = {'Attributes': codec.serialize_item({'id': '1', 'name': 'Lloyd'})}
+
+    dyn.update_item_from_dict('tenants', {'id': '1'}, {'name': 'Lloyd'}, item_client)
+    assert cache.get('tenants', {'id': '1'}) == {'id': '1', 'name': 'Lloyd'}
+    assert item_client.get_item.call_count == 1
+    assert len(other._items) == 0
+
+    counters = dyn.CounterBuffer(client=item_client)
+    counters.increment('tenants', {'id': '1'}, 'logins')
+    counters.flush()
+    cache.get('tenants', {'id': '1'})
+    assert item_client.get_item.call_count == 2
+
+
+@pytest.mark.unit
+def test_item_cache_skips_reads_racing_writes(item_client):
+    cache = dyn.ItemCache(client=item_client)
+    item_client.update_item.return_value = {'Attributes': codec.serialize_item({'id': '1', 'name': 'Lloyd'})}
+    read = item_client.get_item.side_effect
+
+    def get_item_then_write(**kwargs):
+        response = read(**kwargs)
+        dyn.update_item_from_dict('tenants', {'id': '1'}, {'name': 'Lloyd'}, item_client)
+        return response
+
+    item_client.get_item.side_effect = get_item_then_write
+    assert cache.get('tenants', {'id': '1'})['name'] == 'Harry'
+    item_client.get_item.side_effect = read
+    cache.get('tenants', {'id': '1'})
+    assert item_client.get_item.call_count == 2
+    assert not cache._loading
+
+
+@pytest.mark.unit
+def test_item_cache_batch_write(item_client):
+    cache = dyn.ItemCache(client=item_client)
+    item_client.batch_write_item.return_value = {}
+    cache.get('tenants', {'id': '1'})
+    cache.get('tenants', {'id': 'missing'})
+
+    dyn.batch_write('tenants', items=[{'id': '1', 'name': 'Lloyd'}], delete_keys=[{'id': 'missing'}],
+                    client=item_client)
+    cache.get('tenants', {'id': '1'})
+    cache.get('tenants', {'id': 'missing'})
+    assert item_client.get_item.call_count == 4
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016-present, CloudZero, Inc. All rights reserved.
+# Licensed under the BSD-style license. See LICENSE file in the project root for full license information.
+
+from decimal import Decimal
+import timeit
+
+from boto3.dynamodb.types import DYNAMODB_CONTEXT, TypeDeserializer, TypeSerializer
+from hypothesis import given, strategies as st
+import pytest
+
+import pyfaaster.aws.dynamodb as dyn
+import pyfaaster.aws.dynamodb_codec as codec
+
+boto_serializer = TypeSerializer()
+boto_deserializer = TypeDeserializer()
+
+
+def _dynamodb_decimal(d):
+    try:
+        DYNAMODB_CONTEXT.create_decimal(d)
+        return True
+    except ArithmeticError:
+        return False
+
+
+numbers = st.one_of(
+    st.integers(min_value=-10 ** 38 + 1, max_value=10 ** 38 - 1),
+    st.decimals(allow_nan=False, allow_infinity=False).filter(_dynamodb_decimal),
+)
+scalars = st.one_of(st.none(), st.booleans(), st.text(), numbers, st.binary(min_size=1))
+sets = st.one_of(
+    st.frozensets(st.text(), min_size=1).map(set),
+    st.frozensets(st.integers(min_value=-10 ** 6, max_value=10 ** 6), min_size=1).map(set),
+)
+values = st.recursive(
+    st.one_of(scalars, sets),
+    lambda children: st.one_of(st.lists(children, max_size=5), st.dictionaries(st.text(), children, max_size=5)),
+    max_leaves=20,
+)
+items = st.dictionaries(st.text(min_size=1), values, max_size=10)
+
+
+@pytest.mark.unit
+@given(values)
+def test_serialize_matches_boto3(value):
+    assert codec.serialize(value) == boto_serializer.serialize(value)
+
+
+@pytest.mark.unit
+@given(items)
+def test_deserialize_matches_boto3(item):
+    serialized = {k: boto_serializer.serialize(v) for k, v in item.items()}
+    expected = {k: boto_deserializer.deserialize(v) for k, v in serialized.items()}
+
+    deserialized = codec.deserialize_item(serialized)
+    assert deserialized == expected
+    assert [type(v) for v in deserialized.values()] == [type(v) for v in expected.values()]
+    assert codec.deserialize_items([serialized, serialized]) == [expected, expected]
+    assert codec.deserialize_item(codec.serialize_item(deserialized)) == expected
+
+
+@pytest.mark.unit
+@given(st.one_of(st.floats(min_value=-1e100, max_value=1e100).filter(lambda f: f == 0 or abs(f) > 1e-100),
+                 st.integers(min_value=-10 ** 38 + 1, max_value=10 ** 38 - 1)))
+def test_floats_round_trip(number):
+    value = {'n': number, 'l': [number], 's': {number}}
+    deserialized = codec.deserialize(codec.serialize(value, floats=True), floats=True)
+    assert deserialized == value
+    assert isinstance(deserialized['n'], (int, float))
+
+
+@pytest.mark.unit
+def test_serialize_rejects_what_boto3_rejects():
+    for value in (1.5, {'nested': [1.5]}, Decimal('NaN'), 10 ** 40, object()):
+        with pytest.raises((TypeError, ArithmeticError)):
+            codec.serialize(value)
+    with pytest.raises(TypeError):
+        codec.serialize(float('nan'), floats=True)
+
+
+@pytest.mark.unit
+@given(values)
+def test_module_serializer_and_deserializer(value):
+    serialized = dyn.serializer.serialize(value)
+    assert serialized == boto_serializer.serialize(value)
+    assert dyn.deserializer.deserialize(serialized) == boto_deserializer.deserialize(serialized)
+
+
+@pytest.mark.performance
+def test_deserialize_benchmark():
+    item = {f'attribute-{i}': {'S': 'value'} if i % 2 else {'N': str(i * 1.5)} for i in range(50)}
+    item['nested'] = {'M': {'a': {'L': [{'N': '1'}, {'S': 'b'}, {'BOOL': True}]}}}
+    page = [item] * 100
+
+    boto = min(timeit.repeat(lambda: [{k: boto_deserializer.deserialize(v) for k, v in i.items()} for i in page],
+                             number=10, repeat=3))
+    fast = min(timeit.repeat(lambda: codec.deserialize_items(page), number=10, repeat=3))
+    floats = min(timeit.repeat(lambda: codec.deserialize_items(page, floats=True), number=10, repeat=3))
+    print(f'boto3: {boto:.4f}s, codec: {fast:.4f}s ({boto / fast:.2f}x), '
+          f'codec with floats: {floats:.4f}s ({boto / floats:.2f}x) per 1000 items')
+    assert boto / fast > 1.5
+    assert boto / floats > 1.5
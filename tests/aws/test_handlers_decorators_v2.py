@@ -654,3 +654,182 @@ def test_catch_exceptions():
         throws_exception()
     except Exception:
         pytest.fail("The catch_exceptions decorator didn't do its job! You had one job ... one job!")
+
+
+@pytest.mark.unit
+def test_configuration_aware_ttl(context, mocker):
+    settings = {'setting': 'value'}
+    mocker.patch('pyfaaster.aws.configuration.conn', return_value={'client': None, 'encrypt_key_arn': None})
+    load = mocker.patch('pyfaaster.aws.configuration.load')
+    load_revalidated = mocker.patch('pyfaaster.aws.configuration.load_revalidated', return_value=settings)
+    save_revalidated = mocker.patch('pyfaaster.aws.configuration.save_revalidated')
+
+    @decs.configuration_aware('config.json', ttl=30)
+    def handler(event, context, configuration=None, **kwargs):
+        configuration['save']({'new': 'settings'})
+        return configuration['load']()
+
+    assert handler({}, None) == settings
+    load.assert_not_called()
+    load_revalidated.assert_called_once_with(mocker.ANY, _CONFIG_BUCKET, 'config.json', 30)
+    save_revalidated.assert_called_once_with(mocker.ANY, _CONFIG_BUCKET, 'config.json', {'new': 'settings'}, ttl=30)
+
+
+def _sns_event(*messages, topic_arn='arn:aws:sns:anything'):
+    return {
+        'Records': [
+            {
+                'Sns': {
+                    'MessageId': f'id-{i}',
+                    'TopicArn': topic_arn,
+                    'Message': message if isinstance(message, str) else json.dumps(message),
+                },
+            }
+            for i, message in enumerate(messages)
+        ],
+    }
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('max_concurrency', [None, 4])
+def test_subscriber_batch_list(context, max_concurrency):
+    event = _sns_event({'n': 0}, 'not json', {'n': 2})
+
+    @decs.subscriber(batch='list', max_concurrency=max_concurrency)
+    def handler(event, context, messages, **kwargs):
+        return messages
+
+    response = handler(event, None)
+    assert response['result'] == [{'n': 0}, {'n': 2}]
+    [failed] = response['failed_records']
+    assert failed['index'] == 1
+    assert failed['MessageId'] == 'id-1'
+    assert 'not decode' in failed['error']
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('max_concurrency', [None, 4])
+def test_subscriber_batch_each(context, max_concurrency):
+    event = _sns_event({'n': 0}, {'n': 1}, {'n': 2}, {'n': 3})
+
+    @decs.subscriber(batch='each', max_concurrency=max_concurrency)
+    def handler(event, context, message, **kwargs):
+        if message['n'] == 2:
+            raise Exception('boom')
+        return message['n']
+
+    response = handler(event, None)
+    assert response['results'] == [0, 1, None, 3]
+    assert [(f['index'], f['MessageId'], f['error']) for f in response['failed_records']] == [(2, 'id-2', 'boom')]
+
+
+@pytest.mark.unit
+def test_subscriber_batch_required_topic(context):
+    event = _sns_event({'n': 0}, topic_arn='arn:aws:sns:region:account:other-topic')
+
+    @decs.subscriber(required_topics=['must-match'], batch='each')
+    def handler(event, context, message, **kwargs):
+        return message
+
+    response = handler(event, None)
+    assert response['results'] == [None]
+    assert 'not from expected topic' in response['failed_records'][0]['error']
+
+
+@pytest.mark.unit
+def test_subscriber_batch_unsupported_mode():
+    with pytest.raises(ValueError):
+        decs.subscriber(batch='all')
+
+
+def _sqs_event(*bodies, queue='arn:aws:sqs:us-east-1:123456789012:queue'):
+    return {
+        'Records': [
+            {
+                'messageId': f'id-{i}',
+                'eventSource': 'aws:sqs',
+                'eventSourceARN': queue,
+                'body': body if isinstance(body, str) else json.dumps(body),
+            }
+            for i, body in enumerate(bodies)
+        ],
+    }
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('max_concurrency', [None, 4])
+def test_sqs_consumer(context, max_concurrency):
+    sns_wrapped = {'Type': 'Notification', 'TopicArn': 'arn:aws:sns:anything', 'Message': json.dumps({'n': 3})}
+    event = _sqs_event({'n': 0}, 'not json', {'n': 2}, sns_wrapped, {'n': 4})
+    seen = []
+
+    @decs.sqs_consumer(max_concurrency=max_concurrency)
+    def handler(event, context, message, **kwargs):
+        if message['n'] == 2:
+            raise Exception('boom')
+        seen.append(message)
+
+    response = handler(event, None)
+    assert response == {'batchItemFailures': [{'itemIdentifier': 'id-1'}, {'itemIdentifier': 'id-2'}]}
+    assert sorted(m['n'] for m in seen) == [0, 3, 4]
+
+
+@pytest.mark.unit
+def test_sqs_consumer_fifo_stops_at_first_failure(context):
+    event = _sqs_event({'n': 0}, {'n': 1}, {'n': 2}, queue='arn:aws:sqs:us-east-1:123456789012:queue.fifo')
+    seen = []
+
+    @decs.sqs_consumer(max_concurrency=4)
+    def handler(event, context, message, **kwargs):
+        if message['n'] == 1:
+            raise Exception('boom')
+        seen.append(message['n'])
+
+    response = handler(event, None)
+    assert response == {'batchItemFailures': [{'itemIdentifier': 'id-1'}, {'itemIdentifier': 'id-2'}]}
+    assert seen == [0]
+
+
+@pytest.mark.unit
+def test_sqs_consumer_event_not_sqs_format(context):
+    @decs.sqs_consumer()
+    def handler(event, context, message, **kwargs):
+        return message
+
+    with pytest.raises(Exception) as err:
+        handler({'message': 'hi'}, None)
+    assert 'Unsupported' in str(err.value)
+
+
+@pytest.mark.unit
+def test_counters_aware(context, mocker):
+    update_item = mocker.patch('pyfaaster.aws.clients.client').return_value.update_item
+
+    @decs.counters_aware()
+    def handler(event, context, counters, **kwargs):
+        for tenant in event['tenants']:
+            counters.increment('usage', {'tenant': tenant}, 'requests')
+        if event.get('fail'):
+            raise Exception('boom')
+        return 'done'
+
+    assert handler({'tenants': ['a', 'b', 'a']}, None) == 'done'
+    assert update_item.call_count == 2
+
+    with pytest.raises(Exception):
+        handler({'tenants': ['a'], 'fail': True}, None)
+    assert update_item.call_count == 2
+
+
+@pytest.mark.unit
+def test_item_cache_aware(context, mocker):
+    get_item = mocker.patch('pyfaaster.aws.clients.client').return_value.get_item
+    get_item.return_value = {'Item': {'id': {'S': '1'}}}
+
+    @decs.item_cache_aware(ttl=300)
+    def handler(event, context, item_cache, **kwargs):
+        return item_cache.get('tenants', {'id': event['tenant']})
+
+    assert handler({'tenant': '1'}, None) == {'id': '1'}
+    assert handler({'tenant': '1'}, None) == {'id': '1'}
+    assert get_item.call_count == 1
@@ -0,0 +1,174 @@
+# Copyright (c) 2016-present, CloudZero, Inc. All rights reserved.
+# Licensed under the BSD-style license. See LICENSE file in the project root for full license information.
+
+import logging
+import os
+import timeit
+
+import pytest
+
+import pyfaaster.aws.dynamodb as dynamodb
+from pyfaaster.aws.exceptions import HTTPResponseException
+import pyfaaster.aws.handlers_decorators_v2 as decs
+import pyfaaster.aws.handlers_pipeline as pipe
+from tests.aws.common import MockContext
+
+_CONFIG_BUCKET = 'example_config_bucket'
+
+
+@pytest.fixture(scope='function')
+def context(mocker):
+    orig_env = os.environ.copy()
+    os.environ['NAMESPACE'] = 'test-ns'
+    os.environ['CONFIG'] = _CONFIG_BUCKET
+    os.environ['ENCRYPT_KEY_ARN'] = 'arn'
+    os.environ.pop('PAUSE', None)
+
+    yield MockContext('arn:aws:lambda:us-east-1:123456789012', function_name='module.do_the_thing')
+    mocker.stopall()
+    os.environ = orig_env
+
+
+def identity_handler(event, context, configuration=None, **kwargs):
+    kwargs['configuration'] = configuration['load']() if configuration else None
+    return {
+        'body': {
+            'event': event,
+            'kwargs': kwargs,
+        },
+    }
+
+
+def failing_handler(event, context, **kwargs):
+    raise Exception('boom')
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('event', [
+    {},
+    {'headers': {'Origin': 'https://good.com'}},
+    {'headers': {'Origin': 'https://bad.com'}},
+    {'detail-type': 'Scheduled Event', 'source': 'aws.events'},
+])
+@pytest.mark.parametrize('handler', [identity_handler, failing_handler])
+def test_pipeline_matches_decorators(context, event, handler):
+    decorated = decs.http_response('oops')(
+        decs.allow_origin_response('https://good.com')(
+            decs.account_id_aware(
+                decs.region_aware(
+                    decs.environ_aware(['NAMESPACE'], ['FOO'])(
+                        decs.pingable(handler))))))
+    piped = pipe.pipeline(handler, [
+        pipe.http_response('oops'),
+        pipe.allow_origin_response('https://good.com'),
+        pipe.account_id_aware,
+        pipe.region_aware,
+        pipe.environ_aware(['NAMESPACE'], ['FOO']),
+        pipe.pingable,
+    ])
+
+    assert piped(dict(event), context) == decorated(dict(event), context)
+
+
+@pytest.mark.unit
+def test_pipeline_short_circuit_skips_inner_steps(context):
+    calls = []
+    outer = pipe.Step('outer', after=lambda e, c, ks, r: calls.append('outer') or r)
+    inner = pipe.Step('inner', after=lambda e, c, ks, r: calls.append('inner') or r)
+
+    handler = pipe.pipeline(identity_handler, [outer, pipe.pingable, inner])
+    response = handler({'detail-type': 'Scheduled Event', 'source': 'aws.events'}, context)
+
+    assert response == 'info: ping'
+    assert calls == ['outer']
+
+
+@pytest.mark.unit
+def test_pipeline_raises_unhandled_errors(context):
+    handler = pipe.pipeline(identity_handler, [pipe.environ_aware(['MISSING'])])
+
+    with pytest.raises(HTTPResponseException) as err:
+        handler({}, context)
+    assert 'MISSING' in err.value.body
+
+
+@pytest.mark.unit
+def test_pipeline_catch_exceptions(context):
+    handler = pipe.pipeline(failing_handler, [pipe.catch_exceptions])
+    assert handler({}, context) is None
+
+
+@pytest.mark.unit
+def test_pipeline_pausable(context):
+    os.environ['PAUSE'] = 'true'
+    handler = pipe.pipeline(identity_handler, [pipe.http_response(), pipe.pausable])
+    assert handler({}, context) == decs.http_response()(decs.pausable(identity_handler))({}, context)
+
+
+@pytest.mark.unit
+def test_pipeline_counters_aware(context, mocker):
+    update_item = mocker.patch('pyfaaster.aws.clients.client').return_value.update_item
+
+    def counting_handler(event, context, counters, **kwargs):
+        counters.increment('usage', {'tenant': 'a'}, 'requests')
+        counters.increment('usage', {'tenant': 'a'}, 'requests')
+
+    pipe.pipeline(counting_handler, [pipe.counters_aware()])({}, context)
+    assert update_item.call_args[1]['ExpressionAttributeValues'] == {':a0': {'N': '2'}}
+
+
+@pytest.mark.unit
+def test_pipeline_item_cache_aware(context):
+    cache = dynamodb.ItemCache()
+    handler = pipe.pipeline(lambda event, context, item_cache, **kwargs: item_cache, [pipe.item_cache_aware(cache)])
+    assert handler({}, context) is cache
+
+
+@pytest.mark.unit
+def test_pipeline_client_config_aware_logs_handler_name(context, mocker):
+    info = mocker.patch.object(pipe.logger, 'info')
+    event = {'headers': {'User-Agent': 'pytest', 'X-Forwarded-For': '127.0.0.1'}}
+
+    pipe.pipeline(identity_handler, [pipe.client_config_aware])(event, context)
+    message, *args = info.call_args[0]
+    assert (message % tuple(args)).startswith(f'{identity_handler.__name__} | ')
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('handler', [identity_handler, failing_handler])
+def test_pipeline_default_matches_decorators(context, mocker, handler):
+    settings = {'setting': 'value'}
+    mocker.patch('pyfaaster.aws.configuration.conn', return_value={'client': None, 'encrypt_key_arn': None})
+    mocker.patch('pyfaaster.aws.configuration.load_or_create', return_value=settings)
+
+    event = {'headers': {'User-Agent': 'pytest', 'X-Forwarded-For': '127.0.0.1'}}
+    assert pipe.default()(handler)(event, context) == decs.default()(handler)(event, context)
+
+
+@pytest.mark.performance
+def test_pipeline_benchmark(context):
+    decorated = decs.http_response()(
+        decs.account_id_aware(
+            decs.client_config_aware(
+                decs.environ_aware(['NAMESPACE', 'CONFIG'], ['ENCRYPT_KEY_ARN'])(
+                    decs.pingable(identity_handler)))))
+    piped = pipe.pipeline(identity_handler, [
+        pipe.http_response(),
+        pipe.account_id_aware,
+        pipe.client_config_aware,
+        pipe.environ_aware(['NAMESPACE', 'CONFIG'], ['ENCRYPT_KEY_ARN']),
+        pipe.pingable,
+    ])
+    event = {'headers': {'User-Agent': 'pytest', 'X-Forwarded-For': '127.0.0.1'}}
+    assert piped(event, context) == decorated(event, context)
+
+    # time the middleware, not the log handler both write the same records to
+    level = decs.logger.level
+    decs.logger.setLevel(logging.WARNING)
+    try:
+        decorated_time = min(timeit.repeat(lambda: decorated(event, context), number=1000, repeat=7))
+        piped_time = min(timeit.repeat(lambda: piped(event, context), number=1000, repeat=7))
+    finally:
+        decs.logger.setLevel(level)
+    print(f'decorators: {decorated_time:.4f}s, pipeline: {piped_time:.4f}s per 1000 invocations')
+    assert piped_time < decorated_time
@@ -0,0 +1,99 @@
+# Copyright (c) 2016-present, CloudZero, Inc. All rights reserved.
+# Licensed under the BSD-style license. See LICENSE file in the project root for full license information.
+
+import os
+
+import pytest
+
+from pyfaaster.aws.exceptions import HTTPResponseException
+import pyfaaster.aws.handlers_decorators_v2 as decs
+import pyfaaster.aws.instrumentation as instrumentation
+from tests.aws.common import MockContext
+
+
+@pytest.fixture(scope='function')
+def records():
+    records = []
+    hook = records.append
+    instrumentation.add_hook(hook)
+    yield records
+    instrumentation.remove_hook(hook)
+    instrumentation.disable()
+
+
+def handler(event, context, **kwargs):
+    return {'body': kwargs}
+
+
+@pytest.mark.unit
+def test_disabled_returns_plain_wrappers(records):
+    instrumentation.disable()
+    decorated = decs.account_id_aware(handler)
+
+    assert not hasattr(decorated, '_pyfaaster_layer')
+    decorated({}, MockContext('arn:aws:lambda:us-east-1:123456789012'))
+    assert records == []
+
+
+@pytest.mark.unit
+def test_records_each_layer(records):
+    instrumentation.enable()
+    decorated = decs.http_response()(decs.account_id_aware(decs.pingable(handler)))
+
+    response = decorated({}, MockContext('arn:aws:lambda:us-east-1:123456789012'))
+    assert response['statusCode'] == 200
+
+    [invocation] = records
+    assert [(r['layer'], r['depth']) for r in invocation] == [
+        ('http_response', 0), ('account_id_aware', 1), ('pingable', 2), ('handler', 3)]
+    for outer, inner in zip(invocation, invocation[1:]):
+        assert outer['duration_ms'] >= inner['duration_ms']
+        assert outer['self_ms'] == pytest.approx(outer['duration_ms'] - inner['duration_ms'])
+
+
+@pytest.mark.unit
+def test_records_allocations(records):
+    instrumentation.enable(allocations=True)
+
+    @decs.account_id_aware
+    def allocating_handler(event, context, **kwargs):
+        return {'body': bytearray(100000)}
+
+    allocating_handler({}, MockContext('arn:aws:lambda:us-east-1:123456789012'))
+
+    [[outer, inner]] = records
+    assert inner['allocated_bytes'] >= 100000
+    assert outer['allocated_bytes'] >= inner['allocated_bytes']
+
+
+@pytest.mark.unit
+def test_records_failed_invocations(records):
+    instrumentation.enable()
+    os.environ.pop('PAUSE_TEST_MISSING', None)
+    decorated = decs.environ_aware(['PAUSE_TEST_MISSING'])(handler)
+
+    with pytest.raises(HTTPResponseException):
+        decorated({}, None)
+    assert [r['layer'] for r in records[0]] == ['environ_aware']
+
+
+@pytest.mark.unit
+def test_publisher_layers(records, mocker):
+    instrumentation.enable()
+    mocker.patch.dict(os.environ, {'NAMESPACE': 'test-ns'})
+    mocker.patch('pyfaaster.aws.publish.conn')
+    mocker.patch('pyfaaster.aws.publish.publish')
+
+    decs.publisher(handler)({}, MockContext('arn:aws:lambda:us-east-1:123456789012'))
+
+    assert [r['layer'] for r in records[0]] == [
+        'account_id_aware', 'environ_aware', 'region_aware', 'publisher', 'handler']
+
+
+@pytest.mark.unit
+def test_log_line(records, mocker):
+    instrumentation.enable(log=True)
+    info = mocker.patch.object(instrumentation.logger, 'info')
+
+    decs.pingable(handler)({}, None)
+    assert 'pyfaaster_layers' in info.call_args[0][0]
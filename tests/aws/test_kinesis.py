@@ -2,9 +2,24 @@
 # Copyright (c) 2016-present, CloudZero, Inc. All rights reserved.
 # Licensed under the BSD-style license. See LICENSE file in the project root for full license information.
 
+import base64
+import gzip
+import hashlib
+import json
+import os
+import timeit
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import botocore.exceptions
+import botocore.session
+from botocore.stub import Stubber
 import pytest
 
 import pyfaaster.aws.kinesis as kinesis
+import pyfaaster.common.concurrency as concurrency
 
 
 @pytest.mark.unit
@@ -27,3 +42,381 @@ def test_decode_records_with_transform():
     records = [{'kinesis': {'data': s64}}]
     [actual] = kinesis.decode_records(records, transform_fn=lambda s: s.upper())
     assert actual == 'PHENOMENAL COSMIC POWERS'
+
+
+@pytest.mark.unit
+def test_iter_records_is_lazy():
+    compressed = b'H4sIAIoX6loC/8ssKalUSMoEkTmZZZl56QrFBYnJqQC7waqcFwAAAA=='
+    records = ({'kinesis': {'data': compressed}} for _ in range(3))
+    decoded = kinesis.iter_records(records, compressed=True, transform_fn=lambda s: s.upper())
+
+    assert next(decoded) == 'ITTY BITTY LIVING SPACE'
+    assert len(list(decoded)) == 2
+
+
+@pytest.mark.unit
+def test_iter_records_chunks():
+    s64 = b'cGhlbm9tZW5hbCBjb3NtaWMgcG93ZXJz'
+    records = [{'kinesis': {'data': s64}}] * 5
+
+    chunks = list(kinesis.iter_records(records, chunk_size=2))
+    assert [len(c) for c in chunks] == [2, 2, 1]
+    assert sum(chunks, []) == kinesis.decode_records(records)
+
+
+def _compressed_records(n):
+    return [{'kinesis': {'data': base64.b64encode(gzip.compress(json.dumps({'i': i, 'log': 'x' * 1000}).encode()))}}
+            for i in range(n)]
+
+
+@pytest.mark.unit
+def test_decode_records_threads_preserve_order():
+    records = _compressed_records(101)
+    decoded = kinesis.decode_records(records, compressed=True, transform_fn=json.loads, max_workers=4)
+    assert [d['i'] for d in decoded] == list(range(101))
+
+
+@pytest.mark.unit
+def test_decode_records_processes_preserve_order():
+    records = _compressed_records(50)
+    decoded = kinesis.decode_records(records, compressed=True, transform_fn=json.loads, max_workers=2,
+                                     processes=True)
+    assert decoded == kinesis.decode_records(records, compressed=True, transform_fn=json.loads)
+
+
+@pytest.mark.unit
+def test_decode_records_falls_back_to_threads(mocker):
+    mocker.patch.dict(kinesis._process_pool, clear=True)
+    mocker.patch('pyfaaster.aws.kinesis.ProcessPoolExecutor', side_effect=OSError('no /dev/shm'))
+    records = _compressed_records(10)
+    decoded = kinesis.decode_records(records, compressed=True, max_workers=2, processes=True)
+    assert decoded == kinesis.decode_records(records, compressed=True)
+
+
+@pytest.mark.unit
+def test_decode_records_replaces_broken_process_pool(mocker):
+    broken = mocker.Mock()
+    broken.map.side_effect = BrokenProcessPool('worker killed')
+    threads = ThreadPoolExecutor(max_workers=2)
+    mocker.patch.dict(kinesis._process_pool, {2: broken}, clear=True)
+    mocker.patch('pyfaaster.aws.kinesis.ProcessPoolExecutor', return_value=threads)
+    records = _compressed_records(10)
+
+    decoded = kinesis.decode_records(records, compressed=True, max_workers=2, processes=True)
+    assert decoded == kinesis.decode_records(records, compressed=True)
+    assert kinesis._process_pool == {2: threads}
+    threads.shutdown()
+
+
+@pytest.mark.unit
+def test_decode_records_pool_per_max_workers():
+    records = _compressed_records(10)
+    kinesis.decode_records(records, compressed=True, max_workers=2)
+    kinesis.decode_records(records, compressed=True, max_workers=3)
+    assert concurrency.executor('kinesis-2')._max_workers == 2
+    assert concurrency.executor('kinesis-3')._max_workers == 3
+
+
+def _cpu_bound(data):
+    # pure python work that holds the GIL, module level so process pools can pickle it
+    record = json.loads(data)
+    record['checksum'] = sum(ord(c) * i for i, c in enumerate(record['log'] * 5))
+    return record
+
+
+@pytest.mark.performance
+def test_decode_records_parallel_benchmark():
+    max_workers = 4
+    modes = {'threads': {'max_workers': max_workers},
+             'processes': {'max_workers': max_workers, 'processes': True}}
+    wins = {}
+    for size in (10, 100, 1000, 4000):
+        records = _compressed_records(size)
+        number = max(1, 1000 // size)
+        serial = min(timeit.repeat(lambda: kinesis.decode_records(records, True, _cpu_bound), number=number,
+                                   repeat=3))
+        report = [f'{size} records: serial {serial / number * 1000:.2f}ms']
+        for mode, kwargs in modes.items():
+            parallel = min(timeit.repeat(lambda: kinesis.decode_records(records, True, _cpu_bound, **kwargs),
+                                         number=number, repeat=3))
+            report.append(f'{mode} {parallel / number * 1000:.2f}ms ({serial / parallel:.2f}x)')
+            # the smallest batch from which parallel keeps winning, not a one off win
+            if parallel < serial:
+                wins.setdefault(mode, size)
+            else:
+                wins.pop(mode, None)
+        print(', '.join(report))
+
+    for mode in modes:
+        if mode in wins:
+            print(f'{mode} ({max_workers} workers) beat serial from {wins[mode]} records')
+        else:
+            print(f'{mode} ({max_workers} workers) never beat serial on this host ({os.cpu_count()} CPUs)')
+
+
+def _varint(n):
+    out = bytearray()
+    while True:
+        b, n = n & 0x7f, n >> 7
+        out.append(b | (0x80 if n else 0))
+        if not n:
+            return bytes(out)
+
+
+def _field(number, value):
+    if isinstance(value, int):
+        return _varint(number << 3) + _varint(value)
+    return _varint(number << 3 | 2) + _varint(len(value)) + value
+
+
+def _aggregated(user_records, partition_keys=(b'pk-0', b'pk-1'), hash_keys=(b'123',)):
+    message = b''.join([_field(1, pk) for pk in partition_keys] + [_field(2, hk) for hk in hash_keys])
+    for i, data in enumerate(user_records):
+        message += _field(3, _field(1, i % len(partition_keys)) + _field(3, data))
+    return kinesis.KPL_MAGIC + message + hashlib.md5(message).digest()
+
+
+@pytest.mark.unit
+def test_deaggregate():
+    user_records = kinesis.deaggregate(_aggregated([b'one', b'two', b'']))
+    assert user_records == [
+        {'partitionKey': 'pk-0', 'explicitHashKey': None, 'data': b'one'},
+        {'partitionKey': 'pk-1', 'explicitHashKey': None, 'data': b'two'},
+        {'partitionKey': 'pk-0', 'explicitHashKey': None, 'data': b''},
+    ]
+
+
+@pytest.mark.unit
+def test_deaggregate_not_aggregated():
+    assert kinesis.deaggregate(b'plain') == [{'partitionKey': None, 'explicitHashKey': None, 'data': b'plain'}]
+
+    corrupted = _aggregated([b'one'])[:-1] + b'\x00'
+    assert kinesis.deaggregate(corrupted)[0]['data'] == corrupted
+
+
+@pytest.mark.unit
+def test_decode_records_aggregated():
+    aggregated = _aggregated([gzip.compress(json.dumps({'i': i}).encode()) for i in range(3)])
+    records = [{'kinesis': {'data': base64.b64encode(aggregated)}}] + _compressed_records(1)
+
+    decoded = kinesis.decode_records(records, compressed=True, transform_fn=json.loads, aggregated=True)
+    assert [d['i'] for d in decoded] == [0, 1, 2, 0]
+    assert kinesis.decode_records(records, compressed=True, transform_fn=json.loads, aggregated=True,
+                                  max_workers=2) == decoded
+    assert list(kinesis.iter_records(records, compressed=True, transform_fn=json.loads, aggregated=True)) == decoded
+
+
+@pytest.fixture(scope='function')
+def kinesis_client():
+    return botocore.session.get_session().create_client('kinesis', region_name='us-east-1')
+
+
+def _put_records_response(results):
+    failed = sum(1 for r in results if 'ErrorCode' in r)
+    return {'FailedRecordCount': failed, 'Records': results} if failed else {'Records': results}
+
+
+def _shard_result(n):
+    return {'ShardId': 'shardId-000000000000', 'SequenceNumber': str(n)}
+
+
+@pytest.mark.unit
+def test_producer_retries_throughput_exceeded(kinesis_client, mocker):
+    sleep = mocker.patch('time.sleep')
+    throttled = {'ErrorCode': 'ProvisionedThroughputExceededException', 'ErrorMessage': 'slow down'}
+    internal = {'ErrorCode': 'InternalFailure', 'ErrorMessage': 'oops'}
+
+    with Stubber(kinesis_client) as stubber:
+        stubber.add_response('put_records', _put_records_response([_shard_result(0), throttled, internal]), {
+            'StreamName': 'stream',
+            'Records': [{'Data': d, 'PartitionKey': 'pk'} for d in (b'a', b'b', b'c')]})
+        stubber.add_response('put_records', _put_records_response([_shard_result(1)]), {
+            'StreamName': 'stream', 'Records': [{'Data': b'b', 'PartitionKey': 'pk'}]})
+
+        producer = kinesis.Producer('stream', client=kinesis_client, backoff=0.5)
+        for data in ('a', 'b', b'c'):
+            producer.put(data, partition_key='pk')
+        results = producer.flush()
+
+    assert [r['success'] for r in results] == [True, True, False]
+    assert results[1]['SequenceNumber'] == '1'
+    assert results[2]['error'] == {'Code': 'InternalFailure', 'Message': 'oops'}
+    sleep.assert_called_once_with(0.5)
+    assert producer.flush() == []
+
+
+@pytest.mark.unit
+def test_producer_chunks_and_compresses(kinesis_client, mocker):
+    put_records = mocker.patch.object(
+        kinesis_client, 'put_records',
+        side_effect=lambda StreamName, Records: _put_records_response([_shard_result(0)] * len(Records)))
+
+    with kinesis.Producer('stream', compressed=True, client=kinesis_client) as producer:
+        for i in range(kinesis.MAX_PUT_RECORDS + 1):
+            producer.put(json.dumps({'i': i}))
+
+    assert [len(c[1]['Records']) for c in put_records.call_args_list] == [kinesis.MAX_PUT_RECORDS, 1]
+    last = put_records.call_args[1]['Records'][0]
+    record = {'kinesis': {'data': base64.b64encode(last['Data'])}}
+    assert kinesis.decode_record(record, compressed=True, transform_fn=json.loads) == {'i': kinesis.MAX_PUT_RECORDS}
+
+
+@pytest.mark.unit
+def test_producer_limits_bytes(kinesis_client, mocker):
+    put_records = mocker.patch.object(
+        kinesis_client, 'put_records',
+        side_effect=lambda StreamName, Records: _put_records_response([_shard_result(0)] * len(Records)))
+    producer = kinesis.Producer('stream', client=kinesis_client)
+
+    for _ in range(6):
+        producer.put(b'x' * (kinesis.MAX_RECORD_BYTES - 10), partition_key='pk')
+    assert len(producer.flush()) == 6
+    assert [len(c[1]['Records']) for c in put_records.call_args_list] == [5, 1]
+
+    with pytest.raises(ValueError):
+        producer.put(b'x' * kinesis.MAX_RECORD_BYTES)
+
+
+@pytest.mark.unit
+def test_producer_keeps_unwritten_records(kinesis_client, mocker):
+    mocker.patch('time.sleep')
+    throttled = {'ErrorCode': 'ProvisionedThroughputExceededException', 'ErrorMessage': 'slow down'}
+
+    with Stubber(kinesis_client) as stubber:
+        stubber.add_response('put_records', _put_records_response([_shard_result(0), throttled]))
+        stubber.add_client_error('put_records', 'ResourceNotFoundException')
+        stubber.add_response('put_records', _put_records_response([_shard_result(1), _shard_result(2)]), {
+            'StreamName': 'stream',
+            'Records': [{'Data': d, 'PartitionKey': 'pk'} for d in (b'b', b'c')]})
+
+        producer = kinesis.Producer('stream', client=kinesis_client)
+        for data in ('a', 'b'):
+            producer.put(data, partition_key='pk')
+        with pytest.raises(botocore.exceptions.ClientError):
+            producer.flush()
+        producer.put('c', partition_key='pk')
+        results = producer.flush()
+
+    assert [r['SequenceNumber'] for r in results] == ['0', '1', '2']
+
+
+@pytest.mark.unit
+def test_producer_raises_failures_on_exit(kinesis_client):
+    internal = {'ErrorCode': 'InternalFailure', 'ErrorMessage': 'oops'}
+
+    with Stubber(kinesis_client) as stubber:
+        stubber.add_response('put_records', _put_records_response([_shard_result(0), internal]))
+        with pytest.raises(kinesis.PutRecordsException) as e:
+            with kinesis.Producer('stream', client=kinesis_client) as producer:
+                producer.put('a')
+                producer.put('b')
+
+    assert e.value.failed == [{'success': False, 'error': {'Code': 'InternalFailure', 'Message': 'oops'}}]
+
+
+@pytest.mark.unit
+def test_decode_records_raw():
+    records = _compressed_records(3)
+    [raw] = kinesis.decode_records(records[:1], compressed=True, raw=True)
+    assert isinstance(raw, bytes)
+
+    decoded = kinesis.decode_records(records, compressed=True, transform_fn=json.loads, raw=True)
+    assert decoded == kinesis.decode_records(records, compressed=True, transform_fn=json.loads)
+    assert list(kinesis.iter_records(records, compressed=True, transform_fn=json.loads, raw=True)) == decoded
+
+
+@pytest.mark.unit
+def test_decode_records_ndjson():
+    lines = b'{"i": 0}\n{"i": 1}\r\n\n{"i": 2}\n'
+    records = [{'kinesis': {'data': base64.b64encode(gzip.compress(lines))}},
+               {'kinesis': {'data': base64.b64encode(gzip.compress(b'{"i": 3}'))}}]
+
+    decoded = kinesis.decode_records(records, compressed=True, ndjson=True, transform_fn=lambda o: o['i'])
+    assert decoded == [0, 1, 2, 3]
+    assert kinesis.decode_records(records, compressed=True, ndjson=True, max_workers=2) == [{'i': i} for i in range(4)]
+    assert list(kinesis.iter_records(records, compressed=True, ndjson=True, chunk_size=3)) == [
+        [{'i': 0}, {'i': 1}, {'i': 2}], [{'i': 3}]]
+
+
+def _shards(count, max_hash_key=2 ** 128 - 1):
+    width = (max_hash_key + 1) // count
+    return [{'ShardId': f'shardId-{i:012}',
+             'HashKeyRange': {'StartingHashKey': str(i * width), 'EndingHashKey': str((i + 1) * width - 1)},
+             'SequenceNumberRange': {'StartingSequenceNumber': '0'}}
+            for i in range(count)]
+
+
+@pytest.fixture(scope='function')
+def shard_ranges_cache():
+    kinesis.shard_ranges_cache.clear()
+    yield kinesis.shard_ranges_cache
+    kinesis.shard_ranges_cache.clear()
+
+
+@pytest.mark.unit
+def test_shard_ranges(kinesis_client, shard_ranges_cache):
+    shards = _shards(4)
+    closed = dict(shards[0], ShardId='shardId-closed')
+    closed['SequenceNumberRange'] = {'StartingSequenceNumber': '0', 'EndingSequenceNumber': '1'}
+
+    with Stubber(kinesis_client) as stubber:
+        stubber.add_response('list_shards', {'Shards': [shards[2], closed], 'NextToken': 'more'},
+                             {'StreamName': 'stream'})
+        stubber.add_response('list_shards', {'Shards': [shards[0], shards[3], shards[1]]}, {'NextToken': 'more'})
+
+        ranges = kinesis.shard_ranges('stream', kinesis_client)
+        assert kinesis.shard_ranges('stream', kinesis_client) is ranges
+
+    assert [r[0] for r in ranges] == [s['ShardId'] for s in shards]
+    assert ranges[1][1:] == (2 ** 126, 2 ** 127 - 1)
+
+
+@pytest.mark.unit
+def test_shard_ranges_per_region(kinesis_client, shard_ranges_cache):
+    west = botocore.session.get_session().create_client('kinesis', region_name='us-west-2')
+    with Stubber(kinesis_client) as east_stubber, Stubber(west) as west_stubber:
+        east_stubber.add_response('list_shards', {'Shards': _shards(2)}, {'StreamName': 'stream'})
+        west_stubber.add_response('list_shards', {'Shards': _shards(4)}, {'StreamName': 'stream'})
+
+        assert len(kinesis.shard_ranges('stream', kinesis_client)) == 2
+        assert len(kinesis.shard_ranges('stream', west)) == 4
+        assert len(kinesis.shard_ranges('stream', kinesis_client)) == 2
+
+
+@pytest.mark.unit
+def test_shard_balancer():
+    ranges = [(s['ShardId'], int(s['HashKeyRange']['StartingHashKey']), int(s['HashKeyRange']['EndingHashKey']))
+              for s in _shards(4)]
+    balancer = kinesis.ShardBalancer(ranges=ranges)
+
+    assert [balancer.shard_id(explicit_hash_key=balancer.hash_key()) for _ in range(8)] == \
+        [r[0] for r in ranges] * 2
+    assert len({balancer.hash_key('customer-1') for _ in range(5)}) == 1
+    assert balancer.shard_id(explicit_hash_key='0') == ranges[0][0]
+    assert balancer.shard_id(explicit_hash_key=str(2 ** 128 - 1)) == ranges[3][0]
+
+
+@pytest.mark.performance
+def test_shard_balancer_simulation():
+    # uneven ranges, as after splitting the first of four shards
+    ranges = [(f'shardId-{i}', int(s['HashKeyRange']['StartingHashKey']), int(s['HashKeyRange']['EndingHashKey']))
+              for i, s in enumerate(_shards(8)[:2] + _shards(4)[1:])]
+    balancer = kinesis.ShardBalancer(ranges=ranges)
+    records = 100000
+    groups = [f'customer-{i}' for i in range(1000)]
+
+    loads = {
+        'random partition keys': Counter(balancer.shard_id(partition_key=uuid.uuid4().hex) for _ in range(records)),
+        'round robin': Counter(balancer.shard_id(explicit_hash_key=balancer.hash_key()) for _ in range(records)),
+        'grouped': Counter(balancer.shard_id(explicit_hash_key=balancer.hash_key(groups[i % len(groups)]))
+                           for i in range(records)),
+    }
+    hottest = {}
+    for strategy, load in loads.items():
+        counts = [load[shard_id] for shard_id, _, _ in ranges]
+        hottest[strategy] = max(counts) / (records / len(ranges))
+        print(f'{strategy}: {counts}, hottest shard at {hottest[strategy]:.2f}x the mean')
+    assert len(set(loads['round robin'].values())) == 1
+    # random keys follow the uneven ranges, the balancer doesn't
+    assert hottest['random partition keys'] > 1.2
+    assert hottest['grouped'] < hottest['random partition keys']
@@ -8,7 +8,9 @@ import simplejson as json
 
 from botocore.stub import Stubber
 
+from pyfaaster.aws.exceptions import PublishException
 import pyfaaster.aws.publish as pub
+import pyfaaster.common.concurrency as concurrency
 
 
 @pytest.mark.unit
@@ -45,3 +47,241 @@ def test_publish():
         published_messages = pub.publish(conn, messages)
 
     assert len(published_messages) == 2
+
+
+def _events(count, event_type='test-event'):
+    return [{'type': event_type, 'detail': {'n': i, 'timestamp': 'fixed'}} for i in range(count)]
+
+
+def _entries(events, ids=None):
+    return [{
+        'Id': str(i),
+        'Message': json.dumps(event['detail'], iterable_as_array=True),
+        'Subject': event['type'],
+        'MessageAttributes': {'message_type': {'DataType': 'String', 'StringValue': event['type']}},
+    } for i, event in zip(ids if ids is not None else range(len(events)), events)]
+
+
+@pytest.mark.unit
+def test_publish_events_batch():
+    region = 'us-east-1'
+    account_id = '123456789012'
+    namespace = 'test'
+    topic_arn = f'arn:aws:sns:{region}:{account_id}:system-{namespace}-topic-1'
+
+    sns = botocore.session.get_session().create_client('sns', region_name=region)
+    conn = pub.conn(region, account_id, namespace, client=sns)
+    events = _events(12)
+
+    with Stubber(sns) as stubber:
+        stubber.add_response('publish_batch',
+                             {'Successful': [{'Id': str(i), 'MessageId': f'm{i}'} for i in range(10)], 'Failed': []},
+                             {'TopicArn': topic_arn, 'PublishBatchRequestEntries': _entries(events[:10])})
+        stubber.add_response('publish_batch',
+                             {'Successful': [{'Id': '10', 'MessageId': 'm10'}],
+                              'Failed': [{'Id': '11', 'Code': 'InternalError', 'SenderFault': False}]},
+                             {'TopicArn': topic_arn, 'PublishBatchRequestEntries': _entries(events[10:], ids=[10, 11])})
+        stubber.add_response('publish_batch',
+                             {'Successful': [{'Id': '11', 'MessageId': 'm11'}], 'Failed': []},
+                             {'TopicArn': topic_arn, 'PublishBatchRequestEntries': _entries(events[11:], ids=[11])})
+
+        results = pub.publish_events_batch(conn, {f'system-{namespace}-topic-1': events}, backoff=0)
+        stubber.assert_no_pending_responses()
+
+    assert [r['MessageId'] for r in results] == [f'm{i}' for i in range(12)]
+    assert all(r['success'] and r['topic'] == f'system-{namespace}-topic-1' for r in results)
+    assert [r['event'] for r in results] == [e['detail'] for e in events]
+
+
+@pytest.mark.unit
+def test_publish_events_batch_failures():
+    region = 'us-east-1'
+    account_id = '123456789012'
+    namespace = 'test'
+    topic_arn = f'arn:aws:sns:{region}:{account_id}:topic-1'
+
+    sns = botocore.session.get_session().create_client('sns', region_name=region)
+    conn = pub.conn(region, account_id, namespace, client=sns)
+    events = _events(2)
+
+    with Stubber(sns) as stubber:
+        stubber.add_response('publish_batch',
+                             {'Successful': [],
+                              'Failed': [{'Id': '0', 'Code': 'InvalidParameter', 'SenderFault': True},
+                                         {'Id': '1', 'Code': 'InternalError', 'SenderFault': False}]},
+                             {'TopicArn': topic_arn, 'PublishBatchRequestEntries': _entries(events)})
+        stubber.add_response('publish_batch',
+                             {'Successful': [], 'Failed': [{'Id': '1', 'Code': 'InternalError', 'SenderFault': False}]},
+                             {'TopicArn': topic_arn, 'PublishBatchRequestEntries': _entries(events[1:], ids=[1])})
+
+        results = pub.publish_events_batch(conn, {'topic-1': events}, max_attempts=2, backoff=0)
+        stubber.assert_no_pending_responses()
+
+    assert [r['success'] for r in results] == [False, False]
+    assert [r['error']['Code'] for r in results] == ['InvalidParameter', 'InternalError']
+
+
+@pytest.mark.unit
+def test_publish_events_batch_oversized_and_client_errors():
+    region = 'us-east-1'
+    account_id = '123456789012'
+    topic_arn = f'arn:aws:sns:{region}:{account_id}:topic-1'
+
+    sns = botocore.session.get_session().create_client('sns', region_name=region)
+    conn = pub.conn(region, account_id, 'test', client=sns)
+    events = _events(12)
+    events[0]['detail']['padding'] = 'x' * pub.MAX_BATCH_BYTES
+
+    with Stubber(sns) as stubber:
+        stubber.add_client_error('publish_batch', 'InternalError', 'try again')
+        stubber.add_response('publish_batch', {'Successful': [{'Id': '11', 'MessageId': 'm11'}], 'Failed': []},
+                             {'TopicArn': topic_arn, 'PublishBatchRequestEntries': _entries(events[11:], ids=[11])})
+
+        results = pub.publish_events_batch(conn, {'topic-1': events}, backoff=0)
+        stubber.assert_no_pending_responses()
+
+    assert results[0]['error']['Code'] == 'EntryTooLarge'
+    assert [r['error']['Code'] for r in results[1:11]] == ['InternalError'] * 10
+    assert results[11]['MessageId'] == 'm11'
+
+
+@pytest.mark.unit
+def test_publish_concurrently(mocker):
+    sns = mocker.Mock()
+    conn = pub.conn('us-east-1', '123456789012', 'test', client=sns)
+    messages = {f'topic-{i}': f'message {i}' for i in range(8)}
+
+    assert pub.publish(conn, messages, max_concurrency=4) == list(messages.values())
+    assert sorted(c[1]['TopicArn'] for c in sns.publish.call_args_list) == sorted(
+        f'arn:aws:sns:us-east-1:123456789012:{topic}' for topic in messages)
+
+
+@pytest.mark.unit
+def test_publish_events_concurrently_collects_errors(mocker):
+    def publish(TopicArn, **kwargs):
+        if 'bad' in TopicArn:
+            raise Exception(TopicArn)
+        return {}
+
+    sns = mocker.Mock()
+    sns.publish.side_effect = publish
+    conn = pub.conn('us-east-1', '123456789012', 'test', client=sns)
+    events = {
+        'bad-topic-1': [{'type': 'e', 'detail': {}}],
+        'good-topic': [{'type': 'e', 'detail': {}}, {'type': 'e', 'detail': {}}],
+        'bad-topic-2': [{'type': 'e', 'detail': {}}],
+    }
+
+    with pytest.raises(concurrency.ConcurrentExecutionError) as err:
+        pub.publish_events(conn, events, max_concurrency=3)
+
+    assert [i for i, _ in err.value.errors] == [0, 2]
+    assert len(err.value.results[1]) == 2
+
+
+def _put_events_entries(events, event_bus, source='test'):
+    return [{
+        'Source': source,
+        'DetailType': event['type'],
+        'Detail': json.dumps(event['detail'], iterable_as_array=True),
+        'EventBusName': event_bus,
+    } for event in events]
+
+
+@pytest.mark.unit
+def test_publish_events_batch_eventbridge():
+    region = 'us-east-1'
+    account_id = '123456789012'
+    event_bus = f'arn:aws:events:{region}:{account_id}:event-bus/test-bus'
+
+    sns = botocore.session.get_session().create_client('sns', region_name=region)
+    events_client = botocore.session.get_session().create_client('events', region_name=region)
+    conn = pub.conn(region, account_id, 'test', client=sns, events_client=events_client)
+    events = _events(12)
+
+    with Stubber(events_client) as stubber:
+        stubber.add_response('put_events',
+                             {'FailedEntryCount': 0, 'Entries': [{'EventId': f'e{i}'} for i in range(10)]},
+                             {'Entries': _put_events_entries(events[:10], event_bus)})
+        stubber.add_response('put_events',
+                             {'FailedEntryCount': 2, 'Entries': [{'ErrorCode': 'InternalFailure'},
+                                                                 {'ErrorCode': 'MalformedDetail'}]},
+                             {'Entries': _put_events_entries(events[10:], event_bus)})
+        stubber.add_response('put_events',
+                             {'FailedEntryCount': 0, 'Entries': [{'EventId': 'e10'}]},
+                             {'Entries': _put_events_entries(events[10:11], event_bus)})
+
+        results = pub.publish_events_batch(conn, {event_bus: events}, backoff=0)
+        stubber.assert_no_pending_responses()
+
+    assert [r['success'] for r in results] == [True] * 11 + [False]
+    assert all(r['target'] == event_bus for r in results)
+    assert [r.get('EventId') for r in results[:11]] == [f'e{i}' for i in range(11)]
+    assert results[11]['error']['Code'] == 'MalformedDetail'
+
+
+@pytest.mark.unit
+def test_publish_events_batch_eventbridge_oversized_and_client_errors():
+    event_bus = 'arn:aws:events:us-east-1:123456789012:event-bus/test-bus'
+    events_client = botocore.session.get_session().create_client('events', region_name='us-east-1')
+    conn = pub.conn('us-east-1', '123456789012', 'test', client=events_client, events_client=events_client)
+    events = _events(12)
+    events[1]['detail']['padding'] = 'x' * pub.MAX_BATCH_BYTES
+
+    with Stubber(events_client) as stubber:
+        stubber.add_client_error('put_events', 'AccessDeniedException', 'no')
+        stubber.add_response('put_events', {'FailedEntryCount': 0, 'Entries': [{'EventId': 'e11'}]},
+                             {'Entries': _put_events_entries(events[11:], event_bus)})
+
+        results = pub.publish_events_batch(conn, {event_bus: events}, backoff=0)
+        stubber.assert_no_pending_responses()
+
+    assert results[1]['error']['Code'] == 'EntryTooLarge'
+    assert [r['error'] for r in results[:1] + results[2:11]] == [{'Code': 'AccessDeniedException', 'Message': 'no'}] * 10
+    assert results[11]['EventId'] == 'e11'
+
+
+@pytest.mark.unit
+def test_publish_events_routes_by_backend():
+    region = 'us-east-1'
+    account_id = '123456789012'
+
+    sns = botocore.session.get_session().create_client('sns', region_name=region)
+    events_client = botocore.session.get_session().create_client('events', region_name=region)
+    conn = pub.conn(region, account_id, 'test', client=sns, events_client=events_client,
+                    backends=pub.event_bus_backends('bus-{namespace}'))
+    bus_events = [{'type': 'bus-event', 'detail': {'timestamp': 'fixed'}, 'source': 'my.source'}]
+    topic_events = [{'type': 'topic-event', 'detail': {'timestamp': 'fixed'}}]
+
+    with Stubber(events_client) as events_stubber, Stubber(sns) as sns_stubber:
+        events_stubber.add_response('put_events', {'FailedEntryCount': 0, 'Entries': [{'EventId': 'e0'}]},
+                                    {'Entries': _put_events_entries(bus_events, 'bus-test', source='my.source')})
+        sns_stubber.add_response('publish', {}, {
+            'TopicArn': f'arn:aws:sns:{region}:{account_id}:topic',
+            'Message': json.dumps(topic_events[0]['detail']),
+            'Subject': 'topic-event',
+            'MessageAttributes': {'message_type': {'DataType': 'String', 'StringValue': 'topic-event'}},
+        })
+
+        published = pub.publish_events(conn, {'bus-{namespace}': bus_events, 'topic': topic_events})
+        events_stubber.assert_no_pending_responses()
+        sns_stubber.assert_no_pending_responses()
+
+    assert published == [bus_events[0]['detail'], topic_events[0]['detail']]
+
+
+@pytest.mark.unit
+def test_publish_events_eventbridge_failure():
+    events_client = botocore.session.get_session().create_client('events', region_name='us-east-1')
+    conn = pub.conn('us-east-1', '123456789012', 'test', client=events_client, events_client=events_client)
+    event_bus = 'arn:aws:events:us-east-1:123456789012:event-bus/test-bus'
+    events = [{'type': 'bus-event', 'detail': {'timestamp': 'fixed'}}]
+
+    with Stubber(events_client) as stubber:
+        stubber.add_response('put_events',
+                             {'FailedEntryCount': 1, 'Entries': [{'ErrorCode': 'MalformedDetail', 'ErrorMessage': 'no'}]},
+                             {'Entries': _put_events_entries(events, event_bus)})
+        with pytest.raises(PublishException) as err:
+            pub.publish_events(conn, {event_bus: events})
+
+    assert err.value.failures[0]['error'] == {'Code': 'MalformedDetail', 'Message': 'no'}
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016-present, CloudZero, Inc. All rights reserved.
+# Licensed under the BSD-style license. See LICENSE file in the project root for full license information.
+
+import threading
+import time
+
+import pytest
+
+import pyfaaster.common.concurrency as concurrency
+
+
+@pytest.mark.unit
+def test_map_concurrently_preserves_order():
+    def slow_identity(x):
+        time.sleep(0.01 * (5 - x))
+        return x
+
+    assert concurrency.map_concurrently(slow_identity, range(5)) == list(range(5))
+
+
+@pytest.mark.unit
+def test_map_concurrently_max_concurrency():
+    lock = threading.Lock()
+    state = {'running': 0, 'peak': 0}
+
+    def track(_):
+        with lock:
+            state['running'] += 1
+            state['peak'] = max(state['peak'], state['running'])
+        time.sleep(0.01)
+        with lock:
+            state['running'] -= 1
+
+    concurrency.map_concurrently(track, range(12), max_concurrency=3)
+    assert 1 < state['peak'] <= 3
+
+
+@pytest.mark.unit
+def test_map_concurrently_serial_runs_in_calling_thread():
+    caller = threading.current_thread()
+    assert concurrency.map_concurrently(lambda _: threading.current_thread(), range(3), max_concurrency=1) == [caller] * 3
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('max_concurrency', [1, 4])
+def test_map_concurrently_collects_errors(max_concurrency):
+    def fail_on_odd(x):
+        if x % 2:
+            raise ValueError(x)
+        return x
+
+    with pytest.raises(concurrency.ConcurrentExecutionError) as err:
+        concurrency.map_concurrently(fail_on_odd, range(5), max_concurrency=max_concurrency)
+
+    assert [i for i, _ in err.value.errors] == [1, 3]
+    assert err.value.results == [0, None, 2, None, 4]
+
+
+@pytest.mark.unit
+def test_executor_is_reused():
+    assert concurrency.executor('test') is concurrency.executor('test')
+    assert concurrency.executor('test') is not concurrency.executor('other-test')